@@ -0,0 +1,148 @@
+import binascii, json, os, socket, socketserver, stat, sys, threading
+from collections import OrderedDict
+import compiler_plugin
+
+# Compile daemon: keeps the compiler loaded in a long-running process and
+# serves requests over a local Unix socket, so that short-lived tools don't
+# pay interpreter startup and module import for every contract.
+#
+# Protocol: one JSON object per line in each direction. A request looks like
+#   {"method": "compile" | "abi" | "gas_estimate", "code": "...", "options": {...}}
+# and is answered with {"result": ...} or {"error": "..."}. Compiled code is
+# returned as a 0x-prefixed hex string.
+
+# Maximum number of artifacts (and, separately, of parsed sources) kept in
+# memory
+DEFAULT_CACHE_SIZE = 256
+
+# Options that may be passed through to the compiler
+allowed_options = ['batch', 'optimize', 'passes', 'target']
+
+# Bounded least-recently-used cache, safe to share between threads
+class LRUCache():
+    def __init__(self, size=DEFAULT_CACHE_SIZE):
+        self.size = size
+        self.items = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+
+    def get(self, key):
+        with self.lock:
+            if key not in self.items:
+                self.misses += 1
+                return None
+            self.hits += 1
+            self.items.move_to_end(key)
+            return self.items[key]
+
+    def put(self, key, value):
+        with self.lock:
+            self.items[key] = value
+            self.items.move_to_end(key)
+            while len(self.items) > self.size:
+                self.items.popitem(last=False)
+
+compiler = compiler_plugin.Compiler()
+
+# The compiler uses global counters for fresh symbols, so only one
+# compilation may run at a time
+compile_lock = threading.Lock()
+
+methods = ['compile', 'abi', 'gas_estimate']
+
+def run_method(method, tree, options):
+    if method == 'compile':
+        return '0x' + binascii.hexlify(compiler.compile(tree, **options)).decode('ascii')
+    elif method == 'abi':
+        return compiler.mk_full_signature(tree, **options)
+    elif method == 'gas_estimate':
+        return compiler.gas_estimate(tree)
+    raise Exception("Unknown method: %r" % method)
+
+# Handles one decoded request, using the cache for repeated requests and the
+# fronts cache to parse each source only once across methods and options
+def handle_request(req, cache, fronts):
+    method, code, options = req.get('method'), req.get('code'), req.get('options', {})
+    if method == 'stats':
+        return {"hits": cache.hits, "misses": cache.misses, "size": len(cache.items),
+                "parse_hits": fronts.hits, "parse_misses": fronts.misses}
+    if method not in methods:
+        raise Exception("Unknown method: %r" % method)
+    if not isinstance(code, str):
+        raise Exception("Request must contain the contract source as 'code'")
+    if method == 'gas_estimate' and options:
+        raise Exception("gas_estimate takes no options")
+    for key in options:
+        if key not in allowed_options:
+            raise Exception("Unsupported option: %r" % key)
+    key = (method, code, json.dumps(options, sort_keys=True))
+    result = cache.get(key)
+    if result is None:
+        tree = fronts.get(code)
+        if tree is None:
+            tree = compiler_plugin.parse_code(code)
+            fronts.put(code, tree)
+        with compile_lock:
+            result = run_method(method, tree, options)
+        cache.put(key, result)
+    return result
+
+class RequestHandler(socketserver.StreamRequestHandler):
+    def handle(self):
+        for line in self.rfile:
+            if not line.strip():
+                continue
+            try:
+                response = {"result": handle_request(json.loads(line.decode('utf-8')), self.server.cache, self.server.fronts)}
+            except Exception as e:
+                response = {"error": str(e)}
+            self.wfile.write(json.dumps(response).encode('utf-8') + b'\n')
+            self.wfile.flush()
+
+class CompileServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+
+    def __init__(self, path, cache_size=DEFAULT_CACHE_SIZE):
+        # A socket left behind by a previous daemon is removed, but any
+        # other file at the path is left alone
+        if os.path.exists(path):
+            if not stat.S_ISSOCK(os.stat(path).st_mode):
+                raise Exception("Refusing to replace %s: not a socket" % path)
+            os.unlink(path)
+        socketserver.UnixStreamServer.__init__(self, path, RequestHandler)
+        self.cache = LRUCache(cache_size)
+        self.fronts = LRUCache(cache_size)
+
+def serve(path, cache_size=DEFAULT_CACHE_SIZE):
+    server = CompileServer(path, cache_size)
+    try:
+        server.serve_forever()
+    finally:
+        server.server_close()
+        os.unlink(path)
+
+# Sends a single request to a running daemon and returns its result
+def request(path, method, code=None, **options):
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    sock.connect(path)
+    try:
+        sock.sendall(json.dumps({"method": method, "code": code, "options": options}).encode('utf-8') + b'\n')
+        data = b''
+        while not data.endswith(b'\n'):
+            chunk = sock.recv(65536)
+            if not chunk:
+                break
+            data += chunk
+    finally:
+        sock.close()
+    response = json.loads(data.decode('utf-8'))
+    if 'error' in response:
+        raise Exception(response['error'])
+    return response['result']
+
+if __name__ == '__main__':
+    if len(sys.argv) not in (2, 3):
+        print("Usage: python compile_daemon.py <socket path> [cache size]")
+        sys.exit(1)
+    serve(sys.argv[1], int(sys.argv[2]) if len(sys.argv) == 3 else DEFAULT_CACHE_SIZE)
@@ -1,4 +1,4 @@
-from parser import LLLnode
+from parser import LLLnode, DECIMAL_DIVISOR, MAXDECIMAL, MINDECIMAL
 from opcodes import opcodes, pseudo_opcodes
 
 def num_to_bytearray(x):
@@ -12,13 +12,20 @@ PUSH_OFFSET = 0x5f
 DUP_OFFSET = 0x7f
 SWAP_OFFSET = 0x8f
 
-# Estimates gas consumption
-def gas_estimate(code, depth=0):
+# Gas of jumping to an internal function and back: pushing the return
+# address and the label, and the two jumps and jumpdests
+INTERNAL_CALL_GAS = 2 * 3 + 2 * opcodes['JUMP'][3] + 2 * opcodes['JUMPDEST'][3]
+
+# Estimates gas consumption. internal_gas gives the gas of one call to each
+# internal function by label (see get_internal_gas), which is added at each
+# call; the subroutines themselves cost nothing where they are placed
+def gas_estimate(code, depth=0, internal_gas=None):
+    internal_gas = internal_gas or {}
     if isinstance(code.value, int):
         return 3
     elif isinstance(code.value, str) and (code.value.upper() in opcodes or code.value.upper() in pseudo_opcodes):
         decl = opcodes.get(code.value.upper(), pseudo_opcodes.get(code.value.upper(), None))
-        o = sum([gas_estimate(c, depth + i) for i, c in enumerate(code.args[::-1])]) + decl[3]
+        o = sum([gas_estimate(c, depth + i, internal_gas) for i, c in enumerate(code.args[::-1])]) + decl[3]
         # Dynamic gas costs
         if code.value.upper() == 'CALL' and code.args[2].value != 0:
             o += 34000
@@ -31,22 +38,43 @@ def gas_estimate(code, depth=0):
         return o
     elif isinstance(code.value, str) and code.value == 'if':
         if (len(code.args) == 2):
-            return gas_estimate(code.args[0], depth + 1) + gas_estimate(code.args[1], depth + 1) + 30
+            return gas_estimate(code.args[0], depth + 1, internal_gas) + gas_estimate(code.args[1], depth + 1, internal_gas) + 30
         elif (len(code.args) == 3):
-            return gas_estimate(code.args[0], depth + 1) + max(gas_estimate(code.args[1], depth + 1), gas_estimate(code.args[2], depth + 1)) + 30
+            return gas_estimate(code.args[0], depth + 1, internal_gas) + \
+                max(gas_estimate(code.args[1], depth + 1, internal_gas), gas_estimate(code.args[2], depth + 1, internal_gas)) + 30
         else:
             raise Exception("If statement must have 2 or 3 child elements")
     elif isinstance(code.value, str) and code.value == 'with':
-        return gas_estimate(code.args[1], depth + 1) + gas_estimate(code.args[2], depth + 1) + 20
+        return gas_estimate(code.args[1], depth + 1, internal_gas) + gas_estimate(code.args[2], depth + 1, internal_gas) + 20
     elif isinstance(code.value, str) and code.value == 'repeat':
-        return (gas_estimate(code.args[2], depth + 1) + 50) * code.args[0].value + 30
+        return (gas_estimate(code.args[3], depth + 1, internal_gas) + 50) * code.args[2].value + 30
     elif isinstance(code.value, str) and code.value == 'seq':
-        return sum([gas_estimate(c, depth + 1) for c in code.args])
+        return sum([gas_estimate(c, depth + 1, internal_gas) for c in code.args])
+    elif isinstance(code.value, str) and code.value == 'internal_call':
+        args = code.args[2:]
+        return sum([gas_estimate(c, depth + i, internal_gas) for i, c in enumerate(args)]) + \
+            INTERNAL_CALL_GAS + internal_gas.get(code.args[0].value, 0)
+    elif isinstance(code.value, str) and code.value == 'internal_def':
+        return 0
+    elif isinstance(code.value, str) and code.value == 'internal_return':
+        return sum([gas_estimate(c, depth, internal_gas) for c in code.args]) + 3 * (depth + len(code.args))
     elif isinstance(code.value, str):
         return 3
     else:
         raise Exception("Gas estimate failed: "+repr(code))
 
+# Gas of one call to each of the given internal functions, by label: the
+# subroutine, including the internal functions it calls in turn, and moving
+# its arguments from the stack into memory
+def get_internal_gas(defs):
+    o = {}
+    # Internal functions are not recursive, so this settles after at most
+    # one round per function
+    for _ in defs:
+        for d in defs:
+            o[d.args[0].value] = gas_estimate(d.args[-1], 1, o) + 9 * (len(d.args) - 2)
+    return o
+
 next_symbol = [0]
 
 def mksymbol():
@@ -56,6 +84,18 @@ def mksymbol():
 def is_symbol(i):
     return isinstance(i, str) and i[:5] == '_sym_'
 
+# Failed checks jump to a single error block in each piece of code, which
+# ends the call with REVERT so that the remaining gas is refunded
+ERROR_SYMBOL = '_sym_error'
+
+def add_error_block(assembly):
+    if ERROR_SYMBOL not in assembly:
+        return assembly
+    o = list(assembly)
+    if not o or o[-1] not in ('STOP', 'RETURN', 'JUMP', 'REVERT', 'INVALID', 'SUICIDE', 'SELFDESTRUCT'):
+        o.append('STOP')
+    return o + [ERROR_SYMBOL, 'JUMPDEST', 'PUSH1', 0, 'DUP1', 'REVERT']
+
 # Compiles LLL to assembly
 def compile_to_assembly(code, withargs={}, break_dest=None, height=0):
     # Opcodes
@@ -108,13 +148,13 @@ def compile_to_assembly(code, withargs={}, break_dest=None, height=0):
         o = []
         loops = num_to_bytearray(code.args[2].value) or [2]
         start, end = mksymbol(), mksymbol()
-        o.extend(compile_to_assembly(code.args[0]))
-        o.extend(compile_to_assembly(code.args[1]))
+        o.extend(compile_to_assembly(code.args[0], withargs, break_dest, height))
+        o.extend(compile_to_assembly(code.args[1], withargs, break_dest, height + 1))
         o.extend(['PUSH'+str(len(loops))] + loops)
         # stack: memloc, startvalue, rounds
         o.extend(['DUP2', 'DUP4', 'MSTORE', 'ADD', start, 'JUMPDEST'])
         # stack: memloc, exit_index
-        o.extend(compile_to_assembly(code.args[3], withargs, (end, height + 1), height + 1))
+        o.extend(compile_to_assembly(code.args[3], withargs, (end, height + 2), height + 2))
         # stack: memloc, exit_index
         o.extend(['DUP2', 'MLOAD', 'PUSH1', 1, 'ADD', 'DUP1', 'DUP4', 'MSTORE'])
         # stack: len(loops), index memory address, new index
@@ -137,11 +177,40 @@ def compile_to_assembly(code, withargs={}, break_dest=None, height=0):
             o.extend(['SWAP1', 'POP'])
         else:
             o.extend(['POP'])
-        if old:
+        if old is not None:
             withargs[code.args[0].value] = old
         else:
             del withargs[code.args[0].value]
         return o
+    # Call to an internal function: pushes the arguments and the return
+    # address and jumps to the subroutine, which comes back with its result
+    # (if any) in place of them
+    elif code.value == 'internal_call':
+        o = []
+        for i, arg in enumerate(code.args[2:]):
+            o.extend(compile_to_assembly(arg, withargs, break_dest, height + i))
+        ret = mksymbol()
+        o.extend([ret, code.args[0].value, 'JUMP', ret, 'JUMPDEST'])
+        return o
+    # Internal function: moves the arguments from below the return address
+    # into memory and runs the body, which starts with an empty stack
+    elif code.value == 'internal_def':
+        o = [code.args[0].value, 'JUMPDEST']
+        for pos in code.args[-2:0:-1]:
+            o.append('SWAP1')
+            o.extend(compile_to_assembly(pos))
+            o.append('MSTORE')
+        o.extend(compile_to_assembly(code.args[-1], {}, None, 0))
+        return o
+    # Return from an internal function, dropping what the body has on the
+    # stack (loop counters, with variables) and jumping to the return address
+    elif code.value == 'internal_return':
+        if code.args:
+            o = compile_to_assembly(code.args[0], withargs, break_dest, height)
+            o.extend(['SWAP1', 'POP'] * height + ['SWAP1', 'JUMP'])
+        else:
+            o = ['POP'] * height + ['JUMP']
+        return o
     # LLL statement (used to contain code inside code)
     elif code.value == 'lll':
         o = []
@@ -150,7 +219,7 @@ def compile_to_assembly(code, withargs={}, break_dest=None, height=0):
         o.extend([endcode, 'JUMP', begincode, 'BLANK'])
         o.append(compile_to_assembly(code.args[0], {}, None, 0)) # Append is intentional
         o.extend([endcode, 'JUMPDEST', begincode, endcode, 'SUB', begincode])
-        o.extend(compile_to_assembly(code.args[1], withargs, break_dest, height))
+        o.extend(compile_to_assembly(code.args[1], withargs, break_dest, height + 2))
         o.extend(['CODECOPY', begincode, endcode, 'SUB'])
         return o
     # Seq (used to piece together multiple statements)
@@ -165,7 +234,7 @@ def compile_to_assembly(code, withargs={}, break_dest=None, height=0):
     # Assert (if false, exit)
     elif code.value == 'assert':
         o = compile_to_assembly(code.args[0], withargs, break_dest, height)
-        o.extend(['ISZERO', 'PC', 'JUMPI'])
+        o.extend(['ISZERO', ERROR_SYMBOL, 'JUMPI'])
         return o
     # Unsigned clamp, check less-than
     elif code.value == 'uclamplt':
@@ -173,43 +242,88 @@ def compile_to_assembly(code, withargs={}, break_dest=None, height=0):
             if code.args[0].value < code.args[1].value:
                 return compile_to_assembly(code.args[0], withargs, break_dest, height)
             else:
-                return ['INVALID']
+                return [ERROR_SYMBOL, 'JUMP']
         o = compile_to_assembly(code.args[0], withargs, break_dest, height)
         o.extend(compile_to_assembly(code.args[1], withargs, break_dest, height + 1))
         o.extend(['DUP2'])
         # Stack: num num bound
-        o.extend(['LT', 'ISZERO', 'PC', 'JUMPI'])
+        o.extend(['LT', 'ISZERO', ERROR_SYMBOL, 'JUMPI'])
         return o
     # Signed clamp, check against upper and lower bounds
     elif code.value == 'clamp':
         o = compile_to_assembly(code.args[0], withargs, break_dest, height)
         o.extend(compile_to_assembly(code.args[1], withargs, break_dest, height + 1))
         o.extend(['DUP1'])
-        o.extend(compile_to_assembly(code.args[2], withargs, break_dest, height + 2))
-        o.extend(['SWAP1', 'SGT', 'PC', 'JUMPI'])
-        o.extend(['DUP1', 'SWAP2', 'SWAP1', 'SLT', 'PC', 'JUMPI'])
+        o.extend(compile_to_assembly(code.args[2], withargs, break_dest, height + 3))
+        # Stack: lower value value upper; both checks share one jump
+        o.extend(['SWAP1', 'SGT', 'SWAP2', 'DUP2', 'SLT', 'DUP3', 'OR', ERROR_SYMBOL, 'JUMPI'])
+        o.extend(['SWAP1', 'POP'])
         return o
     # Checks that a value is nonzero
     elif code.value == 'clamp_nonzero':
         o = compile_to_assembly(code.args[0], withargs, break_dest, height)
-        o.extend(['DUP1', 'ISZERO', 'PC', 'JUMPI'])
+        o.extend(['DUP1', 'ISZERO', ERROR_SYMBOL, 'JUMPI'])
         return o
     # SHA3 a single value
     elif code.value == 'sha3_32':
         o = compile_to_assembly(code.args[0], withargs, break_dest, height)
         o.extend(['PUSH1', 192, 'MSTORE', 'PUSH1', 192, 'PUSH1', 32, 'SHA3'])
         return o
+    # Decimal multiplication: checks the product for overflow, rescales it
+    # and clamps it, with all three checks sharing a single jump
+    elif code.value == 'dmul':
+        o = compile_to_assembly(code.args[1], withargs, break_dest, height)
+        o.extend(compile_to_assembly(code.args[0], withargs, break_dest, height + 1))
+        # Stack: y x
+        o.extend(['DUP2', 'DUP2', 'MUL', 'DUP1', 'DUP3', 'SWAP1', 'SDIV', 'DUP4', 'EQ', 'DUP3', 'ISZERO', 'OR'])
+        # Stack: y x product ok
+        o.extend(['SWAP3', 'POP', 'SWAP1', 'POP'])
+        o.extend(compile_to_assembly(LLLnode(DECIMAL_DIVISOR)))
+        o.extend(['SWAP1', 'SDIV', 'SWAP1', 'ISZERO'])
+        # Stack: result failed
+        o.extend(decimal_bounds_check())
+        return o
+    # Decimal division: checks for a zero divisor, rescales the dividend and
+    # clamps the result, with all checks sharing a single jump
+    elif code.value == 'ddiv':
+        o = compile_to_assembly(code.args[1], withargs, break_dest, height)
+        o.extend(compile_to_assembly(code.args[0], withargs, break_dest, height + 1))
+        # Stack: y x
+        o.extend(compile_to_assembly(LLLnode(DECIMAL_DIVISOR)))
+        o.extend(['MUL', 'DUP2', 'SWAP1', 'SDIV', 'SWAP1', 'ISZERO'])
+        # Stack: result failed
+        o.extend(decimal_bounds_check())
+        return o
+    # Decimal modulo: the result is always smaller than the divisor, so only
+    # a zero divisor needs to be checked
+    elif code.value == 'dmod':
+        o = compile_to_assembly(code.args[1], withargs, break_dest, height)
+        o.extend(['DUP1', 'ISZERO', ERROR_SYMBOL, 'JUMPI'])
+        o.extend(compile_to_assembly(code.args[0], withargs, break_dest, height + 1))
+        o.extend(['SMOD'])
+        return o
     # <= operator
     elif code.value == 'sle':
-        return compile_to_assembly(LLLnode.from_list(['iszero', ['sgt', code.args[0], code.args[1]]]))
+        return compile_to_assembly(LLLnode.from_list(['iszero', ['sgt', code.args[0], code.args[1]]]), withargs, break_dest, height)
     # >= operator
     elif code.value == 'sge':
-        return compile_to_assembly(LLLnode.from_list(['iszero', ['slt', code.args[0], code.args[1]]]))
+        return compile_to_assembly(LLLnode.from_list(['iszero', ['slt', code.args[0], code.args[1]]]), withargs, break_dest, height)
     else:
         raise Exception("Weird code element: "+repr(code))
 
+# Given a stack of (result, failed), checks that the result is within the
+# decimal bounds and exits if it is not or if the failed flag is set
+def decimal_bounds_check():
+    o = ['DUP2']
+    o.extend(compile_to_assembly(LLLnode(MAXDECIMAL)))
+    o.extend(['SWAP1', 'SGT', 'OR', 'DUP2'])
+    o.extend(compile_to_assembly(LLLnode(MINDECIMAL)))
+    o.extend(['SWAP1', 'SLT', 'OR', ERROR_SYMBOL, 'JUMPI'])
+    return o
+
 # Assembles assembly into EVM
 def assembly_to_evm(assembly):
+    assembly = add_error_block(assembly)
     posmap = {}
     sub_assemblies = []
     codes = []
@@ -1,27 +1,56 @@
-import parser, compile_lll
+import parser, compile_lll, optimizer
+from opcodes import DEFAULT_TARGET
 
 def memsize_to_gas(memsize):
     return (memsize // 32) * 3 + (memsize // 32) ** 2 // 512
 
-initial_gas = compile_lll.gas_estimate(parser.mk_initial())
+# Gas used by the header code, computed the first time it is needed
+_initial_gas = []
+
+def get_initial_gas():
+    if not _initial_gas:
+        _initial_gas.append(compile_lll.gas_estimate(parser.mk_initial()))
+    return _initial_gas[0]
+
+# Gas of one call to each internal function of a contract, by label
+def get_internal_gas(internals, _globals):
+    defs = parser.make_internal_defs(internals, _globals, internals, parser.RESERVED_MEMORY)
+    return compile_lll.get_internal_gas([optimizer.optimize(d) for d in defs.values()])
+
+# Each method takes contract source, or a tree already returned by
+# parser.parse, so that callers compiling the same source several ways
+# (eg. the compile daemon) only parse it once
+def parse_code(code):
+    return parser.parse(code) if isinstance(code, str) else code
 
 class Compiler():
-    def compile(self, code, *args, **kwargs):
-        lll = parser.parse_tree_to_lll(parser.parse(code))
-        return compile_lll.assembly_to_evm(compile_lll.compile_to_assembly(lll))
+    # optimize selects the optimization level (0, 1, 2 or 'size'), passes
+    # overrides the list of passes to run, and report, if given, is a list
+    # that receives a record of the time, size and gas effect of each pass.
+    # target names the EVM version the code is for (see opcodes.targets)
+    def compile(self, code, *args, batch=False, optimize=1, passes=None, report=None, target=DEFAULT_TARGET, **kwargs):
+        lll = parser.parse_tree_to_lll(parse_code(code), batch=batch)
+        lll = optimizer.optimize(lll, optimize, passes, report, target)
+        assembly = optimizer.optimize_assembly(compile_lll.compile_to_assembly(lll), optimize, passes, report)
+        parser.flush_method_ids()
+        return compile_lll.assembly_to_evm(assembly)
 
-    def mk_full_signature(self, code, *args, **kwargs):
-        o = parser.mk_full_signature(parser.parse(code))
+    def mk_full_signature(self, code, *args, batch=False, **kwargs):
+        o = parser.mk_full_signature(parse_code(code), batch=batch)
         return o
 
     def gas_estimate(self, code, *args, **kwargs):
-        code = parser.parse(code)
+        code = parse_code(code)
         _defs, _globals = parser.get_defs_and_globals(code)
+        internals = parser.get_internal_funcs(_defs, _globals)
+        internal_gas = get_internal_gas(internals, _globals)
         o = {}
         for _def in _defs:
+            if parser.is_internal(_def):
+                continue
             name, args, output_type, const, sig, method_id = parser.get_func_details(_def)
             varz = {}
-            kode = parser.parse_func(_def, _globals, varz)
-            gascost = compile_lll.gas_estimate(kode) + initial_gas
-            o[name] = gascost + memsize_to_gas(varz.get("_next_mem", parser.RESERVED_MEMORY)) + 68 * (4 + 32 * len(args))
+            kode = optimizer.optimize(parser.parse_func(_def, _globals, varz, internals))
+            gascost = compile_lll.gas_estimate(kode, 0, internal_gas) + get_initial_gas()
+            o[name] = gascost + memsize_to_gas(varz.get("_next_mem", parser.RESERVED_MEMORY)) + 68 * (4 + 32 * parser.get_args_size(args))
         return o
@@ -0,0 +1,291 @@
+# Contracts run by the gas regression runner (gas_regression.py). Each entry
+# gives a name, the source of a contract, its constructor arguments (as a
+# function of the tester module, so that they can refer to its accounts) and
+# a function that drives the deployed contract through a representative set
+# of calls, as run(t, s, c) with the tester module, its state and the
+# contract. The calls check their results, so that a miscompiled contract
+# fails the run instead of producing a good-looking gas number.
+#
+# Keep the entries stable: changing a contract or its calls changes its
+# baseline, which then has to be regenerated with gas_regression.py --update
+
+escrow = """
+buyer = address
+seller = address
+arbitrator = address
+
+def setup(_seller: address, _arbitrator: address):
+    if not self.buyer:
+        self.buyer = msg.sender
+        self.seller = _seller
+        self.arbitrator = _arbitrator
+
+def finalize():
+    assert msg.sender == self.buyer or msg.sender == self.arbitrator
+    send(self.seller, self.balance)
+
+def refund():
+    assert msg.sender == self.seller or msg.sender == self.arbitrator
+    send(self.buyer, self.balance)
+"""
+
+def run_escrow(t, s, c):
+    c.setup(t.a1, t.a2, sender=t.k0)
+    try:
+        c.finalize(sender=t.k1)
+        success = True
+    except t.TransactionFailed:
+        success = False
+    assert not success
+    c.finalize(sender=t.k0)
+    c.refund(sender=t.k2)
+
+escrow_with_init = """
+buyer = address
+seller = address
+arbitrator = address
+
+def __init__(_seller: address, _arbitrator: address):
+    if not self.buyer:
+        self.buyer = msg.sender
+        self.seller = _seller
+        self.arbitrator = _arbitrator
+
+def finalize():
+    assert msg.sender == self.buyer or msg.sender == self.arbitrator
+    send(self.seller, self.balance)
+
+def refund():
+    assert msg.sender == self.seller or msg.sender == self.arbitrator
+    send(self.buyer, self.balance)
+"""
+
+def run_escrow_with_init(t, s, c):
+    c.finalize(sender=t.k0)
+    c.refund(sender=t.k1)
+
+crowdfund = """
+funders = {num: [sender(address), value(num)]}
+nextFunderIndex = num
+beneficiary = address
+deadline = num
+goal = num
+refundIndex = num
+timelimit = num
+
+def __init__(_beneficiary: address, _goal: num, _timelimit: num):
+    self.beneficiary = _beneficiary
+    self.deadline = block.timestamp + _timelimit
+    self.timelimit = _timelimit
+    self.goal = _goal
+
+def participate():
+    assert block.timestamp < self.deadline
+    nfi = self.nextFunderIndex
+    self.funders[nfi].sender = msg.sender
+    self.funders[nfi].value = msg.value
+    self.nextFunderIndex = nfi + 1
+
+def expired() -> bool(const):
+    return block.timestamp >= self.deadline
+
+def reached() -> bool(const):
+    return self.balance >= self.goal
+
+def finalize():
+    assert block.timestamp >= self.deadline and self.balance >= self.goal
+    selfdestruct(self.beneficiary)
+
+def refund():
+    ind = self.refundIndex
+    for i in range(30):
+        if ind + i >= self.nextFunderIndex:
+            self.refundIndex = self.nextFunderIndex
+            return
+        send(self.funders[ind + i].sender, self.funders[ind + i].value)
+        self.funders[ind + i].sender = "0x0000000000000000000000000000000000000000"
+        self.funders[ind + i].value = 0
+    self.refundIndex = ind + 30
+"""
+
+def run_crowdfund(t, s, c):
+    c.participate(value=5)
+    assert not c.reached()
+    c.participate(value=49)
+    assert c.reached()
+    s.state.timestamp += 1000
+    assert c.expired()
+    c.finalize()
+
+def run_crowdfund_refund(t, s, c):
+    for k, value in ((t.k3, 1), (t.k4, 2), (t.k5, 3), (t.k6, 4)):
+        c.participate(value=value, sender=k)
+    s.state.timestamp += 1000
+    assert not c.reached()
+    c.refund()
+
+repeaters = """
+def repeat(z: num) -> num:
+    x = 0
+    for i in range(6):
+        x = x + z
+    return(x)
+
+def nested() -> num:
+    out = 0
+    for i in range(6):
+        out = out * 10
+        for j in range(4):
+            out = out + j
+    return(out)
+
+def offset() -> num:
+    out = 0
+    for i in range(80, 121):
+        out = out + i
+    return(out)
+
+def sum(frm: num, to: num) -> num:
+    out = 0
+    for i in range(frm, frm + 101):
+        if i == to:
+            break
+        out = out + i
+    return(out)
+
+def reverse_digits(x: num) -> num:
+    dig = num[6]
+    z = x
+    for i in range(6):
+        dig[i] = z % 10
+        z = z / 10
+    o = 0
+    for i in range(6):
+        o = o * 10 + dig[i]
+    return o
+"""
+
+def run_repeaters(t, s, c):
+    assert c.repeat(9) == 54
+    assert c.nested() == 666666
+    assert c.offset() == 4100
+    assert c.sum(100, 99999) == 15150
+    assert c.sum(70, 131) == 6100
+    assert c.reverse_digits(123456) == 654321
+
+decimals = """
+def add() -> num:
+    return(floor(333.0 + 666.0))
+
+def sub() -> num:
+    return(floor(1332.1 - 333.1))
+
+def mul(x: num) -> num:
+    y = 27.0
+    return(floor(y * x))
+
+def div() -> num:
+    return(floor(999999.0 / 7.0 / 11.0 / 13.0))
+
+def mod() -> num:
+    return(floor(1999.0 % 1000))
+
+def compound() -> num:
+    x = 10000.0
+    for i in range(4):
+        x = x * 1.2
+    return(floor(x))
+
+def mixed(x: num) -> num:
+    d = x * 1.5
+    return floor(d / 3 + 20 / d + d % 4 + 7 % d)
+"""
+
+def run_decimals(t, s, c):
+    assert c.add() == 999
+    assert c.sub() == 999
+    assert c.mul(37) == 999
+    assert c.div() == 999
+    assert c.mod() == 999
+    assert c.compound() == 20736
+    assert c.mixed(4) == 8
+
+storage_structs = """
+var = [a(num), b(num)]
+pairs = {num: [a(num), b(num)]}
+nested = [x(num), inner([y(num), z(num)])]
+total = num
+count = num
+
+def __init__(a: num, b: num):
+    self.var.a = a
+    self.var.b = b
+
+def returnMoose() -> num:
+    return self.var.a * 10 + self.var.b
+
+def setAndGet(k: num) -> num:
+    j = k
+    self.pairs[j].a = 3
+    self.pairs[j].b = 4
+    j = j + 1
+    self.pairs[j].a = 5
+    return self.pairs[j - 1].a * 100 + self.pairs[j - 1].b * 10 + self.pairs[j].a
+
+def setNested() -> num:
+    self.nested.inner.z = 4
+    return self.nested.inner.z
+
+def accumulate(x: num) -> num:
+    for i in range(5):
+        self.total += x
+        self.count = self.count + 1
+    return self.total * 100 + self.count
+"""
+
+def run_storage_structs(t, s, c):
+    assert c.returnMoose() == 57
+    assert c.setAndGet(7) == 345
+    assert c.setNested() == 4
+    assert c.accumulate(3) == 1505
+    assert c.accumulate(3) == 3010
+
+internal_functions = """
+total = num
+
+@internal
+def clamp_to(x: num, hi: num) -> num:
+    if x > hi:
+        return hi
+    return x
+
+@internal
+def add_total(x: num):
+    self.total = self.total + x
+
+def deposit(x: num) -> num:
+    self.add_total(self.clamp_to(x, 100))
+    return self.total
+
+def sum_clamped() -> num:
+    out = 0
+    for i in range(10):
+        out = out + self.clamp_to(i * 100, 500)
+    return out
+"""
+
+def run_internal_functions(t, s, c):
+    assert c.deposit(30) == 30
+    assert c.deposit(300) == 130
+    assert c.sum_clamped() == 3500
+
+corpus = [
+    {'name': 'escrow', 'code': escrow, 'args': lambda t: [], 'run': run_escrow},
+    {'name': 'escrow_with_init', 'code': escrow_with_init, 'args': lambda t: [t.a1, t.a2], 'run': run_escrow_with_init},
+    {'name': 'crowdfund', 'code': crowdfund, 'args': lambda t: [t.a1, 50, 600], 'run': run_crowdfund},
+    {'name': 'crowdfund_refund', 'code': crowdfund, 'args': lambda t: [t.a1, 50, 600], 'run': run_crowdfund_refund},
+    {'name': 'repeaters', 'code': repeaters, 'args': lambda t: [], 'run': run_repeaters},
+    {'name': 'decimals', 'code': decimals, 'args': lambda t: [], 'run': run_decimals},
+    {'name': 'storage_structs', 'code': storage_structs, 'args': lambda t: [5, 7], 'run': run_storage_structs},
+    {'name': 'internal_functions', 'code': internal_functions, 'args': lambda t: [], 'run': run_internal_functions},
+]
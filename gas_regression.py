@@ -0,0 +1,189 @@
+import json, os, sys
+import gas_corpus
+
+# Gas regression runner: compiles and runs the contracts of gas_corpus.py,
+# records the actual gas used by each call, the gas used to deploy each
+# contract and the size of its bytecode, and compares them against a
+# committed baseline. Unlike gas_report.py, which splits up the static
+# estimate, the numbers here are measured by executing the code, so they
+# catch regressions that the estimate does not model.
+#
+# Usage: python gas_regression.py [--update] [--baseline <path>]
+#                                 [--threshold <metric>=<fraction>]...
+#
+# Exits with status 1 if any number grew by more than the threshold of its
+# metric, or if the baseline has a number that the run did not produce.
+# --update writes the results of the run as the new baseline instead.
+
+DEFAULT_BASELINE = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'gas_baseline.json')
+
+metrics = ['runtime gas', 'deploy gas', 'code size']
+
+# Allowed growth of each metric, as a fraction of its baseline value. The
+# compiler and the EVM are deterministic, so by default any growth fails
+DEFAULT_THRESHOLDS = {metric: 0.0 for metric in metrics}
+
+# Gas used by the last transaction of a tester state; receipts hold the
+# cumulative gas used in the block
+def last_tx_gas(s):
+    receipts = s.state.receipts
+    return receipts[-1].gas_used - (receipts[-2].gas_used if len(receipts) > 1 else 0)
+
+# Wraps a tester contract, recording the gas of each call under the name of
+# the function, with '#2', '#3'... for repeated calls. Failed calls are
+# recorded as well, since what they cost matters too
+class GasRecorder():
+    def __init__(self, s, contract, record):
+        self._s, self._contract, self._record = s, contract, record
+
+    def __getattr__(self, name):
+        f = getattr(self._contract, name)
+        def call(*args, **kwargs):
+            txs = len(self._s.state.receipts)
+            try:
+                return f(*args, **kwargs)
+            finally:
+                if len(self._s.state.receipts) > txs:
+                    key, i = name, 1
+                    while key in self._record:
+                        i += 1
+                        key = '%s#%d' % (name, i)
+                    self._record[key] = last_tx_gas(self._s)
+        return call
+
+# Returns {entry name: {'runtime gas': {call: gas}, 'deploy gas': gas,
+# 'code size': bytes}}. Each entry runs in a fresh tester state
+def run_corpus(entries=None):
+    from ethereum import tester as t
+    import compiler_plugin
+    if 'viper' not in t.languages:
+        t.languages['viper'] = compiler_plugin.Compiler()
+    o = {}
+    for entry in (gas_corpus.corpus if entries is None else entries):
+        s = t.state()
+        calls = {}
+        c = s.abi_contract(entry['code'], language='viper', constructor_parameters=entry['args'](t))
+        deploy_gas = last_tx_gas(s)
+        entry['run'](t, s, GasRecorder(s, c, calls))
+        o[entry['name']] = {
+            'runtime gas': calls,
+            'deploy gas': deploy_gas,
+            'code size': len(t.languages['viper'].compile(entry['code'])),
+        }
+    return o
+
+# Flattens results into {(entry name, metric, call or None): value}
+def flatten(results):
+    o = {}
+    for name, result in results.items():
+        for call, gas in result.get('runtime gas', {}).items():
+            o[(name, 'runtime gas', call)] = gas
+        for metric in ('deploy gas', 'code size'):
+            if metric in result:
+                o[(name, metric, None)] = result[metric]
+    return o
+
+# Compares results against a baseline. Returns a list of rows (entry name,
+# metric, call, old value, new value, status), where status is one of
+# 'regression', 'improvement', 'unchanged', 'new' (no baseline value) and
+# 'missing' (no value in the results); old or new is None when absent
+def compare(baseline, results, thresholds=None):
+    thresholds = dict(DEFAULT_THRESHOLDS, **(thresholds or {}))
+    old, new = flatten(baseline), flatten(results)
+    rows = []
+    for key in list(old) + [key for key in new if key not in old]:
+        before, after = old.get(key), new.get(key)
+        if before is None:
+            status = 'new'
+        elif after is None:
+            status = 'missing'
+        elif after > before * (1 + thresholds[key[1]]):
+            status = 'regression'
+        elif after < before:
+            status = 'improvement'
+        else:
+            status = 'unchanged'
+        rows.append(key + (before, after, status))
+    return rows
+
+def failures(rows):
+    return [row for row in rows if row[5] in ('regression', 'missing')]
+
+# Formats the rows of compare() that are not unchanged as a text table
+def format_rows(rows):
+    table = [['contract', 'metric', 'old', 'new', 'change', 'status']]
+    for name, metric, call, before, after, status in rows:
+        if status == 'unchanged':
+            continue
+        if before is not None and after is not None:
+            change = '%+d' % (after - before) + (' (%+.2f%%)' % (100.0 * (after - before) / before) if before else '')
+        else:
+            change = ''
+        table.append([name, metric + (': ' + call if call else ''),
+                      '-' if before is None else str(before),
+                      '-' if after is None else str(after), change, status.upper() if status in ('regression', 'missing') else status])
+    if len(table) == 1:
+        return 'No changes'
+    widths = [max(len(row[i]) for row in table) for i in range(len(table[0]))]
+    lines = []
+    for j, row in enumerate(table):
+        lines.append('  '.join(cell.rjust(widths[i]) if i in (2, 3, 4) else cell.ljust(widths[i]) for i, cell in enumerate(row)).rstrip())
+        if j == 0:
+            lines.append('  '.join('-' * width for width in widths))
+    return '\n'.join(lines)
+
+def load_baseline(path):
+    with open(path) as f:
+        baseline = json.load(f)
+    for metric in baseline.get('thresholds', {}):
+        if metric not in metrics:
+            raise Exception("Unknown metric in thresholds: %s" % metric)
+    return baseline
+
+def save_baseline(path, results, thresholds):
+    with open(path, 'w') as f:
+        json.dump({'thresholds': thresholds, 'results': results}, f, indent=4, sort_keys=True)
+        f.write('\n')
+
+def parse_threshold(arg):
+    if '=' not in arg:
+        raise Exception("Expected <metric>=<fraction>, got %s" % arg)
+    metric, fraction = arg.rsplit('=', 1)
+    if metric not in metrics:
+        raise Exception("Unknown metric: %s (expected one of %s)" % (metric, ', '.join(metrics)))
+    return metric, float(fraction)
+
+if __name__ == '__main__':
+    argv = sys.argv[1:]
+    path, update, overrides = DEFAULT_BASELINE, False, {}
+    while argv:
+        arg = argv.pop(0)
+        if arg == '--update':
+            update = True
+        elif arg == '--baseline' and argv:
+            path = argv.pop(0)
+        elif arg == '--threshold' and argv:
+            metric, fraction = parse_threshold(argv.pop(0))
+            overrides[metric] = fraction
+        else:
+            print("Usage: python gas_regression.py [--update] [--baseline <path>] [--threshold <metric>=<fraction>]...")
+            sys.exit(1)
+    baseline = load_baseline(path) if os.path.exists(path) else {}
+    thresholds = dict(DEFAULT_THRESHOLDS, **baseline.get('thresholds', {}))
+    thresholds.update(overrides)
+    results = run_corpus()
+    if update:
+        save_baseline(path, results, thresholds)
+        print("Wrote baseline for %d contracts to %s" % (len(results), path))
+        sys.exit(0)
+    if not baseline:
+        print("No baseline at %s; run with --update to create it" % path)
+        sys.exit(1)
+    rows = compare(baseline['results'], results, thresholds)
+    print(format_rows(rows))
+    failed = failures(rows)
+    if failed:
+        print("FAILED: %d of %d numbers regressed or are missing (thresholds: %s); if this is expected, run with --update" %
+              (len(failed), len(rows), ', '.join('%s %g%%' % (m, 100 * thresholds[m]) for m in metrics)))
+        sys.exit(1)
+    print("Passed: %d numbers within thresholds" % len(rows))
@@ -0,0 +1,183 @@
+import json, sys
+import parser, compile_lll, optimizer
+from compiler_plugin import memsize_to_gas, get_initial_gas
+from opcodes import opcodes, pseudo_opcodes
+
+# Gas report: splits the estimate of each function (the same estimate as
+# Compiler.gas_estimate) into cost categories, so that it is possible to see
+# where the gas of a contract goes and how a change moves it around.
+
+categories = ['dispatch', 'argument decoding', 'clamps', 'storage reads',
+              'storage writes', 'hashing', 'memory', 'control flow', 'calls', 'other']
+
+# Category of the cost of each opcode; opcodes not listed count as 'other'
+op_categories = {
+    'calldatacopy': 'argument decoding',
+    'calldataload': 'argument decoding',
+    'codecopy': 'argument decoding',
+    'clamp': 'clamps',
+    'uclamplt': 'clamps',
+    'clamp_nonzero': 'clamps',
+    'assert': 'clamps',
+    'sload': 'storage reads',
+    'sstore': 'storage writes',
+    'sha3': 'hashing',
+    'sha3_32': 'hashing',
+    'mload': 'memory',
+    'mstore': 'memory',
+    'mstore8': 'memory',
+    'call': 'calls',
+    'callcode': 'calls',
+    'delegatecall': 'calls',
+    'if': 'control flow',
+    'repeat': 'control flow',
+    'break': 'control flow',
+    'return': 'control flow',
+    'revert': 'control flow',
+    'stop': 'control flow',
+}
+
+def add_costs(o, costs, times=1):
+    for category, gas in costs.items():
+        o[category] = o.get(category, 0) + gas * times
+    return o
+
+# Splits compile_lll.gas_estimate(code) into categories. Constants, variables,
+# pops and loads of the reserved constants (eg. the bounds used by clamps)
+# are counted as part of the operation that uses them. internals gives the
+# breakdown of one call to each internal function by label, which is added
+# at each call (see internal_breakdowns)
+def gas_breakdown(code, depth=0, inherited='other', internals=None):
+    internals = internals or {}
+    if isinstance(code.value, int):
+        return {inherited: 3}
+    op = code.value.lower()
+    if op == 'mload' and isinstance(code.args[0].value, int) and code.args[0].value < parser.RESERVED_MEMORY:
+        category = inherited
+    elif op == 'pop':
+        category = inherited
+    else:
+        category = op_categories.get(op, 'other')
+    if code.value.upper() in opcodes or code.value.upper() in pseudo_opcodes:
+        decl = opcodes.get(code.value.upper(), pseudo_opcodes.get(code.value.upper(), None))
+        o = {category: decl[3]}
+        for i, c in enumerate(code.args[::-1]):
+            add_costs(o, gas_breakdown(c, depth + i, category, internals))
+        if code.value.upper() == 'CALL' and code.args[2].value != 0:
+            add_costs(o, {category: 34000})
+        if code.value.upper() == 'SSTORE' and code.args[1].value != 0:
+            add_costs(o, {category: 15000})
+        if code.value.upper() in ('SUICIDE', 'SELFDESTRUCT'):
+            add_costs(o, {category: 25000})
+        if code.value.upper() == 'BREAK':
+            add_costs(o, {category: opcodes['POP'][3] * depth})
+        return o
+    elif op == 'if':
+        o = add_costs({category: 30}, gas_breakdown(code.args[0], depth + 1, 'other', internals))
+        branches = [gas_breakdown(c, depth + 1, 'other', internals) for c in code.args[1:]]
+        return add_costs(o, max(branches, key=lambda b: sum(b.values())))
+    elif op == 'with':
+        o = add_costs({'other': 20}, gas_breakdown(code.args[1], depth + 1, 'other', internals))
+        return add_costs(o, gas_breakdown(code.args[2], depth + 1, 'other', internals))
+    elif op == 'repeat':
+        o = add_costs({category: 30}, add_costs({category: 50}, gas_breakdown(code.args[3], depth + 1, 'other', internals)), code.args[2].value)
+        return o
+    elif op == 'seq':
+        o = {}
+        for c in code.args:
+            add_costs(o, gas_breakdown(c, depth + 1, 'other', internals))
+        return o
+    elif op == 'internal_call':
+        o = {'control flow': compile_lll.INTERNAL_CALL_GAS}
+        for i, c in enumerate(code.args[2:]):
+            add_costs(o, gas_breakdown(c, depth + i, 'other', internals))
+        return add_costs(o, internals.get(code.args[0].value, {}))
+    elif op == 'internal_def':
+        return {}
+    elif op == 'internal_return':
+        o = {'control flow': 3 * (depth + len(code.args))}
+        for c in code.args:
+            add_costs(o, gas_breakdown(c, depth, 'other', internals))
+        return o
+    else:
+        return {inherited: 3}
+
+# Breakdown of one call to each internal function of a contract, by label,
+# in the same way as compile_lll.get_internal_gas
+def internal_breakdowns(internals, _globals):
+    defs = [optimizer.optimize(d) for d in parser.make_internal_defs(internals, _globals, internals, parser.RESERVED_MEMORY).values()]
+    o = {}
+    for _ in defs:
+        for d in defs:
+            o[d.args[0].value] = add_costs(gas_breakdown(d.args[-1], 1, 'other', o), {'memory': 9 * (len(d.args) - 2)})
+    return o
+
+# Returns {function name: {category: gas, ..., 'total': gas}}
+def gas_report(code):
+    code = parser.parse(code)
+    _defs, _globals = parser.get_defs_and_globals(code)
+    internals = parser.get_internal_funcs(_defs, _globals)
+    breakdowns = internal_breakdowns(internals, _globals)
+    o = {}
+    for _def in _defs:
+        if parser.is_internal(_def):
+            continue
+        name, args, output_type, const, sig, method_id = parser.get_func_details(_def)
+        varz = {}
+        kode = optimizer.optimize(parser.parse_func(_def, _globals, varz, internals))
+        costs = {category: 0 for category in categories}
+        costs['dispatch'] += get_initial_gas() + 68 * 4
+        costs['argument decoding'] += 68 * 32 * parser.get_args_size(args)
+        costs['memory'] += memsize_to_gas(varz.get("_next_mem", parser.RESERVED_MEMORY))
+        # The method id test wrapping the body of every function but __init__
+        if kode.value == 'if' and kode.args[0].value == 'eq' and kode.args[0].args[0].to_list() == ['mload', 0]:
+            add_costs(costs, gas_breakdown(kode.args[0], 1, 'dispatch', breakdowns))
+            add_costs(costs, {'dispatch': 30})
+            add_costs(costs, gas_breakdown(kode.args[1], 1, 'other', breakdowns))
+        else:
+            add_costs(costs, gas_breakdown(kode, 0, 'other', breakdowns))
+        costs['total'] = sum(costs.values())
+        o[name] = costs
+    return o
+
+# Returns {function name: {category: new gas - old gas}} for the functions in
+# either report; functions missing from one of them count as zero there
+def diff_reports(old, new):
+    o = {}
+    for name in list(old) + [name for name in new if name not in old]:
+        before, after = old.get(name, {}), new.get(name, {})
+        o[name] = {category: after.get(category, 0) - before.get(category, 0)
+                   for category in categories + ['total']}
+    return o
+
+# Formats a report (or a diff) as a text table with one row per function
+def format_table(report, signed=False):
+    columns = categories + ['total']
+    fmt = '%+d' if signed else '%d'
+    rows = [['function'] + columns]
+    for name, costs in report.items():
+        rows.append([name] + [fmt % costs.get(category, 0) for category in columns])
+    widths = [max(len(row[i]) for row in rows) for i in range(len(rows[0]))]
+    lines = []
+    for j, row in enumerate(rows):
+        lines.append('  '.join(cell.ljust(widths[i]) if i == 0 else cell.rjust(widths[i]) for i, cell in enumerate(row)))
+        if j == 0:
+            lines.append('  '.join('-' * width for width in widths))
+    return '\n'.join(lines)
+
+if __name__ == '__main__':
+    argv = sys.argv[1:]
+    as_json = '--json' in argv
+    files = [arg for arg in argv if arg != '--json']
+    if len(files) not in (1, 2):
+        print("Usage: python gas_report.py [--json] <contract> [<new version of contract>]")
+        sys.exit(1)
+    reports = [gas_report(open(path).read()) for path in files]
+    if len(reports) == 2:
+        result, signed = diff_reports(reports[0], reports[1]), True
+    else:
+        result, signed = reports[0], False
+    if as_json:
+        print(json.dumps(result, indent=4))
+    else:
+        print(format_table(result, signed))
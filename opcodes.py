@@ -22,6 +22,9 @@ opcodes = {
     'XOR': [0x18, 2, 1, 3],
     'NOT': [0x19, 1, 1, 3],
     'BYTE': [0x1a, 2, 1, 3],
+    'SHL': [0x1b, 2, 1, 3],
+    'SHR': [0x1c, 2, 1, 3],
+    'SAR': [0x1d, 2, 1, 3],
     'SHA3': [0x20, 2, 1, 30],
     'ADDRESS': [0x30, 0, 1, 2],
     'BALANCE': [0x31, 1, 1, 400],
@@ -65,6 +68,7 @@ opcodes = {
     'RETURN': [0xf3, 2, 0, 0],
     'DELEGATECALL': [0xf4, 6, 1, 700],
     'CALLBLACKBOX': [0xf5, 7, 1, 700],
+    'REVERT': [0xfd, 2, 0, 0],
     'INVALID': [0xfe, 0, 0, 0],
     'SUICIDE': [0xff, 1, 0, 5000],
     'SELFDESTRUCT': [0xff, 1, 0, 5000],
@@ -78,6 +82,33 @@ pseudo_opcodes = {
     'PASS': [None, 0, 0, 0],
     'BREAK': [None, 0, 0, 20],
     'SHA3_32': [None, 1, 1, 40],
+    'DMUL': [None, 2, 1, 60],
+    'DDIV': [None, 2, 1, 60],
+    'DMOD': [None, 2, 1, 25],
     'SLE': [0x12, 2, 1, 10],
     'SGE': [0x13, 2, 1, 10],
 }
+
+# EVM versions that code can be compiled for, oldest first, with the opcodes
+# each one adds. The optimizer only emits opcodes of the target version and
+# of the versions before it
+targets = [
+    ('byzantium', []),
+    ('constantinople', ['SHL', 'SHR', 'SAR']),
+]
+
+DEFAULT_TARGET = 'byzantium'
+
+# Returns the position of a target in the list above
+def check_target(target):
+    names = [name for name, added in targets]
+    if target not in names:
+        raise Exception("Unknown EVM target: %r (expected one of %s)" % (target, ', '.join(names)))
+    return names.index(target)
+
+def is_available(opcode, target):
+    index = check_target(target)
+    for i, (name, added) in enumerate(targets):
+        if opcode.upper() in added:
+            return i <= index
+    return True
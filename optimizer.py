@@ -0,0 +1,970 @@
+import time
+from parser import LLLnode, sha3_256
+from opcodes import opcodes, pseudo_opcodes, check_target, is_available, DEFAULT_TARGET
+import compile_lll
+
+# Opcodes whose result only depends on their arguments and on values that
+# stay constant for the duration of a call
+pure_ops = ['add', 'sub', 'mul', 'div', 'sdiv', 'mod', 'smod', 'exp',
+            'addmod', 'mulmod', 'signextend', 'lt', 'gt', 'slt', 'sgt',
+            'sle', 'sge', 'eq', 'iszero', 'and', 'or', 'xor', 'not', 'byte',
+            'sha3_32', 'clamp', 'uclamplt', 'clamp_nonzero', 'address',
+            'origin', 'caller', 'callvalue', 'calldataload', 'calldatasize',
+            'codesize', 'gasprice', 'coinbase', 'timestamp', 'number',
+            'difficulty', 'gaslimit']
+
+# Pseudo-opcodes that abort execution when their check fails
+failing_ops = ['clamp', 'uclamplt', 'clamp_nonzero', 'assert']
+
+# Statements after which the rest of a sequence may not be executed
+exit_ops = ['return', 'revert', 'break', 'stop', 'suicide', 'selfdestruct', 'internal_return']
+
+# Maximum number of storage keys kept on the stack at once, so that the
+# extra with-variables never push other values out of DUP16 range
+MAX_CACHED_KEYS = 4
+
+next_var = [0]
+
+def mkvar(prefix):
+    next_var[0] += 1
+    return '_%s_%d' % (prefix, next_var[0])
+
+def is_cached_key(value):
+    return isinstance(value, str) and value.startswith('_key_')
+
+def key_of(node):
+    return repr(node.to_list())
+
+# Code inside an lll node runs in its own context, so it is never
+# considered part of the enclosing expression
+def scoped_args(node):
+    return node.args[1:] if node.value == 'lll' else node.args
+
+def walk(node):
+    yield node
+    for arg in scoped_args(node):
+        for sub in walk(arg):
+            yield sub
+
+# Returns the set of constant memory addresses an expression reads, or None
+# if the expression is not a pure function of memory and call constants
+def get_pure_deps(node):
+    if isinstance(node.value, int) or is_cached_key(node.value):
+        return set()
+    if node.value == 'mload':
+        if isinstance(node.args[0].value, int):
+            return {node.args[0].value}
+        return None
+    if not isinstance(node.value, str) or node.value not in pure_ops:
+        return None
+    deps = set()
+    for arg in node.args:
+        sub = get_pure_deps(arg)
+        if sub is None:
+            return None
+        deps |= sub
+    return deps
+
+def can_fail(node):
+    return any(sub.value in failing_ops for sub in walk(node))
+
+def may_exit(node):
+    return any(sub.value in exit_ops for sub in walk(node))
+
+# Returns the set of constant memory addresses a statement may write to, or
+# None if it writes to an address that is not known at compile time
+def get_memory_writes(node):
+    writes = set()
+    for sub in walk(node):
+        if sub.value in ('mstore', 'repeat'):
+            if not isinstance(sub.args[0].value, int):
+                return None
+            writes.add(sub.args[0].value)
+        elif sub.value in ('mstore8', 'internal_call', 'internal_def'):
+            return None
+        elif sub.value in ('calldatacopy', 'codecopy'):
+            if not (isinstance(sub.args[2].value, int) and sub.args[2].value == 0):
+                return None
+        elif sub.value in ('call', 'callcode', 'delegatecall', 'callblackbox'):
+            size = sub.args[-1]
+            if not (isinstance(size.value, int) and size.value == 0):
+                return None
+        elif sub.value == 'sha3_32':
+            writes.add(192)
+    return writes
+
+# Yields the subexpressions of a statement that are evaluated every time
+# the statement itself is executed
+def unconditional_subtrees(node):
+    yield node
+    if node.value == 'if':
+        children = node.args[:1]
+    elif node.value == 'repeat':
+        children = node.args[:2]
+    elif node.value == 'seq':
+        children = []
+        for arg in node.args:
+            if may_exit(arg):
+                break
+            children.append(arg)
+    else:
+        children = node.args
+    for arg in children:
+        for sub in unconditional_subtrees(arg):
+            yield sub
+
+def count_occurrences(node, key):
+    return sum(1 for sub in walk(node) if sub.value == 'sha3_32' and key_of(sub) == key)
+
+def substitute(node, key, var):
+    if key_of(node) == key:
+        return LLLnode(var, [], node.typ, node.annotation)
+    if node.value == 'lll':
+        return LLLnode(node.value, [node.args[0], substitute(node.args[1], key, var)], node.typ, node.annotation)
+    return LLLnode(node.value, [substitute(arg, key, var) for arg in node.args], node.typ, node.annotation)
+
+# Finds a sha3_32 storage key that is computed at least twice within a run
+# of statements starting at stmts[i], during which none of its inputs change.
+# Returns the key, its node, and the index one past the last statement using it
+def find_cached_key(stmts, i):
+    candidates = [sub for sub in unconditional_subtrees(stmts[i]) if sub.value == 'sha3_32']
+    # Cheap-to-check keys that cannot throw may also be hoisted out of
+    # conditional branches, since evaluating them early has no side effects
+    candidates += [sub for sub in walk(stmts[i]) if sub.value == 'sha3_32' and not can_fail(sub)]
+    candidates.sort(key=lambda sub: -len(key_of(sub)))
+    for candidate in candidates:
+        deps = get_pure_deps(candidate)
+        if deps is None:
+            continue
+        key = key_of(candidate)
+        uses, end = 0, i
+        for j in range(i, len(stmts)):
+            writes = get_memory_writes(stmts[j])
+            if writes is None or writes & deps:
+                break
+            count = count_occurrences(stmts[j], key)
+            if count:
+                uses += count
+                end = j + 1
+        if uses >= 2:
+            return key, candidate, end
+    return None
+
+# Computes each storage key (sha3_32) only once per run of statements in
+# which its inputs are unchanged, keeping the result on the stack
+def cache_storage_keys(node, depth=0):
+    if node.value == 'lll':
+        return LLLnode(node.value, [cache_storage_keys(node.args[0]), cache_storage_keys(node.args[1], depth)], node.typ, node.annotation)
+    # Internal functions start with an empty stack
+    elif node.value == 'internal_def':
+        return LLLnode(node.value, node.args[:-1] + [cache_storage_keys(node.args[-1])], node.typ, node.annotation)
+    elif node.value != 'seq':
+        return LLLnode(node.value, [cache_storage_keys(arg, depth) for arg in node.args], node.typ, node.annotation)
+    stmts, o, i = node.args, [], 0
+    while i < len(stmts):
+        found = find_cached_key(stmts, i) if depth < MAX_CACHED_KEYS and stmts[i].value != 'internal_def' else None
+        if found:
+            key, candidate, end = found
+            var = mkvar('key')
+            body = LLLnode.from_list(['seq'] + [substitute(s, key, var) for s in stmts[i:end]])
+            o.append(LLLnode.from_list(['with', var, candidate, cache_storage_keys(body, depth + 1)]))
+            i = end
+        else:
+            o.append(cache_storage_keys(stmts[i], depth))
+            i += 1
+    return LLLnode(node.value, o, node.typ, node.annotation)
+
+# Removes instruction sequences that have no effect, or replaces them with
+# shorter equivalents
+def peephole(assembly):
+    o = []
+    for item in assembly:
+        if isinstance(item, list):
+            o.append(peephole(item))
+            continue
+        o.append(item)
+        # x DUPn POP, x SWAP1 SWAP1 => x
+        if len(o) >= 2 and o[-1] == 'POP' and isinstance(o[-2], str) and o[-2][:3] == 'DUP':
+            o = o[:-2]
+        elif len(o) >= 2 and o[-1] == 'SWAP1' and o[-2] == 'SWAP1':
+            o = o[:-2]
+        # ISZERO ISZERO <dest> JUMPI => <dest> JUMPI
+        elif len(o) >= 4 and o[-1] == 'JUMPI' and o[-3] == 'ISZERO' and o[-4] == 'ISZERO' and \
+                compile_lll.is_symbol(o[-2]):
+            o = o[:-4] + o[-2:]
+    return o
+
+# Size optimization: repeated straight-line instruction sequences are moved
+# into subroutines placed after the code, and each occurrence is replaced by
+# a jump there and back. A subroutine is entered with the return address on
+# top of the k stack items the sequence uses; it moves the address below
+# them, runs the sequence and brings the address back above its m results
+#
+#   caller:     <ret> <sub> JUMP <ret> JUMPDEST
+#   subroutine: <sub> JUMPDEST SWAPk .. SWAP1 <sequence> SWAP1 .. SWAPm JUMP
+
+# Shortest and longest sequences considered, in instructions
+MIN_OUTLINE_LENGTH = 3
+MAX_OUTLINE_LENGTH = 64
+
+# Gas paid at deployment for each byte of runtime code: the code deposit
+# plus the transaction data for the init code that carries it
+DEPLOY_GAS_PER_BYTE = 200 + 68
+
+# Number of times each outlined occurrence is assumed to run over the life
+# of the contract, used to weigh the extra jumps against the smaller code
+OUTLINE_EXPECTED_CALLS = 10
+
+# Bytes and gas added at each call site
+OUTLINE_CALL_SIZE = 8
+OUTLINE_CALL_GAS = 2 * 3 + 2 * opcodes['JUMP'][3] + 2 * opcodes['JUMPDEST'][3]
+
+# Splits assembly into instructions, each a tuple of assembly items, and
+# tells whether each of them may be moved into a subroutine. Labels, jumps
+# and nested code may not
+def split_instructions(assembly):
+    instrs, movable, i = [], [], 0
+    while i < len(assembly):
+        item = assembly[i]
+        if isinstance(item, str) and item[:4] == 'PUSH':
+            n = int(item[4:])
+            instrs.append(tuple(assembly[i: i + n + 1]))
+            movable.append(True)
+            i += n + 1
+        # Jumps to the error block go to the same place from anywhere
+        elif item == compile_lll.ERROR_SYMBOL and i + 1 < len(assembly) and assembly[i + 1] in ('JUMP', 'JUMPI'):
+            instrs.append((item, assembly[i + 1]))
+            movable.append(True)
+            i += 2
+        else:
+            instrs.append((item,))
+            movable.append(not (isinstance(item, list) or compile_lll.is_symbol(item) or
+                                item in ('JUMP', 'JUMPI', 'JUMPDEST', 'PC', 'BLANK')))
+            i += 1
+    return instrs, movable
+
+def instruction_size(instr):
+    return sum(3 if compile_lll.is_symbol(item) else 1 for item in instr)
+
+# Returns (k, m): the number of stack items below the starting height that a
+# sequence reads or changes, and the number of items it leaves in their place
+def stack_effect(instrs):
+    height, lowest = 0, 0
+    for instr in instrs:
+        op = instr[0]
+        if op[:4] == 'PUSH':
+            needs, pushes = 0, 1
+        elif op[:3] == 'DUP':
+            needs, pushes = int(op[3:]), int(op[3:]) + 1
+        elif op[:4] == 'SWAP':
+            needs, pushes = int(op[4:]) + 1, int(op[4:]) + 1
+        elif op == compile_lll.ERROR_SYMBOL:
+            needs, pushes = (1, 0) if instr[1] == 'JUMPI' else (0, 0)
+        else:
+            needs, pushes = opcodes[op][1], opcodes[op][2]
+        lowest = min(lowest, height - needs)
+        height += pushes - needs
+    return -lowest, height - lowest
+
+# Bytes saved and gas added by outlining a sequence found at the given
+# non-overlapping positions
+def outline_cost(instrs, count):
+    size = sum(instruction_size(instr) for instr in instrs)
+    k, m = stack_effect(instrs)
+    if k > 16 or m > 16:
+        return None
+    saved = count * (size - OUTLINE_CALL_SIZE) - (size + k + m + 2)
+    extra_gas = count * (OUTLINE_CALL_GAS + 3 * (k + m))
+    return saved, extra_gas
+
+def non_overlapping(starts, length):
+    o, end = [], 0
+    for start in starts:
+        if start >= end:
+            o.append(start)
+            end = start + length
+    return o
+
+# Finds the repeated sequence that is most worth outlining, as
+# (net gas benefit, start positions, length), or None
+def find_outline_candidate(instrs, movable):
+    seen = {}
+    for i in range(len(instrs)):
+        key = ()
+        for length in range(1, MAX_OUTLINE_LENGTH + 1):
+            if i + length > len(instrs) or not movable[i + length - 1]:
+                break
+            key = hash((key, instrs[i + length - 1]))
+            if length >= MIN_OUTLINE_LENGTH:
+                seen.setdefault((key, length), []).append(i)
+    best = None
+    for (key, length), starts in seen.items():
+        if len(starts) < 2:
+            continue
+        # Group by actual contents, in case of hash collisions
+        groups = {}
+        for start in starts:
+            groups.setdefault(tuple(instrs[start: start + length]), []).append(start)
+        for seq, group in groups.items():
+            group = non_overlapping(group, length)
+            if len(group) < 2:
+                continue
+            cost = outline_cost(seq, len(group))
+            if cost is None or cost[0] <= 0:
+                continue
+            benefit = cost[0] * DEPLOY_GAS_PER_BYTE - cost[1] * OUTLINE_EXPECTED_CALLS
+            if benefit > 0 and (best is None or benefit > best[0]):
+                best = (benefit, group, length)
+    return best
+
+# Outlines repeated sequences in a piece of assembly and in any code nested
+# inside it, as long as doing so is worth it under the cost model above
+def outline_subroutines(assembly):
+    assembly = [outline_subroutines(item) if isinstance(item, list) else item for item in assembly]
+    instrs, movable = split_instructions(assembly)
+    subroutines = []
+    while True:
+        found = find_outline_candidate(instrs, movable)
+        if found is None:
+            break
+        _, starts, length = found
+        seq = instrs[starts[0]: starts[0] + length]
+        k, m = stack_effect(seq)
+        sub = compile_lll.mksymbol()
+        body = [sub, 'JUMPDEST'] + ['SWAP%d' % n for n in range(k, 0, -1)]
+        for instr in seq:
+            body.extend(instr)
+        body.extend(['SWAP%d' % n for n in range(1, m + 1)] + ['JUMP'])
+        subroutines.append(body)
+        for start in starts[::-1]:
+            ret = compile_lll.mksymbol()
+            instrs[start: start + length] = [(ret, sub, 'JUMP', ret, 'JUMPDEST')]
+            movable[start: start + length] = [False]
+    if not subroutines:
+        return assembly
+    o = []
+    for instr in instrs:
+        o.extend(instr)
+    # Subroutines are only reached by jumping, so execution must not fall into them
+    o.append('STOP')
+    for body in subroutines:
+        o.extend(body)
+    return o
+
+# Inlining: each call to an internal function is either kept as a jump to
+# the function's subroutine or replaced by a copy of the function's body,
+# which saves the jumps but adds the body to the code. The choice uses the
+# cost model of outlining above, with calls inside loops weighed by the
+# number of rounds. The last remaining call to a function is inlined
+# whenever possible, since its subroutine can then be removed
+
+# Bytes needed to store each argument into memory when a call is inlined
+INLINE_ARG_SIZE = 4
+
+def get_calls(node):
+    return [sub.args[0].value for sub in walk(node) if sub.value == 'internal_call']
+
+# Is there a break that is not inside a loop of its own?
+def has_free_break(node):
+    if node.value == 'break':
+        return True
+    args = node.args[:3] if node.value == 'repeat' else scoped_args(node)
+    return any(has_free_break(arg) for arg in args)
+
+# Returns the body of an internal function as code that can take the place
+# of a call to it, or None if it returns from anywhere but its last
+# statement or breaks out of a loop it does not contain
+def get_inline_body(definition):
+    body = definition.args[-1]
+    if body.value != 'seq' or not body.args or body.args[-1].value != 'internal_return':
+        return None
+    stmts = body.args[:-1]
+    if any(sub.value == 'internal_return' for stmt in stmts for sub in walk(stmt)) or \
+            any(has_free_break(stmt) for stmt in stmts):
+        return None
+    return LLLnode.from_list(['seq'] + stmts + body.args[-1].args)
+
+# Replaces a call with a copy of the body, which reads its arguments from
+# the same memory the subroutine would have stored them in
+def make_inlined_call(call, definition, body):
+    positions, args = definition.args[1:-1], call.args[2:]
+    # If computing an argument may overwrite the ones before it (by calling
+    # the function again), all of them are computed before any is stored
+    if any(get_memory_writes(arg) is None or get_memory_writes(arg) & set(pos.value for pos in positions)
+           for arg in args[1:]):
+        names = [mkvar('arg') for arg in args]
+        o = ['seq'] + [['mstore', pos, name] for pos, name in zip(positions, names)] + [body]
+        for name, arg in reversed(list(zip(names, args))):
+            o = ['with', name, arg, o]
+    else:
+        o = ['seq'] + [['mstore', pos, arg] for pos, arg in zip(positions, args)] + [body]
+    return LLLnode.from_list(o, typ=call.typ)
+
+# Should a call be inlined, given the size of the inlined body, the number
+# of calls to the function left in the code, and the number of times the
+# call runs for each time the code around it does?
+def should_inline(call, size, sites, weight):
+    if sites == 1:
+        return True
+    nargs = len(call.args) - 2
+    extra_size = size + INLINE_ARG_SIZE * nargs - OUTLINE_CALL_SIZE
+    call_gas = compile_lll.INTERNAL_CALL_GAS + 3 * (nargs + call.valency)
+    return extra_size * DEPLOY_GAS_PER_BYTE <= call_gas * OUTLINE_EXPECTED_CALLS * weight
+
+# Inlines the calls in a piece of code that are worth it. defs holds the
+# subroutines by label, bodies the inlinable ones as (subroutine, body, size)
+# and sites the number of calls left to each function
+def inline_calls(node, defs, bodies, sites, weight=1):
+    if node.value == 'lll':
+        return LLLnode(node.value, [inline_internal_calls(node.args[0]), inline_calls(node.args[1], defs, bodies, sites, weight)],
+                       node.typ, node.annotation)
+    elif node.value == 'internal_def':
+        return defs[node.args[0].value]
+    elif node.value == 'repeat':
+        args = [inline_calls(arg, defs, bodies, sites, weight) for arg in node.args[:3]] + \
+               [inline_calls(node.args[3], defs, bodies, sites, weight * node.args[2].value)]
+    else:
+        args = [inline_calls(arg, defs, bodies, sites, weight) for arg in node.args]
+    node = LLLnode(node.value, args, node.typ, node.annotation)
+    if node.value == 'internal_call' and node.args[0].value in bodies:
+        label = node.args[0].value
+        definition, body, size = bodies[label]
+        if should_inline(node, size, sites[label], weight):
+            sites[label] -= 1
+            for callee in get_calls(body):
+                sites[callee] = sites.get(callee, 0) + 1
+            return make_inlined_call(node, definition, body)
+    return node
+
+# Orders subroutines so that each comes after the ones it calls
+def order_callees_first(defs):
+    calls = dict((label, set(get_calls(d.args[-1])) & set(defs)) for label, d in defs.items())
+    order = []
+    while len(order) < len(defs):
+        ready = sorted(label for label in defs if label not in order and calls[label] <= set(order))
+        if not ready:
+            raise Exception("Recursive internal functions are not supported")
+        order.extend(ready)
+    return order
+
+# Drops the subroutines of a piece of code that are no longer called, and
+# the stop placed before them if none is left
+def remove_dead_subroutines(node, defs):
+    if node.value != 'seq':
+        return node
+    pending = [label for arg in node.args if arg.value != 'internal_def' for label in get_calls(arg)]
+    live = set()
+    while pending:
+        label = pending.pop()
+        if label in defs and label not in live:
+            live.add(label)
+            pending.extend(get_calls(defs[label].args[-1]))
+    args = [arg for arg in node.args if arg.value != 'internal_def' or arg.args[0].value in live]
+    if args and args[-1].value == 'stop':
+        args = args[:-1]
+    return LLLnode(node.value, args, node.typ, node.annotation)
+
+# Inlines calls to internal functions in a piece of code, and in any code
+# nested inside it. Functions are handled before their callers, so that the
+# body copied at a call is already final
+def inline_internal_calls(node):
+    defs = dict((sub.args[0].value, sub) for sub in walk(node) if sub.value == 'internal_def')
+    sites = {}
+    for label in get_calls(node):
+        sites[label] = sites.get(label, 0) + 1
+    bodies = {}
+    for label in order_callees_first(defs):
+        d = defs[label]
+        defs[label] = LLLnode(d.value, d.args[:-1] + [inline_calls(d.args[-1], defs, bodies, sites)], d.typ, d.annotation)
+        body = get_inline_body(defs[label])
+        if body is not None:
+            bodies[label] = (defs[label], body, instruction_size(compile_lll.compile_to_assembly(body)))
+    return remove_dead_subroutines(inline_calls(node, defs, bodies, sites), defs)
+
+# Loop unrolling: replaces a repeat with constant rounds by copies of its
+# body, one per round (or by a shorter loop over groups of rounds), each
+# with its value of the loop counter. Reads of the counter in a full copy
+# become constants, which lets the copy be folded, eg. removing the bounds
+# checks of array accesses. The choice between the loop, full unrolling and
+# partial unrolling uses the cost model of inlining and outlining above, or
+# at level 2, the same model with many more calls assumed.
+#
+# Addresses computed at runtime are taken to stay within the arrays they
+# index, as the bounds checks of the parser ensure, so that only writes to
+# the counter's own address can change it during a round
+
+# Numbers of rounds grouped into one round of a partially unrolled loop
+PARTIAL_UNROLL_FACTORS = [8, 4, 2]
+
+# Most rounds a loop can have to be fully unrolled
+MAX_UNROLLED_ROUNDS = 16
+
+# Number of calls assumed by unroll_loops_for_gas (at level 2), which
+# favors runtime gas over code size
+GAS_EXPECTED_CALLS = 1000
+
+# Statements with no arguments that are not variables
+keyword_leaves = ['pass', 'break', 'seq', 'internal_return']
+
+# Opcodes folded when all their arguments are constants, on unsigned values
+folded_ops = {
+    'add': lambda a, b: a + b,
+    'sub': lambda a, b: a - b,
+    'mul': lambda a, b: a * b,
+    'div': lambda a, b: a // b if b else 0,
+    'mod': lambda a, b: a % b if b else 0,
+    'lt': lambda a, b: int(a < b),
+    'gt': lambda a, b: int(a > b),
+    'eq': lambda a, b: int(a == b),
+    'iszero': lambda a: int(a == 0),
+    'and': lambda a, b: a & b,
+    'or': lambda a, b: a | b,
+    'xor': lambda a, b: a ^ b,
+    'shl': lambda a, b: b << a,
+    'shr': lambda a, b: b >> a,
+    'not': lambda a: 2**256 - 1 - a,
+    'sha3_32': lambda a: int.from_bytes(sha3_256(a.to_bytes(32, 'big')), 'big'),
+}
+
+# Folds the operations of an expression whose arguments are all constants,
+# checks that always pass, and ifs with a constant condition
+def fold_constants(node):
+    if node.value == 'lll':
+        return node
+    return fold_operation(LLLnode(node.value, [fold_constants(arg) for arg in node.args], node.typ, node.annotation))
+
+# Folds an operation whose arguments are already folded
+def fold_operation(node):
+    args = node.args
+    values = [arg.value % 2**256 for arg in args if isinstance(arg.value, int)]
+    if node.value in folded_ops and len(values) == len(args):
+        return LLLnode(folded_ops[node.value](*values) % 2**256, [], node.typ, node.annotation)
+    elif node.value == 'uclamplt' and len(values) == 2 and values[0] < values[1]:
+        return LLLnode(values[0], [], node.typ, node.annotation)
+    elif node.value == 'clamp_nonzero' and len(values) == 1 and values[0]:
+        return args[0]
+    elif node.value == 'if' and isinstance(args[0].value, int):
+        if args[0].value:
+            return args[1]
+        return args[2] if len(args) == 3 else LLLnode('pass', [], None, None)
+    return node
+
+# Replaces reads of the given constant memory address with a value
+def substitute_load(node, addr, value):
+    if node.value == 'mload' and node.args[0].value == addr:
+        return LLLnode.from_list(value, typ=node.typ)
+    elif node.value == 'lll':
+        return node
+    elif node.value == 'repeat' and node.args[0].value == addr:
+        return LLLnode(node.value, [substitute_load(arg, addr, value) for arg in node.args[:3]] + node.args[3:],
+                       node.typ, node.annotation)
+    return LLLnode(node.value, [substitute_load(arg, addr, value) for arg in node.args], node.typ, node.annotation)
+
+def writes_address(node, addr):
+    for sub in walk(node):
+        if sub.value in ('mstore', 'mstore8', 'repeat', 'calldatacopy', 'codecopy') and sub.args[0].value == addr:
+            return True
+        elif sub.value in ('call', 'callcode', 'delegatecall') and sub.args[-2].value == addr:
+            return True
+    return False
+
+# Constant memory addresses read outside the loops that count with them, ie.
+# loop counters whose value after the loop is used
+def get_escaping_counters(node, counters=frozenset()):
+    o = set()
+    if node.value == 'mload' and isinstance(node.args[0].value, int) and node.args[0].value not in counters:
+        o.add(node.args[0].value)
+    if node.value == 'repeat':
+        for arg in node.args[:3]:
+            o |= get_escaping_counters(arg, counters)
+        return o | get_escaping_counters(node.args[3], counters | {node.args[0].value})
+    for arg in node.args:
+        o |= get_escaping_counters(arg, counters)
+    return o
+
+# Size in bytes of a piece of code, which may refer to with-variables bound
+# around it (counted as constants) and break out of a loop around it
+def code_size(node):
+    def close(node):
+        if isinstance(node.value, str) and not node.args and node.value not in keyword_leaves and \
+                not compile_lll.is_symbol(node.value) and \
+                node.value.upper() not in opcodes and node.value.upper() not in pseudo_opcodes:
+            return LLLnode(0, [], node.typ, node.annotation)
+        elif node.value == 'with':
+            return LLLnode(node.value, [node.args[0]] + [close(arg) for arg in node.args[1:]], node.typ, node.annotation)
+        return LLLnode(node.value, [close(arg) for arg in node.args], node.typ, node.annotation)
+    return instruction_size(compile_lll.compile_to_assembly(close(node), {}, ('_sym_unroll_end', 0), 0))
+
+# Versions of a loop with its body copied, each for one value of the
+# counter given as an expression of the round
+def unrolled_loops(node, escaping):
+    memloc, start, rounds, body = node.args
+    addr, rounds = memloc.value, rounds.value
+    # Dynamic starts are computed once, before the copies
+    if isinstance(start.value, int):
+        first, bind = start.value, lambda o: o
+    else:
+        var = mkvar('start')
+        first, bind = var, lambda o: ['with', var, start, o]
+    def index(offset, scale=None):
+        o = first if offset == 0 else ['add', first, offset] if isinstance(first, str) else first + offset
+        if scale is None:
+            return o
+        counter = ['mul', scale, ['mload', addr]]
+        return counter if o == 0 else ['add', counter, o]
+    end = [['mstore', addr, index(rounds)]] if addr in escaping else []
+    o = []
+    if rounds <= MAX_UNROLLED_ROUNDS:
+        copies = [fold_constants(substitute_load(body, addr, index(k))) for k in range(rounds)]
+        # A break leaves a loop of one round around the copies
+        if has_free_break(body):
+            o.append(bind(['seq', ['repeat', addr, 0, 1, ['seq'] + copies]] + end))
+        else:
+            o.append(bind(['seq'] + copies + end))
+    for factor in PARTIAL_UNROLL_FACTORS:
+        if factor < rounds and rounds % factor == 0:
+            group = ['seq'] + [fold_constants(substitute_load(body, addr, index(k, factor))) for k in range(factor)]
+            o.append(bind(['seq', ['repeat', addr, 0, rounds // factor, group]] + end))
+    return [LLLnode.from_list(loop, typ=node.typ) for loop in o]
+
+# Unrolls the loops in a piece of code where the model says it is worth it,
+# given the number of calls to assume. weight is the number of times the
+# code runs for each run of the function
+def unroll(node, escaping, expected_calls, weight=1):
+    if node.value == 'lll':
+        return LLLnode(node.value, [unroll_loops(node.args[0], expected_calls), unroll(node.args[1], escaping, expected_calls, weight)],
+                       node.typ, node.annotation)
+    elif node.value != 'repeat':
+        return LLLnode(node.value, [unroll(arg, escaping, expected_calls, weight) for arg in node.args], node.typ, node.annotation)
+    memloc, start, rounds, body = node.args
+    node = LLLnode(node.value, [memloc, unroll(start, escaping, expected_calls, weight), rounds,
+                                unroll(body, escaping, expected_calls, weight * rounds.value)], node.typ, node.annotation)
+    body = node.args[3]
+    if not isinstance(memloc.value, int) or writes_address(body, memloc.value) or \
+            any(sub.value == 'lll' for sub in walk(body)) or (has_free_break(body) and memloc.value in escaping):
+        return node
+    best, best_saving = node, 0
+    size, gas = code_size(node), compile_lll.gas_estimate(node)
+    for loop in unrolled_loops(node, escaping):
+        saving = (gas - compile_lll.gas_estimate(loop)) * expected_calls * weight - \
+                 (code_size(loop) - size) * DEPLOY_GAS_PER_BYTE
+        if saving > best_saving:
+            best, best_saving = loop, saving
+    return best
+
+def unroll_loops(node, expected_calls=OUTLINE_EXPECTED_CALLS):
+    return unroll(node, get_escaping_counters(node), expected_calls)
+
+def unroll_loops_for_gas(node):
+    return unroll_loops(node, GAS_EXPECTED_CALLS)
+
+# Strength reduction: arithmetic with a constant operand is replaced by
+# cheaper operations that compute the same value. Multiplication and
+# unsigned division by a power of two become shifts on targets that have
+# them, and unsigned modulo by a power of two becomes an and with a mask on
+# any target. Signed division and modulo round towards zero, unlike shifts
+# and masks, so they are only reduced when the dividend is known not to be
+# negative, eg. the counter of a loop with a constant start or an index
+# checked against the length of an array
+
+# Opcodes whose result is never negative as a signed number
+non_negative_ops = ['lt', 'gt', 'slt', 'sgt', 'sle', 'sge', 'eq', 'iszero', 'address', 'caller',
+                    'origin', 'calldatasize', 'codesize', 'timestamp', 'number']
+
+# Returns k if value is 2**k, and None otherwise
+def get_log2(value):
+    if isinstance(value, int) and value > 0 and value & (value - 1) == 0:
+        return value.bit_length() - 1
+    return None
+
+# Is an expression's value below 2**255? counters holds the memory addresses
+# of the counters of the loops around it that cannot go past that
+def is_non_negative(node, counters):
+    if isinstance(node.value, int):
+        return 0 <= node.value < 2**255
+    elif node.value == 'mload':
+        return node.args[0].value in counters
+    elif node.value == 'and':
+        return any(is_non_negative(arg, counters) for arg in node.args)
+    # The result is below the divisor or bound
+    elif node.value in ('mod', 'uclamplt'):
+        return is_non_negative(node.args[1], counters)
+    elif node.value in ('div', 'clamp'):
+        return is_non_negative(node.args[0], counters)
+    elif node.value == 'shr':
+        return is_non_negative(node.args[1], counters) or (isinstance(node.args[0].value, int) and node.args[0].value > 0)
+    return node.value in non_negative_ops
+
+# Can an expression be dropped without changing what the code does?
+def is_removable(node):
+    return not can_fail(node) and all(isinstance(sub.value, int) or sub.value in pure_ops or sub.value in ('mload', 'sload') or
+                                      (not sub.args and sub.value.upper() not in opcodes and sub.value.upper() not in pseudo_opcodes)
+                                      for sub in walk(node))
+
+# Returns the cheaper form of an operation whose arguments are already
+# reduced, or the operation itself
+def reduce_operation(node, shifts, counters):
+    def make(o):
+        return LLLnode.from_list(o, typ=node.typ, annotation=node.annotation)
+    if node.value in ('add', 'mul') and any(isinstance(arg.value, int) for arg in node.args):
+        c, x = node.args if isinstance(node.args[0].value, int) else node.args[::-1]
+        c = c.value % 2**256
+        if c == (0 if node.value == 'add' else 1):
+            return x
+        elif node.value == 'mul' and c == 0 and is_removable(x):
+            return make(0)
+        # Constant offsets and scales are combined into one
+        elif x.value == node.value and any(isinstance(arg.value, int) for arg in x.args):
+            c2, y = x.args if isinstance(x.args[0].value, int) else x.args[::-1]
+            combined = (c + c2.value) if node.value == 'add' else (c * c2.value)
+            return reduce_operation(make([node.value, combined % 2**256, y]), shifts, counters)
+        elif node.value == 'mul' and get_log2(c) and shifts:
+            return make(['shl', get_log2(c), x])
+        # (x / c) * c, as done by decimal(floor(x)), is x minus the remainder
+        elif node.value == 'mul' and x.value == 'sdiv' and x.args[1].value == c and 0 < c < 2**255 and \
+                not x.args[0].args and not isinstance(x.args[0].value, int):
+            return make(['sub', x.args[0], ['smod', x.args[0], c]])
+        return node
+    elif node.value == 'sub' and node.args[1].value == 0:
+        return node.args[0]
+    elif node.value not in ('div', 'sdiv', 'mod', 'smod') or not isinstance(node.args[1].value, int):
+        return node
+    x, c = node.args[0], node.args[1].value % 2**256
+    signed = node.value in ('sdiv', 'smod')
+    if c == 1:
+        return x if node.value in ('div', 'sdiv') else make(0) if is_removable(x) else node
+    # (x * c) / c is x when the product of a num cannot overflow
+    elif node.value == 'sdiv' and x.value == 'mul' and x.args[1].value == c and x.args[0].typ == 'num' and \
+            0 < c < 2**127:
+        return x.args[0]
+    elif get_log2(c) is None or (signed and not is_non_negative(x, counters)):
+        return node
+    elif node.value in ('mod', 'smod'):
+        return make(['and', x, c - 1])
+    elif shifts:
+        return make(['shr', get_log2(c), x])
+    return node
+
+def reduce(node, shifts, counters):
+    if node.value == 'lll':
+        return LLLnode(node.value, [reduce(node.args[0], shifts, frozenset()), reduce(node.args[1], shifts, counters)],
+                       node.typ, node.annotation)
+    elif node.value == 'repeat':
+        memloc, start, rounds, body = node.args
+        if isinstance(memloc.value, int) and isinstance(start.value, int) and 0 <= start.value and \
+                start.value + rounds.value <= 2**255 and not writes_address(body, memloc.value):
+            body_counters = counters | {memloc.value}
+        else:
+            body_counters = counters
+        return LLLnode(node.value, [memloc, reduce(start, shifts, counters), rounds, reduce(body, shifts, body_counters)],
+                       node.typ, node.annotation)
+    node = LLLnode(node.value, [reduce(arg, shifts, counters) for arg in node.args], node.typ, node.annotation)
+    return reduce_operation(fold_operation(node), shifts, counters)
+
+def reduce_strength(node, target=DEFAULT_TARGET):
+    return reduce(node, is_available('shl', target), frozenset())
+
+# Loop-invariant code motion: expressions in the body of a repeat that
+# give the same value in every round, such as the bounds of clamps, checks
+# of arguments and storage keys of fixed slots, are computed once before the
+# loop and kept on the stack with a with-variable. Checks that can fail are
+# only moved if every round runs them before it can exit, since a failed
+# check reverts everything the loop did before it anyway.
+#
+# Slots computed at runtime may equal any slot, including a fixed one (the
+# slot of an element with a constant index is folded into an integer), so
+# a read of storage is only moved if every store in the loop goes to a
+# different fixed slot
+
+# Most values moved out of each loop. Each one is an extra stack item,
+# and if the code no longer compiles because a with-variable is out of
+# DUP16 range, fewer are moved
+MAX_HOISTED_VALUES = 4
+
+# Gas of the DUP that reads a with-variable
+DUP_GAS = 3
+
+# Opcodes in a loop body that may change storage other than with sstore
+storage_changing_ops = ['call', 'callcode', 'delegatecall', 'callblackbox', 'create', 'internal_call']
+
+# Can a storage slot be written by a loop body, given its sstores?
+def slot_written(key, stores):
+    return any(not (isinstance(key.value, int) and isinstance(store.args[0].value, int)) or store.args[0].value == key.value
+               for store in stores)
+
+# Does an expression give the same value in every round of a loop? writes
+# is the set of memory addresses the loop may write (None if unknown),
+# bound the with-variables bound inside it, stores its sstores and
+# storage_fixed whether it can change storage in other ways
+def is_invariant(node, writes, bound, stores, storage_fixed):
+    if isinstance(node.value, int):
+        return True
+    elif not node.args and isinstance(node.value, str) and node.value.upper() not in opcodes and \
+            node.value.upper() not in pseudo_opcodes and node.value not in keyword_leaves:
+        return node.value not in bound
+    elif node.value == 'mload':
+        return writes is not None and isinstance(node.args[0].value, int) and node.args[0].value not in writes
+    elif node.value == 'sload':
+        return storage_fixed and is_invariant(node.args[0], writes, bound, stores, storage_fixed) and \
+            not slot_written(node.args[0], stores)
+    elif node.value not in pure_ops:
+        return False
+    return all(is_invariant(arg, writes, bound, stores, storage_fixed) for arg in node.args)
+
+# Finds the largest invariant expressions of a loop body worth keeping on
+# the stack, ie. that cost more than the DUP which replaces them
+def find_invariants(node, invariant, unconditional, o):
+    if node.args and invariant(node) and compile_lll.gas_estimate(node) > DUP_GAS and \
+            (id(node) in unconditional or not (can_fail(node) or any(sub.value == 'sload' for sub in walk(node)))):
+        o.append(node)
+        return o
+    for arg in scoped_args(node):
+        find_invariants(arg, invariant, unconditional, o)
+    return o
+
+def count_key(node, key):
+    return sum(1 for sub in walk(node) if key_of(sub) == key)
+
+# Is moving an expression out of a loop worth it under the cost model of
+# inlining and outlining? The expression is computed once before the loop
+# and popped after it, and each use becomes a DUP in its place
+def should_hoist(expr, uses, runs):
+    gas_saved = (compile_lll.gas_estimate(expr) - DUP_GAS) * uses * runs - \
+        compile_lll.gas_estimate(LLLnode.from_list(['with', '_x', 0, 'pass']))
+    size = code_size(expr)
+    extra_size = size + 1 - uses * (size - 1)
+    return gas_saved > 0 and gas_saved * OUTLINE_EXPECTED_CALLS > extra_size * DEPLOY_GAS_PER_BYTE
+
+# Moves up to limit invariant expressions out of a loop, and out of the
+# loops nested inside it. weight is the number of times the code runs for
+# each run of the function
+def hoist_invariants(node, limit, weight=1):
+    if node.value == 'lll':
+        return LLLnode(node.value, [hoist_invariants(node.args[0], limit), hoist_invariants(node.args[1], limit, weight)],
+                       node.typ, node.annotation)
+    elif node.value != 'repeat' or not isinstance(node.args[0].value, int) or node.args[2].value < 2:
+        return LLLnode(node.value, [hoist_invariants(arg, limit, weight) for arg in node.args], node.typ, node.annotation)
+    memloc, start, rounds, body = node.args
+    writes = get_memory_writes(LLLnode.from_list(['seq', start, body]))
+    if writes is not None:
+        writes = writes | {memloc.value}
+    bound = set(sub.args[0].value for sub in walk(body) if sub.value == 'with')
+    stores = [sub for sub in walk(body) if sub.value == 'sstore']
+    storage_fixed = not any(sub.value in storage_changing_ops for sub in walk(body))
+    invariant = lambda expr: is_invariant(expr, writes, bound, stores, storage_fixed)
+    unconditional = set(id(sub) for sub in unconditional_subtrees(body))
+    candidates = find_invariants(body, invariant, unconditional, [])
+    candidates.sort(key=lambda sub: -compile_lll.gas_estimate(sub) * count_key(body, key_of(sub)))
+    hoisted = []
+    for candidate in candidates:
+        key = key_of(candidate)
+        if len(hoisted) >= limit or key in [key_of(h[1]) for h in hoisted]:
+            continue
+        # Occurrences may be gone if they were part of an expression moved before
+        uses = count_key(body, key)
+        if uses and should_hoist(candidate, uses, rounds.value * weight):
+            var = mkvar('inv')
+            body = substitute(body, key, var)
+            hoisted.append((var, candidate))
+    o = LLLnode(node.value, [memloc, start, rounds, hoist_invariants(body, limit, weight * rounds.value)], node.typ, node.annotation)
+    for var, candidate in hoisted[::-1]:
+        o = LLLnode.from_list(['with', var, candidate, o], typ=node.typ)
+    return o
+
+def fits_stack(node):
+    try:
+        compile_lll.compile_to_assembly(node, {})
+        return True
+    except Exception:
+        return False
+
+def hoist_loop_invariants(node):
+    for limit in range(MAX_HOISTED_VALUES, 0, -1):
+        o = hoist_invariants(node, limit)
+        if fits_stack(o):
+            return o
+    return node
+
+# Available passes, in the order they run
+lll_passes = [('inline_internal_calls', inline_internal_calls), ('unroll_loops', unroll_loops),
+              ('unroll_loops_for_gas', unroll_loops_for_gas), ('reduce_strength', reduce_strength),
+              ('cache_storage_keys', cache_storage_keys),
+              ('hoist_loop_invariants', hoist_loop_invariants)]
+assembly_passes = [('peephole', peephole), ('outline_subroutines', outline_subroutines)]
+
+# Passes whose output depends on the EVM version targeted
+targeted_passes = ['reduce_strength']
+
+# Passes enabled at each optimization level
+optimization_levels = {
+    0: [],
+    1: ['inline_internal_calls', 'unroll_loops', 'reduce_strength', 'cache_storage_keys', 'hoist_loop_invariants', 'peephole'],
+    2: ['inline_internal_calls', 'unroll_loops_for_gas', 'reduce_strength', 'cache_storage_keys', 'hoist_loop_invariants', 'peephole'],
+    'size': ['inline_internal_calls', 'unroll_loops', 'reduce_strength', 'cache_storage_keys', 'hoist_loop_invariants', 'peephole', 'outline_subroutines'],
+}
+
+def get_passes(level, passes=None):
+    if passes is not None:
+        return passes
+    if level not in optimization_levels:
+        raise Exception("Invalid optimization level: %r" % level)
+    return optimization_levels[level]
+
+def count_nodes(node):
+    return 1 + sum(count_nodes(arg) for arg in node.args)
+
+# Estimated gas of an LLL tree, including the code inside lll nodes
+def lll_gas(node):
+    internal_gas = compile_lll.get_internal_gas([sub for sub in walk(node) if sub.value == 'internal_def'])
+    return compile_lll.gas_estimate(node, 0, internal_gas) + sum(lll_gas(sub.args[0]) for sub in walk(node) if sub.value == 'lll')
+
+def count_instructions(assembly):
+    return sum(count_instructions(item) if isinstance(item, list) else 1
+               for item in assembly if not isinstance(item, int))
+
+# Static gas cost of all instructions in a piece of assembly
+def assembly_gas(assembly):
+    o = 0
+    for item in assembly:
+        if isinstance(item, list):
+            o += assembly_gas(item)
+        elif isinstance(item, str) and item.upper() in opcodes:
+            o += opcodes[item.upper()][3]
+        elif isinstance(item, str) and (item[:4] in ('PUSH', 'SWAP') or item[:3] == 'DUP'):
+            o += 3
+    return o
+
+# Runs a list of passes over an LLL tree or assembly, appending a record of
+# each one to the report if one is given
+def run_passes(code, available, names, measure_size, measure_gas, report=None):
+    for name, func in available:
+        if name not in names:
+            continue
+        size_before = measure_size(code) if report is not None else None
+        gas_before = measure_gas(code) if report is not None else None
+        t0 = time.time()
+        code = func(code)
+        elapsed = time.time() - t0
+        if report is not None:
+            report.append({
+                "pass": name,
+                "time": elapsed,
+                "size_before": size_before,
+                "size_after": measure_size(code),
+                "gas_saved": gas_before - measure_gas(code),
+            })
+    return code
+
+# Runs the LLL-level optimizations enabled at the given level, only using
+# opcodes available on the target EVM version
+def optimize(node, level=1, passes=None, report=None, target=DEFAULT_TARGET):
+    check_target(target)
+    available = [(name, (lambda code, func=func: func(code, target)) if name in targeted_passes else func)
+                 for name, func in lll_passes]
+    return run_passes(node, available, get_passes(level, passes),
+                      count_nodes, lll_gas, report)
+
+# Runs the assembly-level optimizations enabled at the given level
+def optimize_assembly(assembly, level=1, passes=None, report=None):
+    return run_passes(assembly, assembly_passes, get_passes(level, passes),
+                      count_instructions, assembly_gas, report)
@@ -1,14 +1,76 @@
-try:
-    from Crypto.Hash import keccak
-    sha3_256 = lambda x: keccak.new(digest_bits=256, data=x).digest()
-except ImportError:
-    import sha3 as _sha3
-    sha3_256 = lambda x: _sha3.sha3_256(x).digest()
-
-import ast, tokenize, binascii
-from io import BytesIO
+import ast, atexit, binascii, os
 from opcodes import opcodes, pseudo_opcodes
 
+# The keccak backend is imported the first time a hash is needed rather than
+# at module load, as many uses of the compiler never hash anything
+_keccak = []
+
+def sha3_256(x):
+    if not _keccak:
+        try:
+            from Crypto.Hash import keccak
+            _keccak.append(lambda x: keccak.new(digest_bits=256, data=x).digest())
+        except ImportError:
+            import sha3 as _sha3
+            _keccak.append(lambda x: _sha3.sha3_256(x).digest())
+    return _keccak[0](x)
+
+# Memoized table of function signature -> four-byte method id. If the
+# VIPER_SELECTOR_CACHE environment variable names a file, the table is
+# loaded from it on first use, and new entries are saved back to it in one
+# write at the end of a compile (or at exit). Entries that are not four-byte
+# ids are ignored and get rehashed, and the file is replaced atomically so
+# that a concurrent reader never sees it half written. Saving is best-effort:
+# if the file can't be written the ids are just kept in memory
+method_ids = {}
+_method_ids_loaded = []
+_method_ids_dirty = [False]
+
+def load_method_ids(path):
+    import json
+    try:
+        with open(path) as f:
+            loaded = json.load(f)
+    except (IOError, ValueError):
+        return
+    if not isinstance(loaded, dict):
+        return
+    for sig, method_id in loaded.items():
+        if isinstance(method_id, int) and not isinstance(method_id, bool) and 0 <= method_id < 2**32:
+            method_ids[sig] = method_id
+
+def save_method_ids(path):
+    import json, tempfile
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(path)))
+    try:
+        with os.fdopen(fd, 'w') as f:
+            json.dump(method_ids, f, sort_keys=True)
+        os.replace(tmp_path, path)
+    except BaseException:
+        os.unlink(tmp_path)
+        raise
+
+def flush_method_ids():
+    path = os.environ.get('VIPER_SELECTOR_CACHE')
+    if path and _method_ids_dirty[0]:
+        try:
+            save_method_ids(path)
+        except OSError:
+            pass
+        _method_ids_dirty[0] = False
+
+atexit.register(flush_method_ids)
+
+def get_method_id(sig):
+    path = os.environ.get('VIPER_SELECTOR_CACHE')
+    if path and not _method_ids_loaded:
+        load_method_ids(path)
+        _method_ids_loaded.append(path)
+    if sig not in method_ids:
+        method_ids[sig] = fourbytes_to_int(sha3_256(bytes(sig, 'utf-8'))[:4])
+        _method_ids_dirty[0] = True
+    return method_ids[sig]
+
 # Converts code to parse tree
 def parse(code):
     return ast.parse(code).body
@@ -88,6 +150,28 @@ class LLLnode():
             # Seq statements: seq <statement> <statement> ...
             elif self.value == 'seq':
                 self.valency = self.args[-1].valency if self.args else 0
+            # Internal function calls: internal_call <label> <number of return values> <argument> ...
+            elif self.value == 'internal_call':
+                if len(self.args) < 2 or not isinstance(self.args[0].value, str) or self.args[1].value not in (0, 1):
+                    raise Exception("Internal call must have a label and a number of return values (0 or 1)")
+                for arg in self.args[2:]:
+                    if not arg.valency:
+                        raise Exception("Can't have a zerovalent argument to an internal call! %r" % arg)
+                self.valency = self.args[1].value
+            # Internal functions: internal_def <label> <argument memloc> ... <body>
+            elif self.value == 'internal_def':
+                if len(self.args) < 2 or not isinstance(self.args[0].value, str):
+                    raise Exception("Internal function must have a label and a body")
+                if not all(isinstance(arg.value, int) for arg in self.args[1:-1]):
+                    raise Exception("Internal function argument locations must be constant")
+                if self.args[-1].valency:
+                    raise Exception("Body of an internal function must be zerovalent: %r" % self.args[-1])
+                self.valency = 0
+            # Return from an internal function: internal_return [<value>]
+            elif self.value == 'internal_return':
+                if len(self.args) > 1 or (self.args and not self.args[0].valency):
+                    raise Exception("Internal return takes at most one, non-zerovalent, argument")
+                self.valency = 0
             # Variables
             else:
                 self.valency = 1
@@ -120,8 +204,17 @@ class LLLnode():
         else:
             return cls(obj[0], [cls.from_list(o) for o in obj[1:]], typ, annotation)
 
+next_with_var = [0]
+
+# Returns a fresh name for a with-variable, so that the withs generated for
+# nested statements never shadow each other
+def mk_with_var(prefix):
+    next_with_var[0] += 1
+    return '_%s%d' % (prefix, next_with_var[0])
+
 # Available base types
 types = ['num', 'decimal', 'bytes32', 'num256', 'signed256', 'bool', 'address']
+type_names = frozenset(types)
 
 # Available types that functions can have as inputs
 allowed_func_input_types = ['num', 'bool', 'num256', 'signed256', 'address']
@@ -131,6 +224,8 @@ allowed_func_output_types = ['num', 'bool', 'num256', 'signed256', 'address']
 
 # A decimal value can store multiples of 1/DECIMAL_DIVISOR
 DECIMAL_DIVISOR = 10000000000
+MAXDECIMAL = (2**128 - 1) * DECIMAL_DIVISOR
+MINDECIMAL = (-2**128 + 1) * DECIMAL_DIVISOR
 
 # Number of bytes in memory used for system purposes, not for variables
 RESERVED_MEMORY = 256
@@ -154,36 +249,119 @@ def canonicalize_type(t):
         return t
     elif t == 'real':
         return 'real128x128'
+    elif isinstance(t, ListType):
+        return canonicalize_type(t.subtype) + '[%d]' % t.count
     raise Exception("Invalid or unsupported type: "+repr(t))
 
 # Cannot be used for variable naming
-reserved_words = ['int128', 'int256', 'uint256', 'address', 'bytes32',
-                  'real', 'real128x128', 'if', 'for', 'while', 'until',
-                  'pass', 'def', 'push', 'dup', 'swap', 'send', 'call',
-                  'suicide', 'selfdestruct', 'assert', 'stop', 'throw',
-                  'raise', 'init', '_init_', '___init___', '____init____']
+reserved_words = frozenset(['int128', 'int256', 'uint256', 'address', 'bytes32',
+                            'real', 'real128x128', 'if', 'for', 'while', 'until',
+                            'pass', 'def', 'push', 'dup', 'swap', 'send', 'call',
+                            'suicide', 'selfdestruct', 'assert', 'stop', 'throw',
+                            'raise', 'init', '_init_', '___init___', '____init____'])
+
+# Lowercase names that cannot be used for variables: types, reserved words and opcodes
+invalid_varnames = type_names | reserved_words | frozenset(op.lower() for op in opcodes)
 
 # Is a variable name valid?
 def is_varname_valid(varname):
-    if varname.lower() in types:
-        return False
-    if varname.lower() in reserved_words:
-        return False
-    if varname[0] == '~':
-        return False
-    if varname.upper() in opcodes:
-        return False
-    return True
+    return varname[0] != '~' and varname.lower() not in invalid_varnames
 
 class InvalidTypeException(Exception):
     pass
 
+# Compound types are immutable layout objects, built once per declaration,
+# which give their size (in 32-byte words) and member positions. Types
+# containing a mapping only exist in storage, which has no use for their
+# size, so sizes and memory offsets are computed on first use and cached.
+# Base types are plain strings
+class CompoundType():
+    def __eq__(self, other):
+        return type(self) == type(other) and self.key() == other.key()
+
+    def __ne__(self, other):
+        return not self.__eq__(other)
+
+    def __hash__(self):
+        return hash((type(self).__name__, self.key()))
+
+    def __repr__(self):
+        return self.repr()
+
+# Fixed-size lists, eg. num[10]
+class ListType(CompoundType):
+    def __init__(self, subtype, count):
+        self.subtype = subtype
+        self.count = count
+        self._size = None
+
+    @property
+    def size(self):
+        if self._size is None:
+            self._size = get_size_of_type(self.subtype) * self.count
+        return self._size
+
+    def key(self):
+        return (self.subtype, self.count)
+
+    def repr(self):
+        return '%r[%d]' % (self.subtype, self.count)
+
+# Structs, eg. [a(num), b(bytes32)]. Members are laid out in sorted order
+class StructType(CompoundType):
+    def __init__(self, members):
+        self.names = tuple(sorted(members.keys()))
+        self.types = dict(members)
+        # Position of each member, as an index for storage and as an
+        # offset in words for memory
+        self.indexes = dict((name, i) for i, name in enumerate(self.names))
+        self._offsets = None
+        self._size = None
+
+    @property
+    def offsets(self):
+        if self._offsets is None:
+            offsets, offset = {}, 0
+            for name in self.names:
+                offsets[name] = offset
+                offset += get_size_of_type(self.types[name])
+            self._offsets, self._size = offsets, offset
+        return self._offsets
+
+    @property
+    def size(self):
+        if self._size is None:
+            self.offsets
+        return self._size
+
+    def key(self):
+        return tuple((name, self.types[name]) for name in self.names)
+
+    def repr(self):
+        return '[' + ', '.join('%s(%r)' % (name, self.types[name]) for name in self.names) + ']'
+
+# Mappings, eg. {num: address}
+class MappingType(CompoundType):
+    def __init__(self, keytype, valuetype):
+        self.keytype = keytype
+        self.valuetype = valuetype
+
+    @property
+    def size(self):
+        raise Exception("Type size infinite!")
+
+    def key(self):
+        return (self.keytype, self.valuetype)
+
+    def repr(self):
+        return '{%s: %r}' % (self.keytype, self.valuetype)
+
 # Parses an expression representing a type. Annotation refers to whether
 # the type is to be located in memory or storage
 def parse_type(item, annotation):
     # Base types, eg. uint
     if isinstance(item, ast.Name):
-        if item.id not in types:
+        if item.id not in type_names:
             raise InvalidTypeException("Invalid type: "+item.id)
         return item.id
     # Lists, used to enumerate members, eg. [bar(uint), baz(bytes32)...]
@@ -199,37 +377,31 @@ def parse_type(item, annotation):
             o = {elt.func.id: parse_type(elt.args[0], annotation) for elt in item.elts}
             if len(o) < len(item.elts):
                 raise InvalidTypeException("Duplicate argument")
-            return o
+            return StructType(o)
         else:
             raise InvalidTypeException("Mal-formatted list type")
     # Subscripts, used to represent fixed-size lists, eg. uint[100]
     elif isinstance(item, ast.Subscript):
         if not isinstance(item.slice.value, ast.Num):
             raise InvalidTypeException("Arrays must be of the format type[num_of_elements]")
-        return [parse_type(item.value, annotation), item.slice.value.n]
+        return ListType(parse_type(item.value, annotation), item.slice.value.n)
     # Dicts, used to represent mappings, eg. {uint: uint}. Key must be a base type
     elif isinstance(item, ast.Dict):
         if annotation == 'memory':
             raise InvalidTypeException("No dicts allowed for in-memory types!") 
         if not (len(item.keys) == len(item.values) == 1):
             raise InvalidTypeException("Dict types must specify one mapping")
-        if not isinstance(item.keys[0], ast.Name) or item.keys[0].id not in types:
+        if not isinstance(item.keys[0], ast.Name) or item.keys[0].id not in type_names:
             raise InvalidTypeException("Key type invalid")
-        return {item.keys[0].id: parse_type(item.values[0], annotation)}
+        return MappingType(item.keys[0].id, parse_type(item.values[0], annotation))
     else:
         raise InvalidTypeException("Invalid type: %r" % ast.dump(item))
 
 # Gets the number of memory or storage keys needed to represent a given type
 def get_size_of_type(typ):
-    if not isinstance(typ, (list, dict)):
-        return 1
-    if isinstance(typ, list):
-        return get_size_of_type(typ[0]) * typ[1]
-    elif isinstance(typ, dict):
-        if len(typ.keys()) == 1 and list(typ.keys())[0] in types:
-            raise Exception("Type size infinite!")
-        else:
-            return sum([get_size_of_type(v) for v in typ.values()])
+    if isinstance(typ, CompoundType):
+        return typ.size
+    return 1
 
 # Parse top-level functions and variables
 def get_defs_and_globals(code):
@@ -257,31 +429,66 @@ def mk_initial():
                                 ['mstore', ADDRSIZE_POS, 2**160],
                                 ['mstore', MAXNUM_POS, 2**128 - 1],
                                 ['mstore', MINNUM_POS, -2**128 + 1],
-                                ['mstore', MAXDECIMAL_POS, (2**128 - 1) * DECIMAL_DIVISOR],
-                                ['mstore', MINDECIMAL_POS, (-2**128 + 1) * DECIMAL_DIVISOR],
+                                ['mstore', MAXDECIMAL_POS, MAXDECIMAL],
+                                ['mstore', MINDECIMAL_POS, MINDECIMAL],
                              ], typ='null')
 
+# Is a function internal, ie. only callable from other functions of the
+# contract? Internal functions are marked with an @internal decorator
+def is_internal(code):
+    return any(isinstance(d, ast.Name) and d.id == 'internal' for d in code.decorator_list)
+
+# Parses the type of a function argument: a base type or, for functions
+# called through the ABI, a fixed-size list of them, eg. num[50]
+def parse_arg_type(typ, input_types, allow_lists):
+    if isinstance(typ, ast.Name) and typ.id in input_types:
+        return typ.id
+    if allow_lists and isinstance(typ, ast.Subscript):
+        o = parse_type(typ, 'memory')
+        subtype = o
+        while isinstance(subtype, ListType):
+            if subtype.count < 1:
+                raise Exception("Argument lists must have at least one element")
+            subtype = subtype.subtype
+        if subtype in input_types:
+            return o
+    raise Exception("Argument type invalid or unsupported")
+
+# Number of words taken by the arguments of a function, as returned by
+# get_func_details, in the calldata
+def get_args_size(args):
+    return sum([get_size_of_type(typ) for argname, loc, typ in args])
+
 # Get function details
 def get_func_details(code):
     name = code.name
+    for d in code.decorator_list:
+        if not isinstance(d, ast.Name) or d.id != 'internal':
+            raise Exception("Unsupported decorator: %r" % ast.dump(d))
+    if is_internal(code) and name == '__init__':
+        raise Exception("The initializer cannot be internal")
+    # Internal functions are not called through the ABI, so they can take and return any base type
+    input_types = types if is_internal(code) else allowed_func_input_types
+    output_types = types if is_internal(code) else allowed_func_output_types
     # Determine the arguments, expects something of the form def foo(arg1: num, arg2: num ...
     args = []
+    words = 0
     for arg in code.args.args:
-        typ = arg.annotation
         if not isinstance(arg.arg, (str, bytes)):
             raise Exception("Argument name invalid")
-        if not typ:
+        if not arg.annotation:
             raise Exception("Argument must have type")
-        if not isinstance(typ, ast.Name) or typ.id not in allowed_func_input_types:
-            raise Exception("Argument type invalid or unsupported")
+        typ = parse_arg_type(arg.annotation, input_types, not is_internal(code))
         if not is_varname_valid(arg.arg):
             raise Exception("Argument name invalid or reserved: "+arg.arg)
-        if name == '__init__':
-            args.append((arg.arg, -32 * len(code.args.args) + 32 * len(args), typ.id))
-        else:
-            args.append((arg.arg, 4 + 32 * len(args), typ.id))
-        if typ.id not in allowed_func_input_types:
-            raise Exception("Disallowed type for function inputs: "+typ.id)
+        args.append((arg.arg, words, typ))
+        words += get_size_of_type(typ)
+    # Position of each argument in the calldata, or for the initializer,
+    # relative to the end of the code, where constructor arguments are appended
+    if name == '__init__':
+        args = [(argname, -32 * words + 32 * offset, typ) for argname, offset, typ in args]
+    else:
+        args = [(argname, 4 + 32 * offset, typ) for argname, offset, typ in args]
     # Determine the return type and whether or not it's constant. Expects something
     # of the form:
     # def foo(): ...
@@ -290,60 +497,285 @@ def get_func_details(code):
     const = False
     if not code.returns:
         output_type = None
-    elif isinstance(code.returns, ast.Name) and code.returns.id in allowed_func_output_types:
+    elif isinstance(code.returns, ast.Name) and code.returns.id in output_types:
         output_type = code.returns.id
     elif isinstance(code.returns, ast.Call) and isinstance(code.returns.func, ast.Name) and \
-            code.returns.func.id in allowed_func_output_types and len(code.returns.args) == 1 and \
+            code.returns.func.id in output_types and len(code.returns.args) == 1 and \
             isinstance(code.returns.args[0], ast.Name) and code.returns.args[0].id == 'const':
         output_type = code.returns.func.id
         const = True
     else:
         raise Exception("Output type invalid or unsupported: %r" % code.returns)
     # Get the four-byte method id
-    sig = name + '(' + ','.join([canonicalize_type(arg.annotation.id) for arg in code.args.args]) + ')'
-    method_id = fourbytes_to_int(sha3_256(bytes(sig, 'utf-8'))[:4])
+    if is_internal(code):
+        sig, method_id = None, None
+    else:
+        sig = name + '(' + ','.join([canonicalize_type(typ) for argname, loc, typ in args]) + ')'
+        method_id = get_method_id(sig)
     return name, args, output_type, const, sig, method_id
 
+# Names of the functions a function calls as self.name(...)
+def get_internal_calls(code):
+    return set(node.func.attr for node in ast.walk(code) if is_internal_call(node))
+
+def is_internal_call(expr):
+    return isinstance(expr, ast.Call) and isinstance(expr.func, ast.Attribute) and \
+        isinstance(expr.func.value, ast.Name) and expr.func.value.id == 'self'
+
+# An internal function: its signature, the label of the subroutine it is
+# compiled to, and what a call to it can touch, counting the functions it
+# calls in turn: the persistent variables it accesses and whether it sends
+class InternalFunc():
+    def __init__(self, code, _globals):
+        self.code = code
+        self.name, args, self.output_type, const, sig, method_id = get_func_details(code)
+        self.args = [(argname, typ) for argname, loc, typ in args]
+        self.label = '_sym_internal_' + self.name
+        self.calls = get_internal_calls(code)
+        self.reachable = set()
+        self.globals_used = set(node.attr for node in ast.walk(code) if is_atomic_global(node, _globals))
+        self.sends = any(is_send(node) for node in ast.walk(code))
+
+# Collects the internal functions of a contract as name -> InternalFunc.
+# Each of them has a single frame of memory, so recursion is not supported
+def get_internal_funcs(_defs, _globals):
+    internals = {}
+    for _def in _defs:
+        if is_internal(_def):
+            internals[_def.name] = InternalFunc(_def, _globals)
+    for func in internals.values():
+        pending = list(func.calls)
+        while pending:
+            name = pending.pop()
+            if name not in internals:
+                raise Exception("Not an internal function: %s" % name)
+            if name == func.name:
+                raise Exception("Recursive internal functions are not supported: %s" % name)
+            if name not in func.reachable:
+                func.reachable.add(name)
+                pending.extend(internals[name].calls)
+    for func in internals.values():
+        for name in func.reachable:
+            func.globals_used |= internals[name].globals_used
+            func.sends = func.sends or internals[name].sends
+    return internals
+
+# Names of the internal functions that may run, directly or not, when the
+# given functions are called
+def get_called_internals(_defs, internals):
+    o = set()
+    for _def in _defs:
+        for name in get_internal_calls(_def):
+            if name in internals:
+                o |= set([name]) | internals[name].reachable
+    return o
+
 # Contains arguments, variables, etc
 class Context():
-    def __init__(self, args=None, vars=None, globals=None, forvars=None, return_type=None):
+    def __init__(self, args=None, vars=None, globals=None, forvars=None, return_type=None, storage_cache=None,
+                 internals=None, is_internal=False):
         self.args = args or {}
-        self.vars = vars or {}
+        self.vars = vars if vars is not None else {}
         self.globals = globals or {}
         self.forvars = forvars or {}
         self.return_type = return_type
+        # Persistent variables kept in memory during the call: name -> (memory position, is written)
+        self.storage_cache = storage_cache or {}
+        # Internal functions that can be called: name -> InternalFunc
+        self.internals = internals or {}
+        # Whether this is the body of an internal function
+        self.is_internal = is_internal
 
     def new_variable(self, name, typ):
         if not is_varname_valid(name):
             raise Exception("Variable name invalid or reserved: "+name)
         if name in self.vars or name in self.args or name in self.globals:
             raise Exception("Duplicate variable name")
-        pos = self.vars.get('_next_mem', RESERVED_MEMORY)
+        pos = self.reserve_memory(32 * get_size_of_type(typ))
         self.vars[name] = pos, typ
-        self.vars['_next_mem'] = pos + 32 * get_size_of_type(typ)
+        return pos
+
+    # Allocates memory that is not bound to any variable name
+    def reserve_memory(self, size):
+        pos = self.vars.get('_next_mem', RESERVED_MEMORY)
+        self.vars['_next_mem'] = pos + size
         return pos
 
 # Is a function the initializer?
 def is_initializer(code):
     return code.name == '__init__'
 
+# Validates a raw argument value according to its type
+def make_arg_clamp(data_decl, typ):
+    if typ == 'num':
+        return LLLnode.from_list(['clamp', ['mload', MINNUM_POS], data_decl, ['mload', MAXNUM_POS]], typ='num')
+    elif typ == 'bool':
+        return LLLnode.from_list(['uclamplt', data_decl, 2], typ='bool')
+    elif typ == 'address':
+        return LLLnode.from_list(['uclamplt', data_decl, ['mload', ADDRSIZE_POS]], typ='address')
+    elif typ == 'num256' or typ == 'signed256' or typ == 'bytes32':
+        return LLLnode.from_list(data_decl, typ=typ)
+    else:
+        raise Exception("Unsupported type: "+typ)
+
+# Copies all arguments into memory with a single CALLDATACOPY (or CODECOPY
+# for constructor arguments, which are appended to the init code) and
+# validates each of them once, so that later uses are plain MLOADs
+def make_arg_prologue(args, context, is_init=False):
+    if not args:
+        return LLLnode.from_list('pass', typ=None)
+    size = 32 * get_args_size(args)
+    pos = context.reserve_memory(size)
+    if is_init:
+        o = ['seq', ['codecopy', pos, ['sub', ['codesize'], size], size]]
+    else:
+        o = ['seq', ['calldatacopy', pos, 4, size]]
+    for argname, dataloc, typ in args:
+        context.args[argname] = (pos, typ)
+        o.extend(make_arg_checks(pos, typ, context))
+        pos += 32 * get_size_of_type(typ)
+    return LLLnode.from_list(o, typ=None)
+
+# Validates an argument that was copied into memory at pos. All the words
+# of a list are checked in a single loop, whose counter runs over their
+# word positions in memory so that it directly gives their addresses
+def make_arg_checks(pos, typ, context):
+    subtype = typ
+    while isinstance(subtype, ListType):
+        subtype = subtype.subtype
+    if subtype not in ('num', 'bool', 'address'):
+        return []
+    if isinstance(typ, ListType):
+        index = context.reserve_memory(32)
+        return [['repeat', index, pos // 32, get_size_of_type(typ),
+                    ['pop', make_arg_clamp(['mload', ['mul', 32, ['mload', index]]], subtype)]]]
+    return [['pop', make_arg_clamp(['mload', pos], typ)]]
+
+# Is an expression a direct access to an atomic persistent variable, eg. self.x?
+def is_atomic_global(expr, _globals):
+    return isinstance(expr, ast.Attribute) and isinstance(expr.value, ast.Name) and \
+        expr.value.id == 'self' and expr.attr in _globals and expr.attr != 'balance' and \
+        not isinstance(_globals[expr.attr][1], CompoundType)
+
+def is_send(expr):
+    return isinstance(expr, ast.Call) and isinstance(expr.func, ast.Name) and expr.func.id == 'send'
+
+# Determines which atomic persistent variables a function should keep in
+# memory for the duration of the call: those read or written more than once,
+# or accessed inside a loop. Returns a dict of name -> whether it is written
+def get_cached_globals(code, _globals):
+    reads, writes, in_loop = {}, {}, set()
+    for stmt in code.body:
+        for node in ast.walk(stmt):
+            if isinstance(node, (ast.Assign, ast.AugAssign)):
+                for target in (node.targets if isinstance(node, ast.Assign) else [node.target]):
+                    if is_atomic_global(target, _globals):
+                        writes[target.attr] = writes.get(target.attr, 0) + 1
+            if is_atomic_global(node, _globals) and isinstance(node.ctx, ast.Load):
+                reads[node.attr] = reads.get(node.attr, 0) + 1
+            elif isinstance(node, ast.AugAssign) and is_atomic_global(node.target, _globals):
+                reads[node.target.attr] = reads.get(node.target.attr, 0) + 1
+            if isinstance(node, ast.For):
+                # Sends inside a loop would reload the cache on every round
+                if any(is_send(sub) for sub in ast.walk(node)):
+                    return {}
+                in_loop |= set(sub.attr for sub in ast.walk(node) if is_atomic_global(sub, _globals))
+    o = {}
+    for varname in set(reads) | set(writes):
+        if reads.get(varname, 0) >= 2 or writes.get(varname, 0) >= 2 or varname in in_loop:
+            o[varname] = varname in writes
+    return o
+
+# Loads all cached persistent variables from storage into memory
+def make_storage_reload(context):
+    o = ['seq']
+    for varname, (pos, written) in sorted(context.storage_cache.items()):
+        o.append(['mstore', pos, ['sload', context.globals[varname][0]]])
+        if written:
+            o.append(['mstore', pos + 32, ['mload', pos]])
+    return LLLnode.from_list(o, typ=None)
+
+# Writes cached persistent variables whose value changed back to storage
+def make_storage_writeback(context):
+    o = ['seq']
+    for varname, (pos, written) in sorted(context.storage_cache.items()):
+        if written:
+            o.append(['if', ['iszero', ['eq', ['mload', pos], ['mload', pos + 32]]],
+                            ['sstore', context.globals[varname][0], ['mload', pos]]])
+    return LLLnode.from_list(o, typ=None)
+
+# Reserves memory for the persistent variables a function caches (the current
+# value, plus the original value for written ones) and loads them. Variables
+# that internal functions called from it access are not cached, as those
+# functions read and write them in storage
+def make_storage_cache(code, context):
+    excluded = set()
+    for name in get_called_internals([code], context.internals):
+        excluded |= context.internals[name].globals_used
+    for varname, written in sorted(get_cached_globals(code, context.globals).items()):
+        if varname not in excluded:
+            context.storage_cache[varname] = (context.reserve_memory(64 if written else 32), written)
+    return make_storage_reload(context)
+
 # Parses a function declaration
-def parse_func(code, _globals, _vars=None):
+def parse_func(code, _globals, _vars=None, internals=None):
     name, args, output_type, const, sig, method_id = get_func_details(code)
-    context = Context(args={a[0]: (a[1], a[2]) for a in args}, globals=_globals, vars=_vars or {}, return_type=output_type)
+    context = Context(args={a[0]: (a[1], a[2]) for a in args}, globals=_globals, vars=_vars,
+                      return_type=output_type, internals=internals)
     if name == '__init__':
-        return parse_body(code.body, context)
+        return LLLnode.from_list(['seq',
+                                    make_arg_prologue(args, context, is_init=True),
+                                    make_storage_cache(code, context),
+                                    parse_body(code.body, context),
+                                    make_storage_writeback(context)], typ=None)
     else:
         return LLLnode.from_list(['if',
                                     ['eq', ['mload', 0], method_id],
-                                    ['seq'] + [parse_body(c, context) for c in code.body]
+                                    ['seq', make_arg_prologue(args, context), make_storage_cache(code, context)] +
+                                    [parse_body(c, context) for c in code.body] +
+                                    [make_storage_writeback(context)]
                                  ], typ='null')
 
+# Parses an internal function into a subroutine. Its arguments, which the
+# caller passes on the stack, and its variables live in a frame of memory
+# starting at base. Returns the subroutine and the end of its frame
+def parse_internal_func(func, _globals, internals, base):
+    context = Context(globals=_globals, vars={'_next_mem': base}, return_type=func.output_type,
+                      internals=internals, is_internal=True)
+    positions = []
+    for argname, typ in func.args:
+        positions.append(context.reserve_memory(32))
+        context.args[argname] = (positions[-1], typ)
+    body = [parse_stmt(stmt, context) for stmt in func.code.body]
+    # Running off the end of a function that returns a value is an error
+    if not isinstance(func.code.body[-1], ast.Return):
+        body.append(['internal_return'] if func.output_type is None else ['assert', 0])
+    return LLLnode.from_list(['internal_def', func.label] + positions + [['seq'] + body], typ=None), context.vars['_next_mem']
+
+# Parses the given internal functions, giving each of them its own frame of
+# memory above base. Returns name -> subroutine
+def make_internal_defs(names, _globals, internals, base):
+    o = {}
+    for name in sorted(names):
+        o[name], base = parse_internal_func(internals[name], _globals, internals, base)
+    return o
+
+# Signature of the optional entry point that runs several calls at once
+BATCH_SIG = 'batch(bytes)'
+
+# Maximum number of calls a single batch can contain
+MAX_BATCH_CALLS = 64
+
+# Gas kept back from each call in a batch to finish the batch itself
+BATCH_GAS_RESERVE = 1000
+
 # Get ABI signature
-def mk_full_signature(code):
+def mk_full_signature(code, batch=False):
     o = []
     _defs, _globals = get_defs_and_globals(code)
     for code in _defs:
+        if is_internal(code):
+            continue
         name, args, output_type, const, sig, method_id = get_func_details(code)
         o.append({
             "name": sig,
@@ -352,26 +784,92 @@ def mk_full_signature(code):
             "constant": const,
             "type": "constructor" if name == "__init__" else "function"
         })
+    if batch:
+        o.append({
+            "name": BATCH_SIG,
+            "outputs": [{"type": "bytes32[]", "name": "out"}],
+            "inputs": [{"type": "bytes", "name": "calls"}],
+            "constant": False,
+            "type": "function"
+        })
     return o
-        
+
+# Batch entry point. Takes concatenated records of a method id followed by
+# its arguments, runs each of them through the regular function bodies with
+# a DELEGATECALL to this contract (which keeps msg.sender and storage), and
+# returns the results as a bytes32[] array, one word per call (zero for
+# functions without a return value). Fails if any of the calls fails.
+def make_batch_entry(_defs):
+    details = [get_func_details(_def) for _def in _defs]
+    if 'batch' in [d[0] for d in details]:
+        raise Exception("Function name batch is reserved when batching is enabled")
+    cursor, end, size, index = RESERVED_MEMORY, RESERVED_MEMORY + 32, RESERVED_MEMORY + 64, RESERVED_MEMORY + 96
+    buf = RESERVED_MEMORY + 128
+    out = buf + 32 * (max([get_args_size(d[1]) for d in details]) + 1)
+    # Size of a record, looked up from its method id
+    record_size = ['seq', ['assert', 0], 0]
+    for name, args, output_type, const, sig, method_id in details:
+        record_size = ['if', ['eq', ['div', ['calldataload', ['mload', cursor]], 2**224], method_id],
+                             4 + 32 * get_args_size(args),
+                             record_size]
+    return LLLnode.from_list(['if', ['eq', ['mload', 0], get_method_id(BATCH_SIG)],
+        ['seq',
+            # Every call would see the same msg.value, so it cannot be split up
+            ['assert', ['iszero', ['callvalue']]],
+            ['mstore', cursor, ['add', 36, ['calldataload', 4]]],
+            ['mstore', end, ['add', ['mload', cursor], ['calldataload', ['add', 4, ['calldataload', 4]]]]],
+            ['repeat', index, 0, MAX_BATCH_CALLS,
+                ['seq',
+                    ['if', ['iszero', ['lt', ['mload', cursor], ['mload', end]]], 'break'],
+                    ['mstore', size, record_size],
+                    ['assert', ['iszero', ['gt', ['add', ['mload', cursor], ['mload', size]], ['mload', end]]]],
+                    ['calldatacopy', buf, ['mload', cursor], ['mload', size]],
+                    ['assert', ['delegatecall', ['sub', ['gas'], BATCH_GAS_RESERVE], ['address'],
+                                                buf, ['mload', size],
+                                                ['add', out + 64, ['mul', 32, ['mload', index]]], 32]],
+                    ['mstore', cursor, ['add', ['mload', cursor], ['mload', size]]]]],
+            # Fails if there were more records than MAX_BATCH_CALLS
+            ['assert', ['eq', ['mload', cursor], ['mload', end]]],
+            ['mstore', out, 32],
+            ['mstore', out + 32, ['mload', index]],
+            ['return', out, ['add', 64, ['mul', 32, ['mload', index]]]]]], typ='null')
+
 # Main python parse tree => LLL method
-def parse_tree_to_lll(code):
+def parse_tree_to_lll(code, batch=False):
     _defs, _globals = get_defs_and_globals(code)
     if len(set([_def.name for _def in _defs])) < len(_defs):
         raise Exception("Duplicate function name!")
+    internals = get_internal_funcs(_defs, _globals)
     # Initialization function
     initfunc = [_def for _def in _defs if is_initializer(_def)]
     # Regular functions
-    otherfuncs = [_def for _def in _defs if not is_initializer(_def)]
+    otherfuncs = [_def for _def in _defs if not is_initializer(_def) and not is_internal(_def)]
     if not initfunc and not otherfuncs:
         return LLLnode.from_list('pass')
+    funcs = {}
+    # Frames of internal functions are placed above the memory used by any other function
+    frame_base = RESERVED_MEMORY
+    for _def in initfunc + otherfuncs:
+        _vars = {}
+        funcs[_def.name] = parse_func(_def, _globals, _vars, internals)
+        frame_base = max(frame_base, _vars.get('_next_mem', RESERVED_MEMORY))
+    subroutines = make_internal_defs(get_called_internals(initfunc + otherfuncs, internals), _globals, internals, frame_base)
+    # Each piece of code contains the subroutines it calls, after its last
+    # statement so that they are only ever reached by jumping
+    init_subroutines = [subroutines[name] for name in sorted(get_called_internals(initfunc, internals))]
+    runtime_subroutines = [subroutines[name] for name in sorted(get_called_internals(otherfuncs, internals))]
+    runtime = ['seq', mk_initial()] + [funcs[_def.name] for _def in otherfuncs]
+    if batch and otherfuncs:
+        runtime.append(make_batch_entry(otherfuncs))
+    if runtime_subroutines:
+        runtime += [['stop']] + runtime_subroutines
     if not initfunc and otherfuncs:
-        return LLLnode.from_list(['return', 0, ['lll', ['seq', mk_initial()] + [parse_func(_def, _globals) for _def in otherfuncs], 0]], typ=None)
+        return LLLnode.from_list(['return', 0, ['lll', runtime, 0]], typ=None)
     elif initfunc and not otherfuncs:
-        return LLLnode.from_list(['seq', mk_initial(), parse_func(initfunc[0], _globals), ['selfdestruct']], typ=None)
+        return LLLnode.from_list(['seq', mk_initial(), funcs['__init__'], ['selfdestruct']] + init_subroutines, typ=None)
     elif initfunc and otherfuncs:
-        return LLLnode.from_list(['seq', mk_initial(), parse_func(initfunc[0], _globals),
-                                    ['return', 0, ['lll', ['seq', mk_initial()] + [parse_func(_def, _globals) for _def in otherfuncs], 0]]],
+        return LLLnode.from_list(['seq', mk_initial(), funcs['__init__'],
+                                    ['return', 0, ['lll', runtime, 0]]] + init_subroutines,
                                  typ=None)
     
 # Parse a piece of code
@@ -383,12 +881,35 @@ def parse_body(code, context):
         o.append(parse_stmt(stmt, context))
     return LLLnode.from_list(['seq'] + o)
 
+# Hashes a storage key; keys that are known at compile time are hashed by
+# the compiler instead of with SHA3 at runtime
+def make_sha3_32(sub):
+    if isinstance(sub.value, int):
+        return LLLnode.from_list(int.from_bytes(sha3_256((sub.value % 2**256).to_bytes(32, 'big')), 'big'))
+    return LLLnode.from_list(['sha3_32', sub])
+
+# Adds an offset to a storage key, folding the sum if both are constant
+def make_storage_offset(key, offset, typ):
+    if isinstance(key.value, int) and isinstance(offset.value, int):
+        return LLLnode.from_list((key.value + offset.value) % 2**256, typ=typ, annotation='storage')
+    return LLLnode.from_list(['add', key, offset], typ=typ, annotation='storage')
+
+# Adds a byte offset to a memory address, folding the sum if the address is constant
+def make_memory_offset(addr, offset, typ):
+    if isinstance(addr.value, int):
+        return LLLnode.from_list(addr.value + offset, typ=typ, annotation='memory')
+    return LLLnode.from_list(['add', offset, addr], typ=typ, annotation='memory')
+
 # Parse an expression that represents an address in memory or storage
 def parse_left_expr(expr, context, type_hint=None):
     # Base type
     if isinstance(expr, ast.Name):
         if expr.id == 'self':
             return LLLnode.from_list(['address'], typ='address', annotation=None)
+        # List arguments, which the prologue copies into memory
+        if expr.id in context.args and isinstance(context.args[expr.id][1], ListType):
+            pos, typ = context.args[expr.id]
+            return LLLnode.from_list(pos, typ=typ, annotation='memory')
         # New variable
         if expr.id not in context.vars:
             pos = context.new_variable(expr.id, type_hint)
@@ -413,6 +934,8 @@ def parse_left_expr(expr, context, type_hint=None):
             if expr.attr not in context.globals:
                 raise Exception("Persistent variable undeclared: "+expr.attr)
             pos, typ = context.globals[expr.attr][0],context.globals[expr.attr][1]
+            if expr.attr in context.storage_cache:
+                return LLLnode.from_list(context.storage_cache[expr.attr][0], typ=typ, annotation='memory')
             return LLLnode.from_list(pos, typ=typ, annotation='storage')
         # Reserved keywords
         elif isinstance(expr.value, ast.Name) and expr.value.id in ("msg", "block", "tx"):
@@ -434,39 +957,30 @@ def parse_left_expr(expr, context, type_hint=None):
         # Other variables
         else:
             sub = parse_left_expr(expr.value, context, type_hint)
-            if not isinstance(sub.typ, dict):
+            if not isinstance(sub.typ, StructType):
                 raise Exception("Type mismatch: member variable access not expected")
-            attrs = sorted(sub.typ.keys())
-            if expr.attr not in attrs:
-                raise Exception("Member %s not found. Only the following available: %s" % (expr.attr, " ".join(attrs)))
-            index = attrs.index(expr.attr)
+            if expr.attr not in sub.typ.types:
+                raise Exception("Member %s not found. Only the following available: %s" % (expr.attr, " ".join(sub.typ.names)))
             if sub.annotation == 'storage':
-                return LLLnode.from_list(['add', ['sha3_32', sub], index],
-                                         typ=sub.typ[expr.attr],
-                                         annotation='storage')
+                return make_storage_offset(make_sha3_32(sub), LLLnode.from_list(sub.typ.indexes[expr.attr]), sub.typ.types[expr.attr])
             elif sub.annotation == 'memory':
-                offset = 0
-                for i in range(index):
-                    offset += 32 * get_size_of_type(sub.typ[attrs[i]])
-                return LLLnode.from_list(['add', offset, sub],
-                                         typ=sub.typ[expr.attr],
-                                         annotation='memory')
+                return make_memory_offset(sub, 32 * sub.typ.offsets[expr.attr], sub.typ.types[expr.attr])
             else:
                 raise Exception("Annotation weird: "+sub.annotation)
     # Subscript, eg. x[4]
     elif isinstance(expr, ast.Subscript):
         sub = parse_left_expr(expr.value, context, type_hint)
         index = parse_expr(expr.slice.value, context)
-        if isinstance(sub.typ, list):
-            subtype, itemcount = sub.typ[0], sub.typ[1]
+        if isinstance(sub.typ, ListType):
+            subtype, itemcount = sub.typ.subtype, sub.typ.count
             if sub.annotation == 'storage':
-                return LLLnode.from_list(['add',
-                                            ['sha3_32', sub],
-                                            ['uclamplt', index, itemcount]],
-                                         typ=subtype,
-                                         annotation='storage')
+                if isinstance(index.value, int) and 0 <= index.value < itemcount:
+                    return make_storage_offset(make_sha3_32(sub), index, subtype)
+                return make_storage_offset(make_sha3_32(sub), LLLnode.from_list(['uclamplt', index, itemcount]), subtype)
             elif sub.annotation == 'memory':
                 offset = 32 * get_size_of_type(subtype)
+                if isinstance(index.value, int) and 0 <= index.value < itemcount:
+                    return make_memory_offset(sub, offset * index.value, subtype)
                 return LLLnode.from_list(['add',
                                             ['mul', offset, ['uclamplt', index, itemcount]],
                                             sub],
@@ -474,12 +988,10 @@ def parse_left_expr(expr, context, type_hint=None):
                                           annotation='memory')
             else:
                 raise Exception("Annotation weird: "+sub.annotation)
-        elif isinstance(sub.typ, dict):
+        elif isinstance(sub.typ, MappingType):
             if sub.annotation == 'memory':
                 raise Exception("Cannot use dicts for in-memory types: %r" % sub)
-            return LLLnode.from_list(['add', ['sha3_32', sub], parse_expr(expr.slice.value, context)],
-                                      typ=list(sub.typ.values())[0],
-                                      annotation=sub.annotation)
+            return make_storage_offset(make_sha3_32(sub), index, sub.typ.valuetype)
         else:
             raise Exception("Type mismatch: array access not expected. Expr type: "+repr(sub.typ))
     else:
@@ -489,341 +1001,646 @@ def parse_left_expr(expr, context, type_hint=None):
 def parse_expr(expr, context):
     if isinstance(expr, LLLnode):
         return expr
-    # Numbers (integers or decimals)
-    elif isinstance(expr, ast.Num):
-        if isinstance(expr.n, int):
-            if not (-2**127 + 1 <= expr.n <= 2**127 - 1):
-                raise Exception("Number out of range: "+str(expr.n))
-            return LLLnode.from_list(expr.n, typ='num')
-        elif isinstance(expr.n, float):
-            if not (-2**127 + 1 <= expr.n <= 2**127 - 1):
-                raise Exception("Number out of range: "+str(expr.n))
-            return LLLnode.from_list(int(expr.n * DECIMAL_DIVISOR), typ='decimal')
-    # Addresses and bytes32 objects
-    elif isinstance(expr, ast.Str):
-        if len(expr.s) == 42 and expr.s[:2] == '0x':
-            return LLLnode.from_list(hex_to_int(expr.s), typ='address')
-        elif len(expr.s) == 66 and expr.s[:2] == '0x':
-            return LLLnode.from_list(hex_to_int(expr.s), typ='bytes32')
-        else:
-            raise Exception("Unsupported bytes: "+expr.s)
-    # Variable names
-    elif isinstance(expr, ast.Name):
-        if expr.id == 'self':
-            return LLLnode.from_list(['address'], typ='address')
-        if expr.id in context.args:
-            dataloc, typ = context.args[expr.id]
-            if dataloc >= 0:
-                data_decl = ['calldataload', dataloc]
-            else:
-                data_decl = ['seq', ['codecopy', 192, ['sub', ['codesize'], -dataloc], 32], ['mload', 192]]
-            if typ == 'num':
-                return LLLnode.from_list(['clamp', ['mload', MINNUM_POS], data_decl, ['mload', MAXNUM_POS]], typ='num')
-            elif typ == 'bool':
-                return LLLnode.from_list(['uclamplt', data_decl, 2], typ='bool')
-            elif typ == 'address':
-                return LLLnode.from_list(['uclamplt', data_decl, ['mload', ADDRSIZE_POS]], typ='address')
-            elif typ == 'num256' or typ == 'signed256' or typ == 'bytes32':
-                return LLLnode.from_list(data_decl, typ=typ)
-            else:
-                raise Exception("Unsupported type: "+typ)
-        elif expr.id in context.vars:
-            dataloc, typ = context.vars[expr.id]
-            return LLLnode.from_list(['mload', dataloc], typ=typ)
-        else:
-            raise Exception("Undeclared variable: "+expr.id)
-    # x.y or x[5]
-    elif isinstance(expr, (ast.Subscript, ast.Attribute)):
-        o = parse_left_expr(expr, context)
-        if o.annotation == 'memory':
-            return LLLnode.from_list(['mload', o], typ=o.typ)
-        elif o.annotation == 'storage':
-            return LLLnode.from_list(['sload', o], typ=o.typ)
-        else:
-            return o
-    # Arithmetic operations
-    elif isinstance(expr, ast.BinOp):
-        left = parse_expr(expr.left, context)
-        right = parse_expr(expr.right, context)
-        for typ in (left.typ, right.typ):
-            if typ not in ('num', 'decimal'):
-                raise Exception("Invalid type for arithmetic op: "+typ)
-        if isinstance(expr.op, (ast.Add, ast.Sub)):
-            op = 'add' if isinstance(expr.op, ast.Add) else 'sub'
-            if left.typ == right.typ:
-                o = LLLnode.from_list([op, left, right], typ=left.typ)
-            elif left.typ == 'num' and right.typ == 'decimal':
-                o = LLLnode.from_list([op, ['mul', left, DECIMAL_DIVISOR], right], typ='decimal')
-            elif right.typ == 'decimal' and right.typ == 'num':
-                o = LLLnode.from_list([op, left, ['mul', right, DECIMAL_DIVISOR]], typ='decimal')
-        elif isinstance(expr.op, ast.Mult):
-            if left.typ == right.typ == 'num':
-                o = LLLnode.from_list(['mul', left, right], typ='num')
-            elif left.typ == right.typ == 'decimal':
-                o = LLLnode.from_list(['with', 'r', right, ['with', 'l', left,
-                                        ['with', 'ans', ['mul', 'l', 'r'],
-                                            ['seq',
-                                                ['assert', ['or', ['eq', ['sdiv', 'ans', 'l'], 'r'], ['not', 'l']]],
-                                                ['sdiv', 'ans', DECIMAL_DIVISOR]]]]], typ='decimal')
-            elif (left.typ == 'num' and right.typ == 'decimal') or (left.typ == 'decimal' and right.typ == 'num'):
-                o = LLLnode.from_list(['with', 'r', right, ['with', 'l', left,
-                                        ['with', 'ans', ['mul', 'l', 'r'],
-                                            ['seq',
-                                                ['assert', ['or', ['eq', ['sdiv', 'ans', 'l'], 'r'], ['not', 'l']]],
-                                                'ans']]]], typ='decimal')
-        elif isinstance(expr.op, ast.Div):
-            if right.typ == 'num':
-                o = LLLnode.from_list(['sdiv', left, ['clamp_nonzero', right]], typ=left.typ)
-            elif left.typ == right.typ == 'decimal':
-                o = LLLnode.from_list(['with', 'l', left, ['with', 'r', ['clamp_nonzero', right],
-                                            ['sdiv', ['mul', 'l', DECIMAL_DIVISOR], 'r']]],
-                                      typ='decimal')
-            elif left.typ == 'num' and right.typ == 'decimal':
-                o = LLLnode.from_list(['sdiv', ['mul', left, DECIMAL_DIVISOR ** 2], ['clamp_nonzero', right]], typ='decimal')
-        elif isinstance(expr.op, ast.Mod):
-            if left.typ == right.typ:
-                o = LLLnode.from_list(['smod', left, ['clamp_nonzero', right]], typ=left.typ)
-            elif left.typ == 'decimal' and right.typ == 'num':
-                o = LLLnode.from_list(['smod', left, ['mul', ['clamp_nonzero', right], DECIMAL_DIVISOR]], typ='decimal')
-            elif left.typ == 'num' and right.typ == 'decimal':
-                o = LLLnode.from_list(['smod', ['mul', left, DECIMAL_DIVISOR], right], typ='decimal')
-        else:
-            raise Exception("Unsupported binop: %r" % expr.op)
-    # Comparison operations
-    elif isinstance(expr, ast.Compare):
-        left = parse_expr(expr.left, context)
-        right = parse_expr(expr.comparators[0], context)
-        if len(expr.ops) != 1:
-            raise Exception("Cannot have a comparison with more than two elements")
-        if isinstance(expr.ops[0], ast.Gt):
-            op = 'sgt'
-        elif isinstance(expr.ops[0], ast.GtE):
-            op = 'sge'
-        elif isinstance(expr.ops[0], ast.LtE):
-            op = 'sle'
-        elif isinstance(expr.ops[0], ast.Lt):
-            op = 'slt'
-        elif isinstance(expr.ops[0], ast.Eq):
-            op = 'eq'
-        elif isinstance(expr.ops[0], ast.NotEq):
-            op = 'ne'
-        else:
-            raise Exception("Unsupported comparison operator")
-        for typ in (left.typ, right.typ):
-            if typ not in ('num', 'decimal'):
-                if op not in ('eq', 'ne'):
-                    raise Exception("Invalid type for comparison op: "+typ)
+    handler = expr_handlers.get(type(expr))
+    if handler is None:
+        raise Exception("Unsupported operator: %r" % ast.dump(expr))
+    return handler(expr, context)
+
+# Numbers (integers or decimals)
+def parse_num(expr, context):
+    if isinstance(expr.n, int):
+        if not (-2**127 + 1 <= expr.n <= 2**127 - 1):
+            raise Exception("Number out of range: "+str(expr.n))
+        return LLLnode.from_list(expr.n, typ='num')
+    elif isinstance(expr.n, float):
+        if not (-2**127 + 1 <= expr.n <= 2**127 - 1):
+            raise Exception("Number out of range: "+str(expr.n))
+        return LLLnode.from_list(int(expr.n * DECIMAL_DIVISOR), typ='decimal')
+    else:
+        raise Exception("Unsupported number: %r" % expr.n)
+
+# Addresses and bytes32 objects
+def parse_str(expr, context):
+    if len(expr.s) == 42 and expr.s[:2] == '0x':
+        return LLLnode.from_list(hex_to_int(expr.s), typ='address')
+    elif len(expr.s) == 66 and expr.s[:2] == '0x':
+        return LLLnode.from_list(hex_to_int(expr.s), typ='bytes32')
+    else:
+        raise Exception("Unsupported bytes: "+expr.s)
+
+# Variable names
+def parse_name(expr, context):
+    if expr.id == 'self':
+        return LLLnode.from_list(['address'], typ='address')
+    if expr.id in context.args:
+        # Arguments are validated and copied to memory by the prologue
+        dataloc, typ = context.args[expr.id]
+        return LLLnode.from_list(['mload', dataloc], typ=typ)
+    elif expr.id in context.vars:
+        dataloc, typ = context.vars[expr.id]
+        return LLLnode.from_list(['mload', dataloc], typ=typ)
+    else:
+        raise Exception("Undeclared variable: "+expr.id)
+
+# x.y or x[5]
+def parse_variable_access(expr, context):
+    o = parse_left_expr(expr, context)
+    if o.annotation == 'memory':
+        return LLLnode.from_list(['mload', o], typ=o.typ)
+    elif o.annotation == 'storage':
+        return LLLnode.from_list(['sload', o], typ=o.typ)
+    else:
+        return o
+
+# Arithmetic operations
+def parse_binop(expr, context):
+    left = parse_expr(expr.left, context)
+    right = parse_expr(expr.right, context)
+    for typ in (left.typ, right.typ):
+        if typ not in ('num', 'decimal'):
+            raise Exception("Invalid type for arithmetic op: "+typ)
+    op = type(expr.op)
+    if op in (ast.Add, ast.Sub):
+        op = 'add' if op is ast.Add else 'sub'
         if left.typ == right.typ:
-            o = LLLnode.from_list([op, left, right], typ='bool')
+            o = LLLnode.from_list([op, left, right], typ=left.typ)
+        elif left.typ == 'num' and right.typ == 'decimal':
+            o = LLLnode.from_list([op, make_decimal(left), right], typ='decimal')
         elif left.typ == 'decimal' and right.typ == 'num':
-            o = LLLnode.from_list([op, left, ['mul', right, DECIMAL_DIVISOR]], typ='bool')
+            o = LLLnode.from_list([op, left, make_decimal(right)], typ='decimal')
+    # Decimal multiplication, division and modulo use the dmul, ddiv and
+    # dmod pseudo-opcodes, which check for overflow and clamp their result
+    elif op is ast.Mult:
+        if left.typ == right.typ == 'num':
+            o = LLLnode.from_list(['mul', left, right], typ='num')
+        elif left.typ == right.typ == 'decimal':
+            o = LLLnode.from_list(['dmul', left, right], typ='decimal')
         elif left.typ == 'num' and right.typ == 'decimal':
-            o = LLLnode.from_list([op, ['mul', left, DECIMAL_DIVISOR], right], typ='bool')
-        else:
-            raise Exception("Unsupported types for comparison: %r %r" % (left.typ, right.typ))
-    # Boolean logical operations
-    elif isinstance(expr, ast.BoolOp):
-        if len(expr.values) != 2:
-            raise Exception("Expected two arguments for a bool op")
-        left = parse_expr(expr.values[0], context)
-        right = parse_expr(expr.values[1], context)
-        if left.typ != 'bool' or right.typ != 'bool':
+            o = LLLnode.from_list(['dmul', make_decimal(left), right], typ='decimal')
+        elif left.typ == 'decimal' and right.typ == 'num':
+            o = LLLnode.from_list(['dmul', left, make_decimal(right)], typ='decimal')
+    elif op is ast.Div:
+        if right.typ == 'num':
+            o = LLLnode.from_list(['sdiv', left, ['clamp_nonzero', right]], typ=left.typ)
+        elif left.typ == right.typ == 'decimal':
+            o = LLLnode.from_list(['ddiv', left, right], typ='decimal')
+        elif left.typ == 'num' and right.typ == 'decimal':
+            o = LLLnode.from_list(['ddiv', make_decimal(left), right], typ='decimal')
+    elif op is ast.Mod:
+        if left.typ == right.typ == 'num':
+            o = LLLnode.from_list(['smod', left, ['clamp_nonzero', right]], typ='num')
+        elif left.typ == right.typ == 'decimal':
+            o = LLLnode.from_list(['dmod', left, right], typ='decimal')
+        elif left.typ == 'decimal' and right.typ == 'num':
+            o = LLLnode.from_list(['dmod', left, make_decimal(right)], typ='decimal')
+        elif left.typ == 'num' and right.typ == 'decimal':
+            o = LLLnode.from_list(['dmod', make_decimal(left), right], typ='decimal')
+    else:
+        raise Exception("Unsupported binop: %r" % expr.op)
+    return make_clamp(o)
+
+# Comparison operators and the opcodes they map to
+compare_ops = {
+    ast.Gt: 'sgt',
+    ast.GtE: 'sge',
+    ast.LtE: 'sle',
+    ast.Lt: 'slt',
+    ast.Eq: 'eq',
+    ast.NotEq: 'ne',
+}
+
+# Comparison operations
+def parse_compare(expr, context):
+    left = parse_expr(expr.left, context)
+    right = parse_expr(expr.comparators[0], context)
+    if len(expr.ops) != 1:
+        raise Exception("Cannot have a comparison with more than two elements")
+    op = compare_ops.get(type(expr.ops[0]))
+    if op is None:
+        raise Exception("Unsupported comparison operator")
+    for typ in (left.typ, right.typ):
+        if typ not in ('num', 'decimal'):
+            if op not in ('eq', 'ne'):
+                raise Exception("Invalid type for comparison op: "+typ)
+    if left.typ == right.typ:
+        return LLLnode.from_list([op, left, right], typ='bool')
+    elif left.typ == 'decimal' and right.typ == 'num':
+        return LLLnode.from_list([op, left, make_decimal(right)], typ='bool')
+    elif left.typ == 'num' and right.typ == 'decimal':
+        return LLLnode.from_list([op, make_decimal(left), right], typ='bool')
+    else:
+        raise Exception("Unsupported types for comparison: %r %r" % (left.typ, right.typ))
+
+# Operations that are cheap and cannot fail, so that an operand built only
+# from them may be evaluated even when its value is not needed
+cheap_ops = frozenset(['mload', 'iszero', 'eq', 'lt', 'gt', 'slt', 'sgt', 'address',
+                       'caller', 'callvalue', 'origin', 'timestamp', 'number'])
+
+# Is an operand cheaper to evaluate than to jump over?
+def is_cheap_operand(node, limit=5):
+    nodes = [node]
+    for sub in nodes:
+        if len(nodes) > limit or not (isinstance(sub.value, int) or sub.value in cheap_ops):
+            return False
+        nodes.extend(sub.args)
+    return True
+
+# Boolean logical operations. These short-circuit: the operands are lowered
+# to conditional jumps, so that each operand is only evaluated when the
+# result is not yet known. Cheap operands are combined with bitwise and/or
+# instead, since that costs less than a jump
+def parse_boolop(expr, context):
+    if len(expr.values) < 2:
+        raise Exception("Expected at least two arguments for a bool op")
+    values = [parse_expr(value, context) for value in expr.values]
+    for value in values:
+        if value.typ != 'bool':
             raise Exception("Boolean operations can only be between booleans!")
-        if isinstance(expr.op, ast.And):
-            op = 'and'
-        elif isinstance(expr.op, ast.Or):
-            op = 'or'
+    if not isinstance(expr.op, (ast.And, ast.Or)):
+        raise Exception("Unsupported bool op: %r" % expr.op)
+    o = values[-1]
+    for value in values[-2::-1]:
+        if is_cheap_operand(o):
+            o = LLLnode.from_list(['and' if isinstance(expr.op, ast.And) else 'or', value, o], typ='bool')
+        elif isinstance(expr.op, ast.And):
+            o = LLLnode.from_list(['if', value, o, 0], typ='bool')
         else:
-            raise Exception("Unsupported bool op: "+expr.op)
-        o = LLLnode.from_list([op, left, right], typ='bool')
-    # Unary operations (only "not" supported)
-    elif isinstance(expr, ast.UnaryOp):
-        operand = parse_expr(expr.operand, context)
-        if not isinstance(expr.op, ast.Not):
-            raise Exception("Only the 'not' unary operator is supported")
-        # Note that in the case of bool, num, address, decimal, num256 AND bytes32,
-        # a zero entry represents false, all others represent true
-        o = LLLnode.from_list(["iszero", operand], typ='bool')
-    # Function calls
-    elif isinstance(expr, ast.Call): 
-        if isinstance(expr.func, ast.Name) and expr.func.id == 'floor':
-            if len(expr.args) != 1:
-                raise Exception("Floor expects 1 argument!")
-            sub = parse_expr(expr.args[0], context)
-            if sub.typ in ('num', 'num256', 'signed256'):
-                return sub
-            elif sub.typ == 'decimal':
-                return LLLnode.from_list(['sdiv', sub, DECIMAL_DIVISOR], typ='num')
-            else:
-                raise Exception("Bad type for argument to floor: %r" % sub.typ)
-        elif isinstance(expr.func, ast.Name) and expr.func.id == 'decimal':
-            if len(expr.args) != 1:
-                raise Exception("Decimal expects 1 argument!")
-            sub = parse_expr(expr.args[0], context)
-            if sub.typ == 'decimal':
-                return sub
-            elif sub.typ == 'num':
-                return LLLnode.from_list(['mul', sub, DECIMAL_DIVISOR], typ='decimal')
-            else:
-                raise Exception("Bad type for argument to decimal: %r" % sub.typ)
+            o = LLLnode.from_list(['if', value, 1, o], typ='bool')
+    return o
+
+# Unary operations (only "not" supported)
+def parse_unaryop(expr, context):
+    operand = parse_expr(expr.operand, context)
+    if not isinstance(expr.op, ast.Not):
+        raise Exception("Only the 'not' unary operator is supported")
+    # Note that in the case of bool, num, address, decimal, num256 AND bytes32,
+    # a zero entry represents false, all others represent true
+    return LLLnode.from_list(["iszero", operand], typ='bool')
+
+# Function calls
+def parse_call(expr, context):
+    if isinstance(expr.func, ast.Name) and expr.func.id == 'floor':
+        if len(expr.args) != 1:
+            raise Exception("Floor expects 1 argument!")
+        sub = parse_expr(expr.args[0], context)
+        if sub.typ in ('num', 'num256', 'signed256'):
+            return sub
+        elif sub.typ == 'decimal':
+            return LLLnode.from_list(['sdiv', sub, DECIMAL_DIVISOR], typ='num')
+        else:
+            raise Exception("Bad type for argument to floor: %r" % sub.typ)
+    elif isinstance(expr.func, ast.Name) and expr.func.id == 'decimal':
+        if len(expr.args) != 1:
+            raise Exception("Decimal expects 1 argument!")
+        sub = parse_expr(expr.args[0], context)
+        if sub.typ == 'decimal':
+            return sub
+        elif sub.typ == 'num':
+            return make_decimal(sub)
         else:
-            raise Exception("Unsupported operator: %r" % ast.dump(expr))
+            raise Exception("Bad type for argument to decimal: %r" % sub.typ)
+    elif is_internal_call(expr):
+        return make_internal_call(expr, context)
     else:
         raise Exception("Unsupported operator: %r" % ast.dump(expr))
-    # Clamp based on variable type
-    if o.typ == 'bool':
-        return o
-    elif o.typ == 'num':
+
+# Converts an argument or return value of an internal function to its
+# declared type; nums are also accepted for num256 and signed256 values
+def make_internal_value(sub, typ):
+    if sub.typ == 'num' and typ == 'signed256':
+        return LLLnode(sub.value, sub.args, typ, sub.annotation)
+    elif sub.typ == 'num' and typ == 'num256':
+        return LLLnode.from_list(['with', '_v', sub, ['seq', ['assert', ['iszero', ['slt', '_v', 0]]], '_v']], typ=typ)
+    return type_conversion(sub, sub.typ, typ)
+
+# Call to an internal function, eg. self.foo(x). Arguments are passed on the
+# stack. If the function may send, cached persistent variables are written
+# out before and reloaded after, as for a send
+def make_internal_call(expr, context):
+    if expr.func.attr not in context.internals:
+        raise Exception("Not an internal function: %s" % expr.func.attr)
+    func = context.internals[expr.func.attr]
+    if len(expr.args) != len(func.args) or expr.keywords:
+        raise Exception("%s expects %d arguments" % (func.name, len(func.args)))
+    args = []
+    for arg, (argname, typ) in zip(expr.args, func.args):
+        args.append(make_internal_value(parse_expr(arg, context), typ))
+    o = ['internal_call', func.label, 0 if func.output_type is None else 1] + args
+    if func.sends and context.storage_cache:
+        if func.output_type is None:
+            o = ['seq', make_storage_writeback(context), o, make_storage_reload(context)]
+        else:
+            o = ['seq', make_storage_writeback(context), ['with', '_ret', o, ['seq', make_storage_reload(context), '_ret']]]
+    return LLLnode.from_list(o, typ=func.output_type)
+
+# Expression node type -> function that lowers it to LLL
+expr_handlers = {
+    ast.Num: parse_num,
+    ast.Str: parse_str,
+    ast.Name: parse_name,
+    ast.Subscript: parse_variable_access,
+    ast.Attribute: parse_variable_access,
+    ast.BinOp: parse_binop,
+    ast.Compare: parse_compare,
+    ast.BoolOp: parse_boolop,
+    ast.UnaryOp: parse_unaryop,
+    ast.Call: parse_call,
+}
+
+# Clamp based on variable type
+def make_clamp(o):
+    if o.typ == 'num':
         return LLLnode.from_list(['clamp', ['mload', MINNUM_POS], o, ['mload', MAXNUM_POS]], typ='num')
+    elif o.typ == 'decimal' and o.value in ('dmul', 'ddiv', 'dmod'):
+        return o
     elif o.typ == 'decimal':
         return LLLnode.from_list(['clamp', ['mload', MINDECIMAL_POS], o, ['mload', MAXDECIMAL_POS]], typ='decimal')
     else:
         return o
 
+# Converts a num into a decimal, scaling constants at compile time
+def make_decimal(orig):
+    if isinstance(orig.value, int):
+        return LLLnode.from_list(orig.value * DECIMAL_DIVISOR, typ='decimal')
+    return LLLnode.from_list(['mul', orig, DECIMAL_DIVISOR], typ='decimal')
 
 # Convert from one type to another
 def type_conversion(orig, frm, to):
-    if frm == to and not isinstance(frm, (list, dict)):
+    if frm == to and not isinstance(frm, CompoundType):
         return orig
     elif frm == 'num' and to == 'decimal':
-        return LLLnode.from_list(['mul', orig, DECIMAL_DIVISOR])
-    elif isinstance(frm, (list, dict)):
+        return make_decimal(orig)
+    elif isinstance(frm, CompoundType):
         raise Exception("Directly setting non-atomic types is not supported")
     else:
         raise Exception("Typecasting from %r to %r unavailable" % (frm, to))
 
+# Largest compound value (in words) copied with a straight sequence of loads
+# and stores; larger values are copied with a loop, or as one block with the
+# identity precompile when both sides are in memory
+MAX_UNROLLED_COPY_WORDS = 8
+
+IDENTITY_PRECOMPILE = 4
+
+# The same node with another type and annotation
+def with_type(node, typ, annotation):
+    return LLLnode(node.value, node.args, typ, annotation)
+
+# Location of a compound value read by an expression, eg. the memory address
+# of x for the ['mload', x] of a variable
+def get_compound_location(sub):
+    if isinstance(sub.typ, MappingType):
+        raise Exception("Cannot copy a mapping")
+    if sub.value == 'mload':
+        return with_type(sub.args[0], sub.typ, 'memory')
+    elif sub.value == 'sload':
+        return with_type(sub.args[0], sub.typ, 'storage')
+    raise Exception("Cannot copy %r" % sub)
+
+# Where the members of a compound value are found from: its address in
+# memory, or the hash of its key in storage
+def get_member_base(loc):
+    base = make_sha3_32(loc) if loc.annotation == 'storage' else loc
+    return with_type(base, loc.typ, loc.annotation)
+
+# Location of a member of a compound value, given its base (see
+# get_member_base), by struct member name or list index, which may be an
+# LLL expression
+def get_member_location(base, key):
+    if isinstance(base.typ, StructType):
+        subtype = base.typ.types[key]
+        offset = 32 * base.typ.offsets[key] if base.annotation == 'memory' else base.typ.indexes[key]
+    else:
+        subtype = base.typ.subtype
+        if base.annotation == 'storage':
+            offset = key
+        elif isinstance(key, int):
+            offset = 32 * get_size_of_type(subtype) * key
+        else:
+            offset = ['mul', 32 * get_size_of_type(subtype), key]
+    if offset == 0:
+        return with_type(base, subtype, base.annotation)
+    elif base.annotation == 'storage':
+        return make_storage_offset(base, LLLnode.from_list(offset), subtype)
+    elif isinstance(offset, int):
+        return make_memory_offset(base, offset, subtype)
+    return LLLnode.from_list(['add', offset, base], typ=subtype, annotation='memory')
+
+# Evaluates the locations once, binding those that are not constant to with
+# variables, and passes them on to make_body
+def with_locations(locs, make_body, i=0):
+    if i == len(locs):
+        return make_body(locs)
+    loc = locs[i]
+    if not loc.args:
+        return with_locations(locs, make_body, i + 1)
+    name = mk_with_var('loc')
+    locs = locs[:i] + [with_type(LLLnode(name), loc.typ, loc.annotation)] + locs[i + 1:]
+    return LLLnode.from_list(['with', name, loc, with_locations(locs, make_body, i + 1)], typ=None)
+
+def make_load(loc):
+    return LLLnode.from_list(['mload' if loc.annotation == 'memory' else 'sload', loc], typ=loc.typ)
+
+def make_store(loc, sub):
+    return LLLnode.from_list(['mstore' if loc.annotation == 'memory' else 'sstore', loc, sub], typ=None)
+
+# Copies a compound value from one location to another of the same type.
+# Memory values are contiguous, so they are copied as a block of words;
+# storage values are spread over hashed keys, so they are copied member by
+# member, with a loop over the elements of long lists
+def make_setter(left, right, context):
+    if left.typ != right.typ:
+        raise Exception("Typecasting from %r to %r unavailable" % (right.typ, left.typ))
+    if not isinstance(left.typ, CompoundType):
+        return make_store(left, make_load(right))
+    size = get_size_of_type(left.typ)
+    if left.annotation == right.annotation == 'memory':
+        if size > MAX_UNROLLED_COPY_WORDS:
+            return with_locations([left, right], lambda locs: LLLnode.from_list(
+                ['assert', ['call', ['gas'], IDENTITY_PRECOMPILE, 0, locs[1], 32 * size, locs[0], 32 * size]], typ=None))
+        # Copied word by word, as if both were lists of words
+        words = [with_type(loc, ListType('num', size), 'memory') for loc in (left, right)]
+        return with_locations(words, lambda locs: LLLnode.from_list(
+            ['seq'] + [make_store(get_member_location(locs[0], i), make_load(get_member_location(locs[1], i))) for i in range(size)], typ=None))
+    if isinstance(left.typ, StructType):
+        keys = left.typ.names
+    elif size <= MAX_UNROLLED_COPY_WORDS:
+        keys = range(left.typ.count)
+    else:
+        index = context.reserve_memory(32)
+        return with_locations([get_member_base(left), get_member_base(right)], lambda locs: LLLnode.from_list(
+            ['repeat', index, 0, left.typ.count,
+             make_setter(get_member_location(locs[0], ['mload', index]), get_member_location(locs[1], ['mload', index]), context)], typ=None))
+    return with_locations([get_member_base(left), get_member_base(right)], lambda locs: LLLnode.from_list(
+        ['seq'] + [make_setter(get_member_location(locs[0], key), get_member_location(locs[1], key), context) for key in keys], typ=None))
+
 
 # Parse a statement (usually one line of code but not always)
 def parse_stmt(stmt, context):
-    if isinstance(stmt, ast.Expr):
-        return parse_stmt(stmt.value, context)
-    elif isinstance(stmt, ast.Pass):
+    handler = stmt_handlers.get(type(stmt))
+    if handler is None:
+        raise Exception("Unsupported statement type: %r" % ast.dump(stmt))
+    return handler(stmt, context)
+
+# Is an expression a type, as in a declaration like x = num[5]?
+def is_type_declaration(item):
+    if isinstance(item, ast.Name):
+        return item.id in type_names
+    elif isinstance(item, ast.Subscript):
+        return is_type_declaration(item.value)
+    return isinstance(item, (ast.List, ast.Dict))
+
+# Expressions used as statements, eg. send(x, 5)
+def parse_expr_stmt(stmt, context):
+    return parse_stmt(stmt.value, context)
+
+# Pass statement
+def parse_pass(stmt, context):
+    return LLLnode.from_list('pass', typ=None)
+
+# Assignment, either declaring a new variable or storing a value
+def parse_assign(stmt, context):
+    if len(stmt.targets) != 1:
+        raise Exception("Assignment statement must have one target")
+    # Declaration of a new variable (eg. x = num[4])
+    if is_type_declaration(stmt.value):
+        typ = parse_type(stmt.value, annotation='memory')
+        if not isinstance(stmt.targets[0], ast.Name):
+            raise Exception("Can only assign a variable to a new type")
+        context.new_variable(stmt.targets[0].id, typ)
         return LLLnode.from_list('pass', typ=None)
-    elif isinstance(stmt, ast.Assign):
-        # Assignment (eg. x[4] = y)
-        if len(stmt.targets) != 1:
-            raise Exception("Assignment statement must have one target")
-        try:
-            typ = parse_type(stmt.value, annotation='memory')
-            if not isinstance(stmt.targets[0], ast.Name):
-                raise Exception("Can only assign a variable to a new type")
-            varname = stmt.targets[0].id
-            pos = context.new_variable(varname, typ)
-            return LLLnode.from_list('pass', typ=None)
-        except InvalidTypeException:
-            sub = parse_expr(stmt.value, context)
-            target = parse_left_expr(stmt.targets[0], context, type_hint=sub.typ)
-            sub = type_conversion(sub, sub.typ, target.typ)
-            if target.annotation == 'storage':
-                return LLLnode.from_list(['sstore', target, sub], typ=None)
-            elif target.annotation == 'memory':
-                return LLLnode.from_list(['mstore', target, sub], typ=None)
-    # If statements
-    elif isinstance(stmt, ast.If):
-        if stmt.orelse:
-            return LLLnode.from_list(['if',
-                                      parse_expr(stmt.test, context),
-                                      parse_body(stmt.body, context),
-                                      parse_body(stmt.orelse[0], context)], typ=None)
+    # Assignment (eg. x[4] = y)
+    sub = parse_expr(stmt.value, context)
+    target = parse_left_expr(stmt.targets[0], context, type_hint=sub.typ)
+    # Copy of a whole array or struct (eg. x = self.y)
+    if isinstance(sub.typ, CompoundType):
+        if target.annotation not in ('memory', 'storage'):
+            raise Exception("Cannot assign to %s" % ast.dump(stmt.targets[0]))
+        return make_setter(target, get_compound_location(sub), context)
+    sub = type_conversion(sub, sub.typ, target.typ)
+    if target.annotation == 'storage':
+        return LLLnode.from_list(['sstore', target, sub], typ=None)
+    elif target.annotation == 'memory':
+        return LLLnode.from_list(['mstore', target, sub], typ=None)
+    else:
+        raise Exception("Cannot assign to %s" % ast.dump(stmt.targets[0]))
+
+# If statements, including elif chains
+def parse_if(stmt, context):
+    chain = get_constant_chain(stmt)
+    if chain is not None and len(chain[1]) >= MIN_DECISION_TREE_ARMS:
+        scrutinee = parse_expr(chain[0], context)
+        if scrutinee.typ == 'num':
+            return make_decision_tree(scrutinee, chain[1], chain[2], context)
+    if stmt.orelse:
+        return LLLnode.from_list(['if',
+                                  parse_expr(stmt.test, context),
+                                  parse_body(stmt.body, context),
+                                  parse_body(stmt.orelse, context)], typ=None)
+    else:
+        return LLLnode.from_list(['if',
+                                  parse_expr(stmt.test, context),
+                                  parse_body(stmt.body, context)], typ=None)
+
+# Chains of at least this many arms comparing one expression against
+# constants, eg. if x == 1: ... elif x == 2: ..., become decision trees
+MIN_DECISION_TREE_ARMS = 3
+
+# Largest else clause (in LLL nodes) that may be copied into several
+# leaves of a decision tree
+MAX_COPIED_DEFAULT_SIZE = 12
+
+# Can an expression be evaluated once instead of once per test?
+def is_simple_scrutinee(expr):
+    return not any(isinstance(sub, ast.Call) for sub in ast.walk(expr))
+
+# Finds the longest prefix of an if/elif chain whose tests compare the same
+# expression with distinct integer constants. Returns (expression, [(constant,
+# body)], remaining else clause), or None if the first test doesn't qualify
+def get_constant_chain(stmt):
+    scrutinee, cases, seen = None, [], set()
+    while True:
+        test = stmt.test
+        if not isinstance(test, ast.Compare) or len(test.ops) != 1 or not isinstance(test.ops[0], ast.Eq):
+            break
+        left, right = test.left, test.comparators[0]
+        if isinstance(left, ast.Num):
+            left, right = right, left
+        # Constants outside the num range end the chain, so that the plain
+        # if statement reports them the way it would anywhere else
+        if not isinstance(right, ast.Num) or not isinstance(right.n, int) or right.n in seen or \
+                not (-2**127 + 1 <= right.n <= 2**127 - 1):
+            break
+        if scrutinee is None:
+            if not is_simple_scrutinee(left):
+                break
+            scrutinee = left
+        elif ast.dump(left) != ast.dump(scrutinee):
+            break
+        cases.append((right.n, stmt.body))
+        seen.add(right.n)
+        if len(stmt.orelse) == 1 and isinstance(stmt.orelse[0], ast.If):
+            stmt = stmt.orelse[0]
         else:
-            return LLLnode.from_list(['if',
-                                      parse_expr(stmt.test, context),
-                                      parse_body(stmt.body, context)], typ=None)
-    # Calls
-    elif isinstance(stmt, ast.Call):
-        if not isinstance(stmt.func, ast.Name):
-            raise Exception("Function call must be one of: send, selfdestruct")
-        if stmt.func.id == 'send':
-            if len(stmt.args) != 2:
-                raise Exception("Send expects 2 arguments!")
-            to = parse_expr(stmt.args[0], context)
-            if to.typ != "address":
-                raise Exception("Need to send to address")
-            value = parse_expr(stmt.args[1], context)
-            if value.typ != "num" and value.typ != "num256" and value.typ != "decimal":
-                raise Exception("Send value must be a number!")
-            if value.typ == "decimal":
-                return LLLnode.from_list(['pop', ['call', 0, to, ['div', value, DECIMAL_DIVISOR], 0, 0, 0, 0]], typ=None)
-            else:
-                return LLLnode.from_list(['pop', ['call', 0, to, value, 0, 0, 0, 0]], typ=None)
-        elif stmt.func.id in ('suicide', 'selfdestruct'):
-            if len(stmt.args) != 1:
-                raise Exception("%s expects 1 argument!" % stmt.func.id)
-            sub = parse_expr(stmt.args[0], context)
-            if sub.typ != "address":
-                raise Exception("Must %s to an address!" % stmt.func.id)
-            return LLLnode.from_list(['selfdestruct', sub], typ=None)
-            
-    elif isinstance(stmt, ast.Assert):
-        return LLLnode.from_list(['assert', parse_expr(stmt.test, context)], typ=None)
-    # for i in range(n): ... (note: n must be a nonzero positive constant integer)
-    elif isinstance(stmt, ast.For):
-        if not isinstance(stmt.iter, ast.Call) or \
-                not isinstance(stmt.iter.func, ast.Name) or \
-                not isinstance(stmt.target, ast.Name) or \
-                stmt.iter.func.id != "range" or \
-                len(stmt.iter.args) not in (1, 2):
-            raise Exception("For statements must be of the form `for i in range(rounds): ..` or `for i in range(start, start + rounds): ..`")
-        # Type 1 for, eg. for i in range(10): ...
-        if len(stmt.iter.args) == 1:
-            if not isinstance(stmt.iter.args[0], ast.Num):
-                raise Exception("Repeat must have a nonzero positive integral number of rounds")
-            start = LLLnode.from_list(0, typ='num')
-            rounds = stmt.iter.args[0].n
-        elif len(stmt.iter.args) == 2:
-            if isinstance(stmt.iter.args[0], ast.Num) and isinstance(stmt.iter.args[1], ast.Num):
-                # Type 2 for, eg. for i in range(100, 110): ...
-                start = LLLnode.from_list(stmt.iter.args[0].n, typ='num')
-                rounds = LLLnode.from_list(stmt.iter.args[1].n - stmt.iter.args[0].n, typ='num')
-            else:
-                # Type 3 for, eg. for i in range(x, x + 10): ...
-                if not isinstance(stmt.iter.args[1], ast.BinOp) or not isinstance(stmt.iter.args[1].op, ast.Add):
-                    raise Exception("Two-arg for statements must be of the form `for i in range(start, start + rounds): ...`")
-                if ast.dump(stmt.iter.args[0]) != ast.dump(stmt.iter.args[1].left):
-                    raise Exception("Two-arg for statements of the form `for i in range(x, x + y): ...` must have x identical in both places: %r %r" % (ast.dump(stmt.iter.args[0]), ast.dump(stmt.iter.args[1].left)))
-                if not isinstance(stmt.iter.args[1].right, ast.Num):
-                    raise Exception("Repeat must have a nonzero positive integral number of rounds")
-                start = parse_expr(stmt.iter.args[0], context)
-                rounds = stmt.iter.args[1].right.n
-        varname = stmt.target.id
-        pos = context.vars[varname][0] if varname in context.forvars else context.new_variable(varname, 'num')
-        o = LLLnode.from_list(['repeat', pos, start, rounds, parse_body(stmt.body, context)], typ=None)
-        context.forvars[varname] = True
+            return scrutinee, cases, stmt.orelse
+    if not cases:
+        return None
+    return scrutinee, cases, [stmt]
+
+def count_lll_nodes(node):
+    return 1 + sum(count_lll_nodes(arg) for arg in node.args)
+
+# Lowers a chain of constant cases to a binary decision tree over the sorted
+# constants, evaluating the scrutinee once. If the else clause is too large
+# to copy into the leaves, the cases are tested in order instead
+def make_decision_tree(scrutinee, cases, orelse, context):
+    bodies = [(value, parse_body(body, context)) for value, body in cases]
+    default = parse_body(orelse, context) if orelse else None
+    var = mk_with_var('case')
+
+    def linear(cases):
+        o = default
+        for value, body in cases[::-1]:
+            test = ['eq', var, value]
+            o = ['if', test, body, o] if o is not None else ['if', test, body]
         return o
-    # Creating a new memory variable and assigning it
-    elif isinstance(stmt, ast.AugAssign):
-        sub = parse_expr(stmt.value, context)
-        target = parse_left_expr(stmt.target, context)
-        if not isinstance(stmt.op, (ast.Add, ast.Sub, ast.Mult, ast.Div, ast.Mod)):
-            raise Exception("Unsupported operator for augassign")
-        if target.annotation == 'storage':
-            o = parse_expr(ast.BinOp(left=LLLnode.from_list(['sload', '_addr'], typ=target.typ),
-                                     right=sub, op=stmt.op), context)
-            return LLLnode.from_list(['with', '_addr', target, ['sstore', '_addr', type_conversion(o, o.typ, target.typ)]], typ=None)
-        elif target.annotation == 'memory':
-            o = parse_expr(ast.BinOp(left=LLLnode.from_list(['mload', '_addr'], typ=target.typ),
-                                     right=sub, op=stmt.op), context)
-            return LLLnode.from_list(['with', '_addr', target, ['mstore', '_addr', type_conversion(o, o.typ, target.typ)]], typ=None)
-    # Break from a loop
-    elif isinstance(stmt, ast.Break):
-        return LLLnode.from_list('break', typ=None)
-    # Return statement
-    elif isinstance(stmt, ast.Return):
-        if context.return_type is None:
-            if stmt.value:
-                raise Exception("Not expecting to return a value")
-            return LLLnode.from_list(['return', 0, 0], typ=None)
-        if not stmt.value:
-            raise Exception("Expecting to return a value")
-        sub = parse_expr(stmt.value, context)
-        if sub.typ == context.return_type or (sub.typ == 'num' and context.return_type == 'signed256'):
-            return LLLnode.from_list(['seq', ['mstore', 0, sub], ['return', 0, 32]], typ=None)
-        elif sub.typ == 'num' and context.return_type == 'num256':
-            return LLLnode.from_list(['seq', ['mstore', 0, sub],
-                                             ['assert', ['iszero', ['lt', ['mload', 0], 0]]],
-                                             ['return', 0, 32]], typ=None)
+
+    def tree(cases):
+        if len(cases) <= 2:
+            return linear(cases)
+        mid = len(cases) // 2
+        return ['if', ['slt', var, cases[mid][0]], tree(cases[:mid]), tree(cases[mid:])]
+
+    if default is None or count_lll_nodes(default) <= MAX_COPIED_DEFAULT_SIZE:
+        o = tree(sorted(bodies, key=lambda case: case[0]))
+    else:
+        o = linear(bodies)
+    return LLLnode.from_list(['with', var, scrutinee, o], typ=None)
+
+# Calls
+def parse_call_stmt(stmt, context):
+    if is_internal_call(stmt):
+        o = make_internal_call(stmt, context)
+        return LLLnode.from_list(['pop', o] if o.valency else o, typ=None)
+    if not isinstance(stmt.func, ast.Name) or stmt.func.id not in ('send', 'suicide', 'selfdestruct'):
+        raise Exception("Function call must be one of: send, selfdestruct")
+    if stmt.func.id == 'send':
+        if len(stmt.args) != 2:
+            raise Exception("Send expects 2 arguments!")
+        to = parse_expr(stmt.args[0], context)
+        if to.typ != "address":
+            raise Exception("Need to send to address")
+        value = parse_expr(stmt.args[1], context)
+        if value.typ != "num" and value.typ != "num256" and value.typ != "decimal":
+            raise Exception("Send value must be a number!")
+        if value.typ == "decimal":
+            value = LLLnode.from_list(['div', value, DECIMAL_DIVISOR], typ='num')
+        # The recipient may call back into this contract, so cached
+        # persistent variables are written out before and reloaded after
+        return LLLnode.from_list(['seq',
+                                    make_storage_writeback(context),
+                                    ['pop', ['call', 0, to, value, 0, 0, 0, 0]],
+                                    make_storage_reload(context)], typ=None)
+    else:
+        if len(stmt.args) != 1:
+            raise Exception("%s expects 1 argument!" % stmt.func.id)
+        sub = parse_expr(stmt.args[0], context)
+        if sub.typ != "address":
+            raise Exception("Must %s to an address!" % stmt.func.id)
+        return LLLnode.from_list(['selfdestruct', sub], typ=None)
+
+# Assert statement
+def parse_assert(stmt, context):
+    return LLLnode.from_list(['assert', parse_expr(stmt.test, context)], typ=None)
+
+# for i in range(n): ... (note: n must be a nonzero positive constant integer)
+def parse_for(stmt, context):
+    if not isinstance(stmt.iter, ast.Call) or \
+            not isinstance(stmt.iter.func, ast.Name) or \
+            not isinstance(stmt.target, ast.Name) or \
+            stmt.iter.func.id != "range" or \
+            len(stmt.iter.args) not in (1, 2):
+        raise Exception("For statements must be of the form `for i in range(rounds): ..` or `for i in range(start, start + rounds): ..`")
+    # Type 1 for, eg. for i in range(10): ...
+    if len(stmt.iter.args) == 1:
+        if not isinstance(stmt.iter.args[0], ast.Num):
+            raise Exception("Repeat must have a nonzero positive integral number of rounds")
+        start = LLLnode.from_list(0, typ='num')
+        rounds = stmt.iter.args[0].n
+    elif len(stmt.iter.args) == 2:
+        if isinstance(stmt.iter.args[0], ast.Num) and isinstance(stmt.iter.args[1], ast.Num):
+            # Type 2 for, eg. for i in range(100, 110): ...
+            start = LLLnode.from_list(stmt.iter.args[0].n, typ='num')
+            rounds = LLLnode.from_list(stmt.iter.args[1].n - stmt.iter.args[0].n, typ='num')
         else:
-            raise Exception("Unsupported type conversion: %r %r" % (sub.typ, context.return_type))
+            # Type 3 for, eg. for i in range(x, x + 10): ...
+            if not isinstance(stmt.iter.args[1], ast.BinOp) or not isinstance(stmt.iter.args[1].op, ast.Add):
+                raise Exception("Two-arg for statements must be of the form `for i in range(start, start + rounds): ...`")
+            if ast.dump(stmt.iter.args[0]) != ast.dump(stmt.iter.args[1].left):
+                raise Exception("Two-arg for statements of the form `for i in range(x, x + y): ...` must have x identical in both places: %r %r" % (ast.dump(stmt.iter.args[0]), ast.dump(stmt.iter.args[1].left)))
+            if not isinstance(stmt.iter.args[1].right, ast.Num):
+                raise Exception("Repeat must have a nonzero positive integral number of rounds")
+            start = parse_expr(stmt.iter.args[0], context)
+            rounds = stmt.iter.args[1].right.n
+    varname = stmt.target.id
+    pos = context.vars[varname][0] if varname in context.forvars else context.new_variable(varname, 'num')
+    o = LLLnode.from_list(['repeat', pos, start, rounds, parse_body(stmt.body, context)], typ=None)
+    context.forvars[varname] = True
+    return o
+
+# Augmented assignment, eg. x += 5
+def parse_augassign(stmt, context):
+    sub = parse_expr(stmt.value, context)
+    target = parse_left_expr(stmt.target, context)
+    if not isinstance(stmt.op, (ast.Add, ast.Sub, ast.Mult, ast.Div, ast.Mod)):
+        raise Exception("Unsupported operator for augassign")
+    if target.annotation == 'storage':
+        o = parse_expr(ast.BinOp(left=LLLnode.from_list(['sload', '_addr'], typ=target.typ),
+                                 right=sub, op=stmt.op), context)
+        return LLLnode.from_list(['with', '_addr', target, ['sstore', '_addr', type_conversion(o, o.typ, target.typ)]], typ=None)
+    elif target.annotation == 'memory':
+        o = parse_expr(ast.BinOp(left=LLLnode.from_list(['mload', '_addr'], typ=target.typ),
+                                 right=sub, op=stmt.op), context)
+        return LLLnode.from_list(['with', '_addr', target, ['mstore', '_addr', type_conversion(o, o.typ, target.typ)]], typ=None)
+
+# Break from a loop
+def parse_break(stmt, context):
+    return LLLnode.from_list('break', typ=None)
+
+# Return statement
+def parse_return(stmt, context):
+    if context.return_type is None:
+        if stmt.value:
+            raise Exception("Not expecting to return a value")
+        if context.is_internal:
+            return LLLnode.from_list(['internal_return'], typ=None)
+        return LLLnode.from_list(['seq', make_storage_writeback(context), ['return', 0, 0]], typ=None)
+    if not stmt.value:
+        raise Exception("Expecting to return a value")
+    sub = parse_expr(stmt.value, context)
+    # Internal functions leave their result on the stack
+    if context.is_internal:
+        return LLLnode.from_list(['internal_return', make_internal_value(sub, context.return_type)], typ=None)
+    if sub.typ == context.return_type or (sub.typ == 'num' and context.return_type == 'signed256'):
+        return LLLnode.from_list(['seq', ['mstore', 0, sub], make_storage_writeback(context), ['return', 0, 32]], typ=None)
+    elif sub.typ == 'num' and context.return_type == 'num256':
+        return LLLnode.from_list(['seq', ['mstore', 0, sub],
+                                         ['assert', ['iszero', ['lt', ['mload', 0], 0]]],
+                                         make_storage_writeback(context),
+                                         ['return', 0, 32]], typ=None)
     else:
-        print(ast.dump(stmt))
-        raise Exception("Unsupported statement type")
+        raise Exception("Unsupported type conversion: %r %r" % (sub.typ, context.return_type))
+
+# Statement node type -> function that lowers it to LLL
+stmt_handlers = {
+    ast.Expr: parse_expr_stmt,
+    ast.Pass: parse_pass,
+    ast.Assign: parse_assign,
+    ast.If: parse_if,
+    ast.Call: parse_call_stmt,
+    ast.Assert: parse_assert,
+    ast.For: parse_for,
+    ast.AugAssign: parse_augassign,
+    ast.Break: parse_break,
+    ast.Return: parse_return,
+}
@@ -0,0 +1,287 @@
+import mmap
+from parser import LLLnode, ListType, StructType, MappingType
+
+# Compact binary format for LLL trees and assembly, so that build steps can
+# cache and exchange them cheaply. Loading does not validate the nodes again
+# (as LLLnode.from_list does), since their valency is stored with them, and
+# the arguments of a node can be decoded lazily, when first accessed.
+#
+# Layout:
+#   header:   magic, format version, kind of content (LLL or assembly)
+#   strings:  number of strings, then each as a length and UTF-8 bytes
+#   types:    number of types, then each as a tag and its fields
+#   content:  an LLL node or an assembly stream
+#
+# An LLL node is its flags (valency, whether the value is a string), its
+# value (a string index or an integer), its type and annotation (indexes, 0
+# for None), its number of arguments, the byte length of its arguments and
+# the arguments themselves. An assembly stream is a number of items, each a
+# tag (integer, string or nested assembly) and a value. All numbers are
+# LEB128 varints; signed integers are zigzag-encoded first.
+
+MAGIC = b'VLLL'
+FORMAT_VERSION = 1
+
+LLL_CONTENT = 0
+ASSEMBLY_CONTENT = 1
+
+# Node flags
+VALENT = 1
+STRING_VALUE = 2
+
+# Type tags
+BASE_TYPE = 0
+LIST_TYPE = 1
+STRUCT_TYPE = 2
+MAPPING_TYPE = 3
+
+# Assembly item tags
+INT_ITEM = 0
+STRING_ITEM = 1
+NESTED_ITEM = 2
+
+def write_varint(o, n):
+    while n >= 0x80:
+        o.append((n & 0x7f) | 0x80)
+        n >>= 7
+    o.append(n)
+
+def read_varint(data, pos):
+    o, shift = 0, 0
+    while True:
+        b = data[pos]
+        pos += 1
+        o |= (b & 0x7f) << shift
+        if b < 0x80:
+            return o, pos
+        shift += 7
+
+def zigzag(n):
+    return n * 2 if n >= 0 else -n * 2 - 1
+
+def unzigzag(n):
+    return n // 2 if n % 2 == 0 else -(n + 1) // 2
+
+# Collects the strings and types used by a piece of content, each stored once
+class Writer():
+    def __init__(self):
+        self.strings = []
+        self.string_ids = {}
+        self.types = []
+        self.type_ids = {}
+
+    def string(self, s):
+        if not isinstance(s, str):
+            raise Exception("Cannot serialize %r as a string" % s)
+        if s not in self.string_ids:
+            self.string_ids[s] = len(self.strings)
+            self.strings.append(s)
+        return self.string_ids[s]
+
+    # Index of a type, plus one, or 0 for None. Compound types refer to the
+    # types of their members, which are stored before them
+    def type(self, typ):
+        if typ is None:
+            return 0
+        if typ not in self.type_ids:
+            o = bytearray()
+            if isinstance(typ, ListType):
+                o.append(LIST_TYPE)
+                write_varint(o, self.type(typ.subtype))
+                write_varint(o, typ.count)
+            elif isinstance(typ, StructType):
+                o.append(STRUCT_TYPE)
+                write_varint(o, len(typ.names))
+                for name in typ.names:
+                    write_varint(o, self.string(name))
+                    write_varint(o, self.type(typ.types[name]))
+            elif isinstance(typ, MappingType):
+                o.append(MAPPING_TYPE)
+                write_varint(o, self.type(typ.keytype))
+                write_varint(o, self.type(typ.valuetype))
+            else:
+                o.append(BASE_TYPE)
+                write_varint(o, self.string(typ))
+            self.type_ids[typ] = len(self.types) + 1
+            self.types.append(bytes(o))
+        return self.type_ids[typ]
+
+    def finish(self, kind, content):
+        o = bytearray(MAGIC)
+        write_varint(o, FORMAT_VERSION)
+        write_varint(o, kind)
+        write_varint(o, len(self.strings))
+        for s in self.strings:
+            encoded = s.encode('utf-8')
+            write_varint(o, len(encoded))
+            o.extend(encoded)
+        write_varint(o, len(self.types))
+        for t in self.types:
+            o.extend(t)
+        return bytes(o + content)
+
+def encode_node(node, w, o):
+    is_string = isinstance(node.value, str)
+    o.append((VALENT if node.valency else 0) | (STRING_VALUE if is_string else 0))
+    write_varint(o, w.string(node.value) if is_string else zigzag(node.value))
+    write_varint(o, w.type(node.typ))
+    write_varint(o, 0 if node.annotation is None else w.string(node.annotation) + 1)
+    args = bytearray()
+    for arg in node.args:
+        encode_node(arg, w, args)
+    write_varint(o, len(node.args))
+    write_varint(o, len(args))
+    o.extend(args)
+
+def encode_assembly(assembly, w, o):
+    write_varint(o, len(assembly))
+    for item in assembly:
+        if isinstance(item, list):
+            o.append(NESTED_ITEM)
+            encode_assembly(item, w, o)
+        elif isinstance(item, int):
+            o.append(INT_ITEM)
+            write_varint(o, zigzag(item))
+        else:
+            o.append(STRING_ITEM)
+            write_varint(o, w.string(item))
+
+# Serializes an LLL tree
+def dump_lll(node):
+    w = Writer()
+    o = bytearray()
+    encode_node(node, w, o)
+    return w.finish(LLL_CONTENT, o)
+
+# Serializes assembly, as produced by compile_lll.compile_to_assembly
+def dump_assembly(assembly):
+    w = Writer()
+    o = bytearray()
+    encode_assembly(assembly, w, o)
+    return w.finish(ASSEMBLY_CONTENT, o)
+
+# An LLL node whose arguments are decoded the first time they are accessed
+class LazyLLLnode(LLLnode):
+    @property
+    def args(self):
+        if self._args is None:
+            self._args = self._reader.read_args(self._args_pos, self._nargs, True)
+        return self._args
+
+    @args.setter
+    def args(self, args):
+        self._args = args
+
+# Decodes content from bytes or any other buffer, eg. a memory map
+class Reader():
+    def __init__(self, data, kind):
+        self.data = data
+        if bytes(data[:len(MAGIC)]) != MAGIC:
+            raise Exception("Not a serialized LLL tree or assembly")
+        version, pos = read_varint(data, len(MAGIC))
+        if version != FORMAT_VERSION:
+            raise Exception("Unsupported serialization format version: %d" % version)
+        content_kind, pos = read_varint(data, pos)
+        if content_kind != kind:
+            raise Exception("Expected %s, found %s" % (content_names[kind], content_names.get(content_kind, content_kind)))
+        count, pos = read_varint(data, pos)
+        self.strings = []
+        for i in range(count):
+            length, pos = read_varint(data, pos)
+            self.strings.append(bytes(data[pos: pos + length]).decode('utf-8'))
+            pos += length
+        count, pos = read_varint(data, pos)
+        self.types = [None]
+        for i in range(count):
+            typ, pos = self.read_type(pos)
+            self.types.append(typ)
+        self.start = pos
+
+    def read_type(self, pos):
+        tag = self.data[pos]
+        pos += 1
+        if tag == LIST_TYPE:
+            subtype, pos = read_varint(self.data, pos)
+            count, pos = read_varint(self.data, pos)
+            return ListType(self.types[subtype], count), pos
+        elif tag == STRUCT_TYPE:
+            count, pos = read_varint(self.data, pos)
+            members = {}
+            for i in range(count):
+                name, pos = read_varint(self.data, pos)
+                typ, pos = read_varint(self.data, pos)
+                members[self.strings[name]] = self.types[typ]
+            return StructType(members), pos
+        elif tag == MAPPING_TYPE:
+            keytype, pos = read_varint(self.data, pos)
+            valuetype, pos = read_varint(self.data, pos)
+            return MappingType(self.types[keytype], self.types[valuetype]), pos
+        elif tag == BASE_TYPE:
+            name, pos = read_varint(self.data, pos)
+            return self.strings[name], pos
+        raise Exception("Invalid type tag: %d" % tag)
+
+    # Reads the node at pos; returns it and the position after it
+    def read_node(self, pos, lazy):
+        data = self.data
+        flags = data[pos]
+        value, pos = read_varint(data, pos + 1)
+        typ, pos = read_varint(data, pos)
+        annotation, pos = read_varint(data, pos)
+        nargs, pos = read_varint(data, pos)
+        size, pos = read_varint(data, pos)
+        node = LLLnode.__new__(LazyLLLnode if lazy else LLLnode)
+        node.value = self.strings[value] if flags & STRING_VALUE else unzigzag(value)
+        node.typ = self.types[typ]
+        node.annotation = self.strings[annotation - 1] if annotation else None
+        node.valency = 1 if flags & VALENT else 0
+        if lazy:
+            node._reader, node._args_pos, node._nargs = self, pos, nargs
+            node.args = None
+        else:
+            node.args = self.read_args(pos, nargs, False)
+        return node, pos + size
+
+    def read_args(self, pos, nargs, lazy):
+        o = []
+        for i in range(nargs):
+            node, pos = self.read_node(pos, lazy)
+            o.append(node)
+        return o
+
+    def read_assembly(self, pos):
+        count, pos = read_varint(self.data, pos)
+        o = []
+        for i in range(count):
+            tag = self.data[pos]
+            if tag == NESTED_ITEM:
+                item, pos = self.read_assembly(pos + 1)
+            elif tag == INT_ITEM:
+                item, pos = read_varint(self.data, pos + 1)
+                item = unzigzag(item)
+            elif tag == STRING_ITEM:
+                item, pos = read_varint(self.data, pos + 1)
+                item = self.strings[item]
+            else:
+                raise Exception("Invalid assembly item tag: %d" % tag)
+            o.append(item)
+        return o, pos
+
+content_names = {LLL_CONTENT: 'an LLL tree', ASSEMBLY_CONTENT: 'assembly'}
+
+# Deserializes an LLL tree. If lazy, the arguments of each node are only
+# decoded when accessed, and data must stay available until then
+def load_lll(data, lazy=False):
+    reader = Reader(data, LLL_CONTENT)
+    return reader.read_node(reader.start, lazy)[0]
+
+def load_assembly(data):
+    reader = Reader(data, ASSEMBLY_CONTENT)
+    return reader.read_assembly(reader.start)[0]
+
+# Lazily loads a serialized LLL tree from a file, which is memory-mapped
+# rather than read, so that only the parts that are used get paged in
+def open_lll(path):
+    with open(path, 'rb') as f:
+        data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    return load_lll(data, lazy=True)
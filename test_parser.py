@@ -79,6 +79,21 @@ assert c.sum(70, 131) == 6100
 
 print('Passed more complex repeater with offset test')
 
+argument_reuse_test = """
+def scale(x: num, flag: bool) -> num:
+    out = 0
+    for i in range(5):
+        if flag:
+            out = out + x
+    return out
+"""
+
+c = s.abi_contract(argument_reuse_test, language='viper')
+assert c.scale(7, True) == 35
+assert c.scale(7, False) == 0
+print('Passed argument reuse test')
+print('Gas estimate', t.languages['viper'].gas_estimate(argument_reuse_test)['scale'], 'actual', s.state.receipts[-1].gas_used - s.state.receipts[-2].gas_used - 21000)
+
 array_accessor = """
 def test_array(x: num, y: num, z: num, w: num) -> num:
     a = num[4]
@@ -109,6 +124,21 @@ assert c.test_array(2, 7, 1, 8) == 2718
 print('Passed complex array accessor test')
 print('Gas estimate', t.languages['viper'].gas_estimate(two_d_array_accessor)['test_array'], 'actual', s.state.receipts[-1].gas_used - s.state.receipts[-2].gas_used - 21000)
 
+nested_struct_accessor = """
+def test_struct(x: num, y: num, i: num) -> num:
+    a = [c(num[3]), b(num), d([e(num), f(num[2])])]
+    a.b = x
+    a.c[i] = y
+    a.d.f[1] = a.c[i] + a.b
+    a.d.e = 5
+    return a.b * 1000 + a.c[i] * 100 + a.d.e * 10 + a.d.f[1]
+"""
+
+c = s.abi_contract(nested_struct_accessor, language='viper')
+assert c.test_struct(2, 7, 1) == 2759
+assert c.test_struct(1, 3, 2) == 1354
+print('Passed nested struct accessor test')
+
 
 digit_reverser = """
 
@@ -159,6 +189,8 @@ try:
 except t.TransactionFailed:
     success = False
 assert not success
+# Failed checks end the call with REVERT, so most of the gas is refunded
+assert s.state.receipts[-1].gas_used - s.state.receipts[-2].gas_used < 100000
 c.finalize(sender=t.k0)
 
 print('Passed escrow test')
@@ -196,6 +228,130 @@ c.finalize(sender=t.k0)
 print('Passed escrow test with initializer')
 print('Gas estimate', t.languages['viper'].gas_estimate(arbitration_code)['finalize'], 'actual', s.state.receipts[-1].gas_used - s.state.receipts[-2].gas_used - 21000)
 
+short_circuit_test = """
+def divides(x: num, y: num) -> bool:
+    return not (y == 0) and x % y == 0 and x / y > 1
+
+def either(x: num, y: num, z: num) -> bool:
+    return x == 1 or 10 / y == 5 or z == 3
+"""
+
+c = s.abi_contract(short_circuit_test, language='viper')
+assert c.divides(6, 3)
+assert not c.divides(6, 0)
+assert not c.divides(6, 4)
+assert not c.divides(3, 3)
+assert c.either(1, 0, 0)
+assert c.either(0, 2, 0)
+assert c.either(0, 3, 3)
+assert not c.either(0, 3, 4)
+print('Passed short-circuit test')
+
+elif_chain_test = """
+state = num
+
+def step(x: num) -> num:
+    if self.state == 0:
+        self.state = 3
+    elif self.state == 3:
+        self.state = 1
+    elif 1 == self.state:
+        self.state = x
+    elif self.state == 7:
+        self.state = 0
+    elif self.state == 5:
+        return 50
+    else:
+        self.state = self.state + 100
+        return 999
+    return self.state
+
+def classify(x: num) -> num:
+    o = 0
+    for i in range(10):
+        if x == i:
+            o = 1
+        elif x == i + 20:
+            o = 2
+            break
+        else:
+            o = 3
+            o = o + 1
+    return o
+
+def count(x: num) -> num:
+    o = 0
+    for i in range(x, x + 8):
+        if i == 2:
+            o = o + 1
+        elif i == 4:
+            o = o + 10
+        elif i == 5:
+            break
+        elif i == 6:
+            o = o + 1000
+    return o
+"""
+
+c = s.abi_contract(elif_chain_test, language='viper')
+assert [c.step(7), c.step(7), c.step(7), c.step(7), c.step(5), c.step(5)] == [3, 1, 7, 0, 3, 1]
+assert c.step(9) == 9
+assert c.step(0) == 999
+assert c.step(0) == 999
+c = s.abi_contract(elif_chain_test, language='viper')
+assert [c.step(0), c.step(0), c.step(5), c.step(0)] == [3, 1, 5, 50]
+assert c.classify(0) == 4
+assert c.classify(9) == 1
+assert c.classify(25) == 2
+assert c.count(0) == 11
+assert c.count(5) == 0
+assert c.count(6) == 1000
+
+nested_chain_test = """
+def nested(x: num, y: num) -> num:
+    if x == 1:
+        if y == 1:
+            return 11
+        elif y == 2:
+            return 12
+        elif y == 3:
+            return 13
+        return 10
+    elif x == 2:
+        return 20
+    elif x == 3:
+        if y == 1:
+            return 31
+        elif y == 2:
+            return 32
+        elif y == 3:
+            return 33
+    return x * 100 + y
+"""
+
+for level in (0, 1, 2, 'size'):
+    c = t.ABIContract(s, t.languages['viper'].mk_full_signature(nested_chain_test), s.evm(t.languages['viper'].compile(nested_chain_test, optimize=level)))
+    assert [c.nested(1, 2), c.nested(1, 5), c.nested(2, 3), c.nested(3, 3), c.nested(3, 4), c.nested(4, 1)] == [12, 10, 20, 33, 304, 401]
+
+out_of_range_chain_test = """
+def foo(x: num) -> num:
+    if x == 1:
+        return 1
+    elif x == 2:
+        return 2
+    elif x == 170141183460469231731687303715884105728:
+        return 3
+    return 0
+"""
+
+try:
+    t.languages['viper'].compile(out_of_range_chain_test)
+    success = True
+except Exception:
+    success = False
+assert not success
+print('Passed elif chain test')
+
 decimal_test = """
 def foo() -> num:
     return(floor(999.0))
@@ -281,6 +437,34 @@ assert c.phooey() == 20736
 
 print('Passed fractional multiplication test')
 
+decimal_overflow_test = """
+def cube(x: num) -> num:
+    d = decimal(x)
+    return floor(d * d * d)
+
+def mixed(x: num) -> num:
+    d = x * 1.5
+    return floor(d / 3 + 20 / d + d % 4 + 7 % d)
+"""
+
+c = s.abi_contract(decimal_overflow_test, language='viper')
+assert c.cube(1000) == 1000000000
+assert c.mixed(4) == 8
+for x in (2**43, 2**100):
+    try:
+        c.cube(x)
+        success = True
+    except t.TransactionFailed:
+        success = False
+    assert not success
+try:
+    c.mixed(0)
+    success = True
+except t.TransactionFailed:
+    success = False
+assert not success
+print('Passed decimal overflow test')
+
 break_test = """
 def log(n: num) -> num:
     c = n * 1.0
@@ -415,6 +599,306 @@ assert c.returnMoose() == 57
 print('Passed init argument and variable member test')
 
 
+init_argument_reuse_test = """
+total = num
+def __init__(a: num, b: num):
+    self.total = a * b + a + b
+
+def getTotal() -> num:
+    return self.total
+"""
+
+c = s.abi_contract(init_argument_reuse_test, language='viper', constructor_parameters=[3, 4])
+assert c.getTotal() == 19
+print('Passed init argument reuse test')
+
+storage_key_test = """
+pairs = {num: [a(num), b(num)]}
+
+def setAndGet(k: num) -> num:
+    j = k
+    self.pairs[j].a = 3
+    self.pairs[j].b = 4
+    j = j + 1
+    self.pairs[j].a = 5
+    return self.pairs[j - 1].a * 100 + self.pairs[j - 1].b * 10 + self.pairs[j].a
+"""
+
+c = s.abi_contract(storage_key_test, language='viper')
+assert c.setAndGet(7) == 345
+print('Passed storage key caching test')
+
+constant_storage_key_test = """
+table = {num: num}
+grid = num[3]
+nested = [x(num), inner([y(num), z(num)])]
+
+def setAndGet() -> num:
+    self.table[5] = 7
+    self.grid[2] = 3
+    self.nested.inner.z = 4
+    return self.table[5] * 100 + self.grid[2] * 10 + self.nested.inner.z
+"""
+
+c = s.abi_contract(constant_storage_key_test, language='viper')
+assert c.setAndGet() == 734
+
+mapping_member_test = """
+account = [owner(address), balances({num: num})]
+tables = {num: num}[3]
+
+def deposit(k: num, v: num) -> num:
+    self.account.owner = msg.sender
+    self.account.balances[k] = self.account.balances[k] + v
+    self.tables[2][k] = v * 2
+    return self.account.balances[k] * 100 + self.tables[2][k]
+"""
+
+c = s.abi_contract(mapping_member_test, language='viper')
+assert c.deposit(3, 4) == 408
+assert c.deposit(3, 5) == 910
+
+inner = parser.StructType({'a': 'num', 'b': parser.ListType('num', 3)})
+outer = parser.ListType(inner, 2)
+assert outer.size == 8 and inner.offsets == {'a': 0, 'b': 1}
+inner.types['b'] = parser.ListType('num', 5)
+assert outer.size == 8 and inner.size == 4
+try:
+    parser.ListType(parser.MappingType('num', 'num'), 3).size
+    success = True
+except Exception:
+    success = False
+assert not success
+print('Passed constant storage key test')
+
+compound_copy_test = """
+saved = num[3]
+points = [x(num), y(num)][12]
+big = num[20]
+
+def save(a: num, b: num) -> num:
+    x = num[3]
+    x[0] = a
+    x[1] = b
+    x[2] = a + b
+    self.saved = x
+    y = self.saved
+    return y[0] * 100 + y[1] * 10 + y[2]
+
+def swap(i: num, j: num) -> num:
+    for k in range(12):
+        self.points[k].x = k
+        self.points[k].y = k * 2
+    p = self.points
+    self.points[i] = p[j]
+    self.points[j] = p[i]
+    return self.points[i].x * 1000 + self.points[i].y * 100 + self.points[j].x * 10 + self.points[j].y
+
+def blocks(a: num) -> num:
+    x = num[20]
+    for i in range(20):
+        x[i] = i * a
+    y = x
+    self.big = y
+    z = self.big
+    return z[19] + z[3]
+"""
+
+c = s.abi_contract(compound_copy_test, language='viper')
+assert c.save(1, 2) == 123
+assert c.swap(1, 3) == 3612
+assert c.blocks(2) == 44
+try:
+    c.swap(12, 0)
+    success = True
+except t.TransactionFailed:
+    success = False
+assert not success
+for bad_copy in ["""
+x = {num: num}
+y = {num: num}
+def foo():
+    self.x = self.y
+""", """
+def foo():
+    x = num[3]
+    y = num[4]
+    y = x
+"""]:
+    try:
+        t.languages['viper'].compile(bad_copy)
+        success = True
+    except Exception:
+        success = False
+    assert not success
+
+nested_copy_test = """
+m = {num: [a(num[2]), b(num[2])]}
+
+def put(k: num, v: num) -> num:
+    x = [a(num[2]), b(num[2])]
+    x.a[0] = v
+    x.a[1] = v + 1
+    x.b[0] = v + 2
+    x.b[1] = v + 3
+    self.m[k] = x
+    y = self.m[k]
+    return y.a[0] * 1000 + y.a[1] * 100 + y.b[0] * 10 + y.b[1]
+"""
+
+for level in (0, 1, 2, 'size'):
+    c = t.ABIContract(s, t.languages['viper'].mk_full_signature(nested_copy_test), s.evm(t.languages['viper'].compile(nested_copy_test, optimize=level)))
+    assert c.put(4, 1) == 1234
+print('Passed compound copy test')
+
+list_argument_test = """
+saved = num[5]
+
+def total(xs: num[50]) -> num:
+    o = 0
+    for i in range(50):
+        o = o + xs[i]
+    return o
+
+def mixed(a: num, xs: num[3], flags: bool[2], grid: num[2][2]) -> num:
+    if flags[1]:
+        return a * 10000 + xs[0] * 1000 + xs[2] * 100 + grid[1][0] * 10 + grid[0][1]
+    return 0
+
+def store(xs: num[5]) -> num:
+    self.saved = xs
+    return self.saved[4] + xs[0]
+"""
+
+c = s.abi_contract(list_argument_test, language='viper')
+assert c.total(list(range(50))) == 1225
+assert c.mixed(7, [1, 2, 3], [False, True], [[4, 5], [6, 8]]) == 71365
+assert c.store([1, 2, 3, 4, 5]) == 6
+for bad_call in (lambda: c.total([0] * 49 + [2**128]), lambda: c.mixed(7, [1, 2, 3], [False, 2], [[4, 5], [6, 8]])):
+    try:
+        bad_call()
+        success = True
+    except t.TransactionFailed:
+        success = False
+    assert not success
+assert [f['name'] for f in t.languages['viper'].mk_full_signature(list_argument_test)] == \
+    ['total(int128[50])', 'mixed(int128,int128[3],bool[2],int128[2][2])', 'store(int128[5])']
+print('Passed list argument test')
+
+storage_cache_test = """
+total = num
+count = num
+
+def accumulate(x: num) -> num:
+    for i in range(5):
+        self.total += x
+        self.count = self.count + 1
+    return self.total * 100 + self.count
+
+def pay(to: address) -> num:
+    self.count = self.count + 1
+    self.count = self.count + 1
+    send(to, msg.value)
+    return self.count
+"""
+
+c = s.abi_contract(storage_cache_test, language='viper')
+assert c.accumulate(3) == 1505
+print('Gas estimate', t.languages['viper'].gas_estimate(storage_cache_test)['accumulate'], 'actual', s.state.receipts[-1].gas_used - s.state.receipts[-2].gas_used - 21000)
+assert c.accumulate(3) == 3010
+pre_bal = s.state.get_balance(t.a2)
+assert c.pay(t.a2, value=7) == 12
+assert s.state.get_balance(t.a2) - pre_bal == 7
+assert c.accumulate(0) == 3017
+print('Passed storage caching test')
+
+batch_test = """
+total = num
+
+def add(x: num) -> num:
+    self.total = self.total + x
+    return self.total
+
+def reset():
+    self.total = 0
+"""
+
+def batch_record(sig, *args):
+    return parser.sha3_256(bytes(sig, 'utf-8'))[:4] + b''.join(x.to_bytes(32, 'big') for x in args)
+
+batch_abi = t.languages['viper'].mk_full_signature(batch_test, batch=True)
+c = t.ABIContract(s, batch_abi, s.evm(t.languages['viper'].compile(batch_test, batch=True)))
+assert c.add(5) == 5
+records = batch_record('add(int128)', 3) + batch_record('reset()') + batch_record('add(int128)', 4) + batch_record('add(int128)', 6)
+assert [int.from_bytes(x, 'big') for x in c.batch(records)] == [8, 0, 4, 10]
+assert c.add(0) == 10
+try:
+    c.batch(batch_record('add(int128)', 3) + batch_record('add(int128)', 2**200))
+    success = True
+except t.TransactionFailed:
+    success = False
+assert not success
+assert c.add(0) == 10
+print('Passed batch test')
+
+internal_function_test = """
+total = num
+count = num
+
+@internal
+def clamp_to(x: num, hi: num) -> num:
+    if x > hi:
+        return hi
+    return x
+
+@internal
+def add_total(x: num):
+    self.total += self.clamp_to(x, 1000)
+    self.count += 1
+
+@internal
+def mix(a: num, b: num) -> num:
+    return a * 10 + b
+
+def __init__(x: num):
+    self.count = self.mix(x, 1)
+
+def deposit(x: num) -> num:
+    self.add_total(x)
+    self.add_total(x * 2)
+    return self.total * 1000 + self.count
+
+def sum_clamped() -> num:
+    y = 0
+    for i in range(5):
+        y += self.clamp_to(i * 300, 1000)
+    return y
+
+def nested() -> num:
+    return self.mix(1, self.mix(2, self.mix(3, 4)))
+"""
+
+c = s.abi_contract(internal_function_test, language='viper', constructor_parameters=[7])
+assert c.deposit(7) == 21073
+assert c.deposit(700) == 1721075
+assert c.sum_clamped() == 2800
+assert c.nested() == 64
+assert [f['name'] for f in t.languages['viper'].mk_full_signature(internal_function_test)] == \
+    ['__init__(int128)', 'deposit(int128)', 'sum_clamped()', 'nested()']
+# mix is called once in the runtime code, so it is inlined and its subroutine dropped
+for level in (0, 1):
+    code = t.languages['viper'].compile(internal_function_test, optimize=level)
+    c = t.ABIContract(s, t.languages['viper'].mk_full_signature(internal_function_test), s.evm(code + (7).to_bytes(32, 'big')))
+    assert c.nested() == 64 and c.deposit(7) == 21073
+assert len(t.languages['viper'].compile(internal_function_test, optimize=1)) < len(t.languages['viper'].compile(internal_function_test, optimize=0))
+try:
+    t.languages['viper'].compile(internal_function_test.replace('return a * 10 + b', 'return self.mix(a, b)'))
+    success = True
+except Exception:
+    success = False
+assert not success
+print('Passed internal function test')
+
 crowdfund = """
 
 funders = {num: [sender(address), value(num)]}
@@ -502,6 +986,231 @@ assert [y-x for x, y in zip(pre_bals, post_bals)] == [1,2,3,4]
 
 print('Passed composite crowdfund test')
 
+report = []
+t.languages['viper'].compile(crowdfund, optimize=2, report=report)
+assert [r['pass'] for r in report] == ['inline_internal_calls', 'unroll_loops_for_gas', 'reduce_strength', 'cache_storage_keys', 'hoist_loop_invariants', 'peephole']
+# Values moved out of loops add with nodes, but not code
+assert all(r['size_after'] <= r['size_before'] and r['gas_saved'] >= 0 for r in report if r['pass'] != 'hoist_loop_invariants')
+for level in (0, 1, 'size'):
+    c = t.ABIContract(s, t.languages['viper'].mk_full_signature(basic_repeater), s.evm(t.languages['viper'].compile(basic_repeater, optimize=level)))
+    assert c.repeat(9) == 54
+assert len(t.languages['viper'].compile(crowdfund, optimize='size')) < len(t.languages['viper'].compile(crowdfund, optimize=1))
+c = t.ABIContract(s, t.languages['viper'].mk_full_signature(digit_reverser), s.evm(t.languages['viper'].compile(digit_reverser, optimize='size')))
+assert c.reverse_digits(123456) == 654321
+print('Passed optimization levels test')
+
+unroll_test = """
+def small() -> num:
+    x = num[3]
+    for i in range(3):
+        x[i] = i * 10
+    return x[0] + x[1] + x[2]
+
+def stop_at(n: num) -> num:
+    out = 0
+    for i in range(8):
+        if i == n:
+            break
+        out = out + i
+    return out
+
+def after_loop() -> num:
+    for i in range(4):
+        pass
+    return i
+
+def offset(x: num) -> num:
+    out = 0
+    for i in range(x, x + 6):
+        out = out * 10 + i
+    return out
+
+def grouped(xs: num[16]) -> num:
+    out = 0
+    for i in range(16):
+        out = out + xs[i] * i
+    return out
+"""
+
+def count_repeats(node):
+    return (node.value == 'repeat') + sum(count_repeats(arg) for arg in node.args)
+
+import optimizer
+unroll_lll = parser.parse_tree_to_lll(parser.parse(unroll_test))
+assert count_repeats(optimizer.optimize(unroll_lll, 2)) < count_repeats(optimizer.optimize(unroll_lll, 0))
+assert count_repeats(optimizer.optimize(unroll_lll, 1)) < count_repeats(optimizer.optimize(unroll_lll, 0))
+for level in (0, 1, 2):
+    c = t.ABIContract(s, t.languages['viper'].mk_full_signature(unroll_test), s.evm(t.languages['viper'].compile(unroll_test, optimize=level)))
+    assert c.small() == 30
+    assert c.stop_at(3) == 3
+    assert c.stop_at(20) == 28
+    assert c.after_loop() == 4
+    assert c.offset(1) == 123456
+    assert c.grouped(list(range(16))) == 1240
+print('Passed loop unrolling test')
+
+loop_invariant_test = """
+total = num
+count = num
+
+def scaled(xs: num[20], y: num) -> num:
+    out = 0
+    for i in range(20):
+        out = out + xs[i] * (y + 3) + self.total
+    return out
+
+def bump(x: num) -> num:
+    for i in range(20):
+        self.total = self.total + x
+        self.count += 1
+    return self.total * 100 + self.count
+
+def nested(y: num) -> num:
+    out = 0
+    for i in range(20):
+        for j in range(20):
+            out = out + (y * 2 + i) * j
+    return out
+
+def stop_at(n: num, y: num) -> num:
+    out = 0
+    for i in range(20):
+        if i == n:
+            break
+        out = out + i * (y + 1)
+    return out
+"""
+
+def hoisted_values(node):
+    return (node.value == 'with' and node.args[0].value.startswith('_inv_')) + sum(hoisted_values(arg) for arg in node.args)
+
+invariant_lll = parser.parse_tree_to_lll(parser.parse(loop_invariant_test))
+assert hoisted_values(optimizer.optimize(invariant_lll, 1)) > 0
+assert hoisted_values(optimizer.optimize(invariant_lll, 1, passes=[])) == 0
+assert len(t.languages['viper'].compile(loop_invariant_test, passes=['hoist_loop_invariants'])) <= len(t.languages['viper'].compile(loop_invariant_test, passes=[]))
+gas = {}
+for level in (0, 1):
+    c = t.ABIContract(s, t.languages['viper'].mk_full_signature(loop_invariant_test), s.evm(t.languages['viper'].compile(loop_invariant_test, optimize=level)))
+    assert c.scaled(list(range(20)), 2) == 950
+    gas[level] = s.state.receipts[-1].gas_used - s.state.receipts[-2].gas_used
+    assert c.bump(3) == 6020
+    assert c.bump(2) == 10040
+    assert c.nested(1) == 43700
+    assert c.stop_at(4, 1) == 12
+    assert c.stop_at(30, 1) == 380
+assert gas[1] < gas[0]
+
+# Writes through a runtime index may hit the fixed slot of a constant index
+storage_alias_test = """
+grid = num[3]
+table = {num: num}
+
+def grid_sum(i: num) -> num:
+    out = 0
+    for j in range(6):
+        self.grid[i] = self.grid[i] + 1
+        out = out + self.grid[2]
+    return out
+
+def table_sum(k: num) -> num:
+    out = 0
+    for j in range(6):
+        self.table[k] = self.table[k] + 1
+        out = out + self.table[5]
+    return out
+"""
+
+for level in (0, 1, 2, 'size'):
+    c = t.ABIContract(s, t.languages['viper'].mk_full_signature(storage_alias_test), s.evm(t.languages['viper'].compile(storage_alias_test, optimize=level)))
+    assert c.grid_sum(2) == 21
+    assert c.grid_sum(1) == 36
+    assert c.table_sum(5) == 21
+print('Passed loop invariant code motion test')
+
+strength_reduction_test = """
+def signed(x: num) -> num:
+    y = x - 10
+    return (y % 4) * 1000 + y / 8 * 10 + y * 2
+
+def pick(xs: num[4]) -> num:
+    out = 0
+    for i in range(12):
+        out = out * 2 + xs[i % 4] + i / 4
+    return out
+
+def whole(x: num) -> num:
+    d = x * 1.25
+    return floor(decimal(floor(d)) * 4.0)
+"""
+
+def count_ops(node, ops):
+    return (node.value in ops) + sum(count_ops(arg, ops) for arg in node.args)
+
+reduction_lll = parser.parse_tree_to_lll(parser.parse(strength_reduction_test))
+assert count_ops(optimizer.optimize(reduction_lll, 1), ('shl', 'shr', 'sar')) == 0
+assert count_ops(optimizer.optimize(reduction_lll, 1, target='constantinople'), ('shl', 'shr')) > 0
+assert count_ops(optimizer.optimize(reduction_lll, 1), ('smod',)) < count_ops(reduction_lll, ('smod',))
+try:
+    optimizer.optimize(reduction_lll, 1, target='frontier')
+    success = True
+except Exception:
+    success = False
+assert not success
+for level in (0, 1):
+    c = t.ABIContract(s, t.languages['viper'].mk_full_signature(strength_reduction_test), s.evm(t.languages['viper'].compile(strength_reduction_test, optimize=level)))
+    assert c.signed(3) == -3000 + 0 - 14
+    assert c.signed(31) == 1000 + 20 + 42
+    assert c.pick([1, 0, 1, 1]) == 3273
+    assert c.whole(3) == 12
+print('Passed strength reduction test')
+
+import gas_report
+gas = gas_report.gas_report(crowdfund)
+estimates = t.languages['viper'].gas_estimate(crowdfund)
+for name in estimates:
+    assert gas[name]['total'] == estimates[name] == sum(gas[name][c] for c in gas_report.categories)
+assert gas['participate']['storage writes'] > 0 and gas['refund']['calls'] > 0
+assert gas_report.diff_reports(gas, gas)['refund']['total'] == 0
+assert gas_report.format_table(gas).split('\n')[0].split()[:3] == ['function', 'dispatch', 'argument']
+print('Passed gas report test')
+
+import serialization
+def lll_nodes(node):
+    yield node
+    for arg in node.args:
+        for sub in lll_nodes(arg):
+            yield sub
+crowdfund_lll = parser.parse_tree_to_lll(parser.parse(crowdfund))
+data = serialization.dump_lll(crowdfund_lll)
+for loaded in (serialization.load_lll(data), serialization.load_lll(data, lazy=True)):
+    pairs = list(zip(lll_nodes(crowdfund_lll), lll_nodes(loaded)))
+    assert len(pairs) == len(list(lll_nodes(crowdfund_lll)))
+    assert all((a.value, a.typ, a.annotation, a.valency) == (b.value, b.typ, b.annotation, b.valency) for a, b in pairs)
+    assert serialization.dump_lll(loaded) == data
+assert any(isinstance(node.typ, parser.StructType) for node in lll_nodes(serialization.load_lll(data)))
+assembly = compile_lll.compile_to_assembly(crowdfund_lll)
+assert serialization.load_assembly(serialization.dump_assembly(assembly)) == assembly
+try:
+    serialization.load_assembly(data)
+    success = True
+except Exception:
+    success = False
+assert not success
+print('Passed serialization test')
+
+import gas_regression, gas_corpus
+results = gas_regression.run_corpus([entry for entry in gas_corpus.corpus if entry['name'] == 'repeaters'])
+assert results['repeaters']['code size'] > 0 and results['repeaters']['deploy gas'] > 0
+assert sorted(results['repeaters']['runtime gas']) == ['nested', 'offset', 'repeat', 'reverse_digits', 'sum', 'sum#2']
+assert not gas_regression.failures(gas_regression.compare(results, results))
+worse = {'repeaters': dict(results['repeaters'], **{'deploy gas': results['repeaters']['deploy gas'] + 100})}
+assert [row[1] for row in gas_regression.failures(gas_regression.compare(results, worse))] == ['deploy gas']
+assert not gas_regression.failures(gas_regression.compare(results, worse, {'deploy gas': 0.5}))
+baseline = gas_regression.load_baseline(gas_regression.DEFAULT_BASELINE)
+assert all(metric in gas_regression.metrics for metric in baseline['thresholds'])
+assert set(baseline['results']) == set(entry['name'] for entry in gas_corpus.corpus)
+print('Passed gas regression runner test')
+
 comment_test = """
 
 def foo() -> num:
@@ -512,3 +1221,111 @@ def foo() -> num:
 c = s.abi_contract(comment_test, language='viper')
 assert c.foo() == 3
 print('Passed comment test')
+
+import compile_daemon, threading, tempfile, os, binascii
+daemon_path = os.path.join(tempfile.mkdtemp(), 'viper.sock')
+daemon = compile_daemon.CompileServer(daemon_path, cache_size=2)
+threading.Thread(target=daemon.serve_forever, daemon=True).start()
+expected = '0x' + binascii.hexlify(t.languages['viper'].compile(crowdfund)).decode('ascii')
+results = []
+workers = [threading.Thread(target=lambda: results.append(compile_daemon.request(daemon_path, 'compile', crowdfund))) for i in range(4)]
+for w in workers:
+    w.start()
+for w in workers:
+    w.join()
+assert results == [expected] * 4
+assert compile_daemon.request(daemon_path, 'abi', crowdfund) == t.languages['viper'].mk_full_signature(crowdfund)
+assert compile_daemon.request(daemon_path, 'gas_estimate', crowdfund) == t.languages['viper'].gas_estimate(crowdfund)
+assert compile_daemon.request(daemon_path, 'stats')['size'] == 2
+parse_misses = compile_daemon.request(daemon_path, 'stats')['parse_misses']
+compile_daemon.request(daemon_path, 'compile', comment_test)
+compile_daemon.request(daemon_path, 'compile', comment_test, optimize=0)
+assert compile_daemon.request(daemon_path, 'abi', comment_test) == t.languages['viper'].mk_full_signature(comment_test)
+assert compile_daemon.request(daemon_path, 'gas_estimate', comment_test) == t.languages['viper'].gas_estimate(comment_test)
+assert compile_daemon.request(daemon_path, 'stats')['parse_misses'] == parse_misses + 1
+try:
+    compile_daemon.request(daemon_path, 'gas_estimate', comment_test, optimize=0)
+    success = True
+except Exception:
+    success = False
+assert not success
+try:
+    compile_daemon.request(daemon_path, 'compile', 'def foo(:')
+    success = True
+except Exception:
+    success = False
+assert not success
+daemon.shutdown()
+daemon.server_close()
+# The stale socket is replaced, but a regular file is left alone
+compile_daemon.CompileServer(daemon_path).server_close()
+file_path = os.path.join(os.path.dirname(daemon_path), 'not_a_socket')
+with open(file_path, 'w') as f:
+    f.write('data')
+try:
+    compile_daemon.CompileServer(file_path)
+    success = True
+except Exception:
+    success = False
+assert not success and open(file_path).read() == 'data'
+print('Passed compile daemon test')
+
+assert parser.get_method_id('returnMoose()') == parser.fourbytes_to_int(parser.sha3_256(b'returnMoose()')[:4])
+selector_path = os.path.join(tempfile.mkdtemp(), 'selectors.json')
+parser.save_method_ids(selector_path)
+saved = dict(parser.method_ids)
+parser.method_ids.clear()
+parser.load_method_ids(selector_path)
+assert parser.method_ids == saved and 'returnMoose()' in saved
+with open(selector_path, 'w') as f:
+    f.write('{"returnMoose()": -1, "foo(int128)": "0x12345678", "bar()": 4294967296, "baz()": 1234}')
+parser.method_ids.clear()
+parser.load_method_ids(selector_path)
+assert parser.method_ids == {'baz()': 1234}
+parser.method_ids.clear()
+assert parser.get_method_id('returnMoose()') == saved['returnMoose()']
+with open(selector_path, 'w') as f:
+    f.write('[1, 2, 3]')
+parser.load_method_ids(selector_path)
+parser.save_method_ids(selector_path)
+assert os.listdir(os.path.dirname(selector_path)) == ['selectors.json']
+parser.method_ids.clear()
+parser.load_method_ids(selector_path)
+assert parser.method_ids['returnMoose()'] == saved['returnMoose()']
+
+selector_code = """
+def foo(x: num) -> num:
+    return x
+
+def bar(x: num) -> num:
+    return x * 2
+
+def baz(x: num) -> num:
+    return x * 3
+"""
+
+selector_writes = []
+save_method_ids = parser.save_method_ids
+def counting_save(path):
+    selector_writes.append(path)
+    save_method_ids(path)
+parser.save_method_ids = counting_save
+selector_path = os.path.join(tempfile.mkdtemp(), 'selectors.json')
+os.environ['VIPER_SELECTOR_CACHE'] = selector_path
+parser.method_ids.clear()
+del parser._method_ids_loaded[:]
+t.languages['viper'].compile(selector_code)
+assert selector_writes == [selector_path]
+parser.method_ids.clear()
+parser.load_method_ids(selector_path)
+assert all(sig in parser.method_ids for sig in ('foo(int128)', 'bar(int128)', 'baz(int128)'))
+t.languages['viper'].compile(selector_code)
+assert selector_writes == [selector_path]
+# An unwritable cache must not break compilation
+os.environ['VIPER_SELECTOR_CACHE'] = os.path.join(tempfile.mkdtemp(), 'missing', 'selectors.json')
+parser.method_ids.clear()
+t.languages['viper'].compile(selector_code)
+assert len(selector_writes) == 2 and parser.method_ids['foo(int128)'] == parser.fourbytes_to_int(parser.sha3_256(b'foo(int128)')[:4])
+parser.save_method_ids = save_method_ids
+del os.environ['VIPER_SELECTOR_CACHE']
+print('Passed selector cache test')